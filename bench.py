@@ -0,0 +1,510 @@
+# Microbenchmarks for the compiler stages
+# usage: python bench.py [benchmark names...]   (runs all of them by default)
+import gc
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import fields
+from main import *
+from test_main import first_example, simple_stack, complex_stack, working
+
+
+def best_of(f, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def alpha_name(i):
+    # identifiers can't contain digits, so number generated names in base 26
+    name = ""
+    while True:
+        name = chr(ord("a") + i % 26) + name
+        i //= 26
+        if not i:
+            return name
+
+
+def big_program(nclasses):
+    # complex_stack's classes copied nclasses times under fresh names, followed by its main using the first copy
+    classes, main = complex_stack.split("\n\nmain")
+
+    def rename(src, i):
+        return src.replace("ListNode", "ListNode" + alpha_name(i)).replace("Stack", "Stack" + alpha_name(i))
+    copies = [rename(classes, i) for i in range(nclasses)]
+    return "\n".join(copies) + "\n\nmain" + rename(main, 0)
+
+
+def bench_tokenize():
+    src = (simple_stack + complex_stack) * 500
+    ntoks = len(Tokenizer(src).tokenize())
+    elapsed = best_of(lambda: Tokenizer(src).tokenize())
+    print(f"tokenize: {ntoks} tokens in {elapsed:.3f}s, {ntoks / elapsed:,.0f} tokens/sec")
+
+
+def traced(f):
+    # returns (result of f, bytes it left allocated)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    res = f()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return res, after - before
+
+
+def bench_token_memory():
+    src = (simple_stack + complex_stack) * 200
+    toks, compact = traced(lambda: Tokenizer(src).tokenize())
+    # one Token with its own lexeme string per token, the representation the TokenStream replaces
+    objs, full = traced(lambda: [Token(t.type, "".join(t.lexeme)) for t in toks])
+    n = len(toks)
+    print(f"token memory: {n} tokens, TokenStream {compact / n:.1f} bytes/token, Token list {full / n:.1f} bytes/token ({full / compact:.1f}x)")
+
+
+def bench_edit():
+    import random
+    rng = random.Random(0)
+    src = complex_stack + "\n"
+    src = src * (100_000 // src.count("\n"))
+    t = Tokenizer(src)
+    full = best_of(lambda: Tokenizer(src).tokenize(), repeat=1)
+    t.tokenize()
+    nedits = 200
+    start = time.perf_counter()
+    for _ in range(nedits):
+        offset = rng.randrange(len(t.s))
+        t.edit(offset, 0, "x")  # type a character
+        t.edit(offset, 1, "")   # and delete it
+    per_edit = (time.perf_counter() - start) / (2 * nedits)
+    print(f"edit: {src.count(chr(10))} lines, {len(t.toks)} tokens, full tokenize {full * 1000:.0f}ms, "
+          f"single character edit {per_edit * 1000:.2f}ms ({full / per_edit:.0f}x)")
+
+
+def bench_parse():
+    src = big_program(500)
+    t = Tokenizer(src)
+    ntoks = len(t.tokenize())
+
+    def parse():
+        t.pos = 0
+        Parser(t).parse_program()
+    elapsed = best_of(parse)
+    print(f"parse: {ntoks} tokens in {elapsed:.3f}s, {ntoks / elapsed:,.0f} tokens/sec")
+
+
+def bench_lazy_parse():
+    src = big_program(500)
+    t = Tokenizer(src)
+    t.tokenize()
+
+    def shapes(lazy):
+        t.pos = 0
+        Parser(t, lazy=lazy).parse_program().to_ir_tables()
+    eager = best_of(lambda: shapes(False))
+    lazy = best_of(lambda: shapes(True))
+    print(f"lazy parse: class tables of 1500 classes, eager parse {eager * 1000:.0f}ms, lazy parse {lazy * 1000:.0f}ms ({eager / lazy:.1f}x)")
+
+
+def count_nodes(tree):
+    n = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+        elif isinstance(node, ASTNode):
+            n += 1
+            stack.extend(getattr(node, f.name) for f in fields(node))
+    return n
+
+
+def bench_ast_memory():
+    t = Tokenizer(big_program(200))
+    t.tokenize()
+    tree, size = traced(lambda: Parser(t).parse_program())
+    n = count_nodes(tree)
+    print(f"ast memory: {n} nodes, {size / n:.1f} bytes/node")
+
+
+def bench_parallel_parse():
+    src = big_program(2000)
+    t = Tokenizer(src)
+    t.tokenize()
+
+    def parse(jobs):
+        t.pos = 0
+        Parser(t).parse_program(jobs=jobs)
+    serial = best_of(lambda: parse(1), repeat=3)
+    print(f"parallel parse: 6000 classes, serial {serial * 1000:.0f}ms", end="")
+    for jobs in [2, 4]:
+        elapsed = best_of(lambda: parse(jobs), repeat=3)
+        print(f", {jobs} processes {elapsed * 1000:.0f}ms", end="")
+    print(f" ({os.cpu_count()} cpus)")
+
+
+def bench_parse_cache():
+    src = big_program(1000).encode()
+    with tempfile.TemporaryDirectory() as path:
+        cache = ParseCache(path)
+
+        def cold():
+            t = Tokenizer(src.decode())
+            cache.store(src, t, Parser(t).parse_program())
+        parse = best_of(cold, repeat=3)
+        load = best_of(lambda: cache.load(src), repeat=3)
+    print(f"parse cache: {len(src) / 1024:.0f} KiB, parse and store {parse * 1000:.0f}ms, cache hit {load * 1000:.0f}ms"
+          f" ({parse / load:.1f}x)")
+
+
+def bench_lower():
+    # lowering time per AST node should stay flat as programs and expressions grow
+    for n in [250, 500, 1000]:
+        tree = Parser(Tokenizer(big_program(n))).parse_program()
+        nodes = count_nodes(tree)
+        gc.disable()  # otherwise collections rescanning the ever larger tree and IR dominate
+        elapsed = best_of(tree.to_ir_program, repeat=3)
+        gc.enable()
+        print(f"lower: {nodes} nodes in {elapsed * 1000:.0f}ms, {elapsed / nodes * 1e6:.2f}us/node")
+    for depth in [10_000, 100_000]:
+        stmt = Parser(Tokenizer("x = " + "(" * depth + "a" + " + b)" * depth)).parse_stmt()
+
+        def lower():
+            prog = IRProgram([], [], {})
+            prog.add_block("main")
+            stmt.to_ir(prog)
+        gc.disable()
+        elapsed = best_of(lower, repeat=3)
+        gc.enable()
+        print(f"lower: expression {depth} deep in {elapsed * 1000:.0f}ms, {elapsed / depth * 1e6:.2f}us/level")
+
+
+def bench_packed_ir():
+    prog = Parser(Tokenizer(big_program(500))).parse_program().to_ir_program()
+    ninsts = sum(len(b.statements) + 1 for b in prog.blocks)
+    # everything the blocks' instructions reference, without the tables the two forms share
+    _, objects = traced(lambda: Parser(Tokenizer(big_program(500))).parse_program().to_ir_program().blocks)
+    packed_prog, packed = traced(lambda: PackedProgram.from_ir(prog))
+    code = packed_prog.code.itemsize * len(packed_prog.code)
+    print(f"packed ir: {ninsts} instructions, {objects / ninsts:.1f} bytes/instruction as objects,"
+          f" {packed / ninsts:.1f} packed ({objects / packed:.1f}x), {code / ninsts:.1f} of it the code itself"
+          f" rather than the name tables")
+
+    # a whole pass over the packed code, without building any IR objects
+    runs = [PackedProgram.from_ir(prog) for _ in range(3)]
+    gc.disable()
+    elapsed = best_of(lambda: runs.pop().dce(), repeat=3)
+    gc.enable()
+    removed = sum(counts["instructions"] for counts in PackedProgram.from_ir(prog).dce().values())
+    print(f"packed ir: dce removed {removed} instructions in {elapsed * 1000:.0f}ms")
+
+
+def loopy_program(nloops):
+    # main running nloops loops one after another, each with a conditional inside: about 6 blocks per loop
+    loop = """    x = 0
+    while (x < 3): {
+        if (x == y): {
+            y = (y + x)
+        } else {
+            print(x)
+        }
+        x = (x + 1)
+    }
+"""
+    return "main with x, y:\n" + loop * nloops
+
+
+def bench_cfg():
+    for nloops in [10_000, 20_000]:
+        prog = Parser(Tokenizer(loopy_program(nloops))).parse_program().to_ir_program()
+        targets = [name for b in prog.blocks for name in successors(b.ctl_trans)]
+        lookup = best_of(lambda: [prog.get_block(name) for name in targets], repeat=3)
+
+        def rpo():
+            prog.rpo_cache.clear()
+            prog.rpo("main")
+        order = best_of(rpo, repeat=3)
+        index = best_of(prog.reindex, repeat=3)
+        print(f"cfg: {len(prog.blocks)} blocks, {len(targets)} edges: index {index * 1000:.0f}ms,"
+              f" looking up every branch target {lookup * 1000:.0f}ms, reverse postorder {order * 1000:.0f}ms")
+
+
+def bench_ssa():
+    for nloops in [5_000, 10_000, 20_000]:
+        tree = Parser(Tokenizer(loopy_program(nloops))).parse_program()
+        progs = [tree.to_ir_program() for _ in range(3)]
+        nblocks = len(progs[0].blocks)
+        gc.disable()
+        into = best_of(lambda: to_ssa(progs.pop()), repeat=3)
+        prog = tree.to_ir_program()
+        to_ssa(prog)
+        nphis = sum(len(phis(b)) for b in prog.blocks)
+        out = best_of(lambda: from_ssa(prog), repeat=1)
+        gc.enable()
+        print(f"ssa: {nblocks} blocks, {nphis} phis: into SSA {into:.2f}s ({into / nblocks * 1e6:.1f}us/block),"
+              f" out of SSA {out:.2f}s")
+
+
+def count_instructions(prog):
+    return sum(len(b.statements) + 1 for b in prog.blocks)
+
+
+def steps(prog):
+    interp = IRInterpreter(prog)
+    interp.run()
+    return interp.steps
+
+
+def bench_gvn():
+    prog = Parser(Tokenizer(working(complex_stack))).parse_program().to_ir_program()
+    before, dynamic = count_instructions(prog), steps(prog)
+    optimize(prog)
+    print(f"gvn: complex_stack {before} -> {count_instructions(prog)} instructions,"
+          f" {dynamic} -> {steps(prog)} executed")
+
+    tree = Parser(Tokenizer(big_program(1000))).parse_program()
+    prog = tree.to_ir_program()
+    to_ssa(prog)
+    gc.disable()
+    elapsed = best_of(lambda: gvn(prog), repeat=1)
+    gc.enable()
+    print(f"gvn: {len(prog.blocks)} blocks in {elapsed:.2f}s")
+
+
+def bench_sccp():
+    from test_main import constants
+    prog = Parser(Tokenizer(constants)).parse_program().to_ir_program()
+    to_ssa(prog)
+    before, dynamic = count_instructions(prog), steps(prog)
+    sccp(prog)
+    print(f"sccp: constants example in SSA form {before} -> {count_instructions(prog)} instructions,"
+          f" {dynamic} -> {steps(prog)} executed")
+
+    prog = Parser(Tokenizer(loopy_program(10_000))).parse_program().to_ir_program()
+    to_ssa(prog)
+    gc.disable()
+    elapsed = best_of(lambda: sccp(prog), repeat=1)
+    gc.enable()
+    print(f"sccp: {len(prog.blocks)} blocks in {elapsed:.2f}s")
+
+
+def bench_cleanup():
+    for n in [500, 1000]:
+        prog = Parser(Tokenizer(big_program(n))).parse_program().to_ir_program()
+        to_ssa(prog)
+        gvn(prog)
+        nblocks = len(prog.blocks)
+        gc.disable()
+        elapsed = best_of(lambda: cleanup(prog), repeat=1)
+        gc.enable()
+        print(f"cleanup: {nblocks} -> {len(prog.blocks)} blocks in {elapsed:.2f}s")
+
+
+def bench_peephole():
+    prog = Parser(Tokenizer(working(complex_stack))).parse_program().to_ir_program()
+    before, dynamic = count_instructions(prog), steps(prog)
+    report = peephole(prog)
+    cleanup(prog)
+    fired = {}
+    for counts in report.values():
+        for rule, n in counts.items():
+            fired[rule] = fired.get(rule, 0) + n
+    print(f"peephole: complex_stack {before} -> {count_instructions(prog)} instructions,"
+          f" {dynamic} -> {steps(prog)} executed, fired {fired}")
+
+    for n in [500, 1000]:
+        prog = Parser(Tokenizer(big_program(n))).parse_program().to_ir_program()
+        gc.disable()
+        elapsed = best_of(lambda: peephole(prog), repeat=1)
+        gc.enable()
+        print(f"peephole: {count_instructions(prog)} instructions in {elapsed:.2f}s")
+
+
+def bench_licm():
+    # complex_stack with a Stacker walking the stack the way loops in methods do: fields of this read and its
+    # methods called on every iteration
+    walker = working(complex_stack).replace("class Stacker [\n    fields", """class Walker [
+    fields stk, scale
+    method walk(n) with locals i, s:
+        i = 0
+        s = 0
+        while (i < n): {
+            s = (s + (&this.scale * 4))
+            i = (i + 1)
+        }
+        i = 0
+        while (i < n): {
+            _ = ^this.push(i)
+            i = (i + 1)
+        }
+        return s
+    method push(v) with locals:
+        return ^&this.stk.push(v)
+]
+class Stacker [
+    fields""").replace("    _ = ^stkr.do(stk)", """    _ = ^stkr.do(stk)
+    stkr = @Walker
+    !stkr.stk = stk
+    !stkr.scale = 3
+    print(^stkr.walk(50))""")
+
+    def compile(hoist):
+        prog = Parser(Tokenizer(walker)).parse_program().to_ir_program()
+        to_ssa(prog)
+        sccp(prog)
+        gvn(prog)
+        report = licm(prog) if hoist else {}
+        peephole(prog)
+        cleanup(prog)
+        from_ssa(prog)
+        cleanup(prog)
+        return prog, report
+
+    without, _ = compile(False)
+    prog, report = compile(True)
+    assert IRInterpreter(prog).run() == IRInterpreter(without).run()
+    hoisted = sum(counts["hoisted"] for counts in report.values())
+    print(f"licm: complex_stack with loops in methods, {hoisted} instructions hoisted,"
+          f" {steps(without)} -> {steps(prog)} executed")
+
+    prog = Parser(Tokenizer(loopy_program(10_000))).parse_program().to_ir_program()
+    to_ssa(prog)
+    gc.disable()
+    elapsed = best_of(lambda: licm(prog), repeat=1)
+    gc.enable()
+    print(f"licm: {len(prog.blocks)} blocks in {elapsed:.2f}s")
+
+
+def bench_inline():
+    def compile(prg, budget):
+        prog = Parser(Tokenizer(prg)).parse_program().to_ir_program()
+        to_ssa(prog)
+        report = devirtualize(prog) if budget else {}
+        inline(prog, budget)
+        for opt in [sccp, gvn, licm, peephole, cleanup, from_ssa, cleanup]:
+            opt(prog)
+        return prog, report
+
+    for name, prg in [("simple_stack", working(simple_stack)), ("complex_stack", working(complex_stack))]:
+        without, _ = compile(prg, 0)
+        for budget in [INLINE_BUDGET, 64]:
+            prog, report = compile(prg, budget)
+            direct = sum(counts["calls"] for counts in report.values())
+            print(f"inline: {name} with budget {budget}, {direct} calls made direct,"
+                  f" {count_instructions(without)} -> {count_instructions(prog)} instructions,"
+                  f" {steps(without)} -> {steps(prog)} executed")
+
+    prog = Parser(Tokenizer(big_program(1000))).parse_program().to_ir_program()
+    to_ssa(prog)
+    gc.disable()
+    elapsed = best_of(lambda: (devirtualize(prog), inline(prog)), repeat=1)
+    gc.enable()
+    print(f"inline: {len(prog.blocks)} blocks after in {elapsed:.2f}s")
+
+
+def bench_fields():
+    def compile(prg, resolve):
+        prog = Parser(Tokenizer(prg)).parse_program().to_ir_program()
+        to_ssa(prog)
+        devirtualize(prog)
+        inline(prog)
+        report = resolve_fields(prog) if resolve else {}
+        for opt in [sccp, gvn, licm, peephole, cleanup, from_ssa, cleanup]:
+            opt(prog)
+        return prog, report
+
+    for name, prg in [("simple_stack", working(simple_stack)), ("complex_stack", working(complex_stack))]:
+        without, _ = compile(prg, False)
+        prog, report = compile(prg, True)
+        resolved = ", ".join(f"{f} {counts['fields']}" for f, counts in report.items() if counts["fields"])
+        print(f"fields: {name} resolved {resolved}; {steps(without)} -> {steps(prog)} executed")
+
+    prog = Parser(Tokenizer(big_program(1000))).parse_program().to_ir_program()
+    to_ssa(prog)
+    gc.disable()
+    elapsed = best_of(lambda: resolve_fields(prog), repeat=1)
+    gc.enable()
+    print(f"fields: {count_instructions(prog)} instructions in {elapsed:.2f}s")
+
+
+def bench_tables():
+    # classes with fields and methods of their own, besides a couple every class has
+    for n in [1000, 3000]:
+        classes = "".join(f"""class C{alpha_name(i)} [
+    fields val, a{alpha_name(i)}, b{alpha_name(i)}
+    method get() with locals:
+        return &this.val
+    method m{alpha_name(i)}() with locals:
+        return &this.a{alpha_name(i)}
+]
+""" for i in range(n))
+        tree = Parser(Tokenizer(classes + "\nmain with:")).parse_program()
+        for compact in [False, True]:
+            tree.to_ir_tables(compact)  # intern everything first
+            gc.disable()
+            elapsed = best_of(lambda: tree.to_ir_tables(compact), repeat=1)
+            gc.enable()
+            sizes = tree.to_ir_tables(compact).table_sizes()
+            print(f"tables: {n} classes {'compact' if compact else 'dense'}, vtables {sizes['vtables'][1]} words,"
+                  f" field maps {sizes['field maps'][1]} words, built in {elapsed:.2f}s")
+
+    for compact in [False, True]:
+        prog = Parser(Tokenizer(working(complex_stack))).parse_program().to_ir_program(compact)
+        before = steps(prog)
+        optimize(prog)
+        print(f"tables: complex_stack {'compact' if compact else 'dense'} {before} executed, {steps(prog)} optimized")
+
+
+def bench_escape():
+    def compile(prg, replace):
+        prog = Parser(Tokenizer(prg)).parse_program().to_ir_program()
+        to_ssa(prog)
+        report = {}
+        for opt in [devirtualize, inline, resolve_fields, sccp, gvn]:
+            opt(prog)
+        if replace:
+            report = scalar_replace(prog)
+        for opt in [licm, peephole, cleanup, from_ssa, cleanup]:
+            opt(prog)
+        return prog, report
+
+    # a temporary point made, read through a method and dropped every iteration
+    points = """class Pt [
+    fields x, y
+    method sum() with locals:
+      return (&this.x + &this.y)
+]
+
+main with p, s, i:
+    while (i < 1000): {
+        p = @Pt
+        !p.x = i
+        !p.y = (i * 2)
+        s = (s + ^p.sum())
+        i = (i + 1)
+    }
+    print(s)"""
+    for name, prg in [("first_example", first_example), ("points", points), ("complex_stack", working(complex_stack))]:
+        without, _ = compile(prg, False)
+        prog, report = compile(prg, True)
+        allocations = sum(counts["allocations"] for counts in report.values())
+        print(f"escape: {name} {allocations} allocations replaced; {steps(without)} -> {steps(prog)} executed")
+
+    prog = Parser(Tokenizer(big_program(1000))).parse_program().to_ir_program()
+    to_ssa(prog)
+    gc.disable()
+    elapsed = best_of(lambda: scalar_replace(prog), repeat=1)
+    gc.enable()
+    print(f"escape: {count_instructions(prog)} instructions in {elapsed:.2f}s")
+
+
+BENCHMARKS = {name[len("bench_"):]: f for name, f in list(globals().items()) if name.startswith("bench_")}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
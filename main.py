@@ -1,8 +1,23 @@
 import argparse
+import codecs
+import hashlib
+import io
+import mmap
+import operator
+import os
+import pickle
+import re
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 from abc import ABC, abstractmethod
-from dataclasses import dataclass, field
-from typing import Union
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass, field, replace
+from functools import partial
+from itertools import takewhile
+from typing import Callable, Union
 # TODO
 # Questions
 # No infinite parsing if the while loops don't terminate (check when we return None from tokenizer and end loop and
@@ -52,9 +67,43 @@ class TokenType(Enum):
     IDENTIFIER = 38
 
 OPERATORS = [TokenType.PLUS,TokenType.MINUS,TokenType.ASTER,TokenType.SLASH,TokenType.LABRAC,TokenType.RABRAC,TokenType.DEQUAL,TokenType.NEQUAL]
+OPERATOR_TYPES = frozenset(OPERATORS)
+METHOD_BODY_END = frozenset([TokenType.METHOD,TokenType.RSBRAC])
+CLASS_END = frozenset([TokenType.RSBRAC])
+
+# Fixed spelling of every punctuation token, the keywords are the lower case names of TokenType.IF through TokenType.MAIN
+# The lexer tables below are generated from these, so a new token only needs an entry here
+SPELLINGS = {
+    TokenType.LPAREN: "(",
+    TokenType.RPAREN: ")",
+    TokenType.LSBRAC: "[",
+    TokenType.RSBRAC: "]",
+    TokenType.LCBRAC: "{",
+    TokenType.RCBRAC: "}",
+    TokenType.LABRAC: "<",
+    TokenType.RABRAC: ">",
+    TokenType.CARET: "^",
+    TokenType.DOT: ".",
+    TokenType.COMMA: ",",
+    TokenType.COLON: ":",
+    TokenType.AMP: "&",
+    TokenType.AT: "@",
+    TokenType.EXCLAM: "!",
+    TokenType.PLUS: "+",
+    TokenType.MINUS: "-",
+    TokenType.ASTER: "*",
+    TokenType.SLASH: "/",
+    TokenType.EQUAL: "=",
+    TokenType.DEQUAL: "==",
+    TokenType.NEQUAL: "!=",
+    TokenType.UNDER: "_",
+    TokenType.NEWLINE: "\n",
+}
+KEYWORDS = {t.name.lower(): t for t in TokenType if TokenType.IF.value <= t.value <= TokenType.MAIN.value}
 
 
 class Token():
+    __slots__ = ("type", "lexeme")
     def __init__(self,typ:TokenType,lexeme:str):
         self.type = typ
         self.lexeme = lexeme
@@ -62,138 +111,355 @@ class Token():
         return str((self.type,self.lexeme))
 
 
+def build_lex_table():
+    # first character of a token -> what to lex. Punctuation maps to its TokenType, or to a dict from the following
+    # character to TokenType when it begins a two character operator ("" holds the one character token).
+    # Digits and letters map to TokenType.NUMBER/IDENTIFIER and are lexed as a run.
+    table = {}
+    for typ, spelling in SPELLINGS.items():
+        if len(spelling) == 1 and spelling not in table:
+            table[spelling] = typ
+        else:
+            prev = table.get(spelling[0])
+            follow = prev if type(prev) is dict else {"": prev} if prev else {}
+            follow[spelling[1:]] = typ
+            table[spelling[0]] = follow
+    for c in "0123456789":
+        table[c] = TokenType.NUMBER
+    for c in "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ":
+        table[c] = TokenType.IDENTIFIER
+    return table
+
+LEX_TABLE = build_lex_table()
+FIXED_TOKENS = {t: Token(t, s) for t, s in [*SPELLINGS.items(), *((t, s) for s, t in KEYWORDS.items())]}
+KEYWORD_LEN = max(map(len, KEYWORDS))
+WHITESPACE = re.compile(r"[ \t]*")
+DIGITS = re.compile(r"\d+")
+WORD = re.compile(r"[^\W\d_]+")
+
+
+def lex_span(src:str, pos:int):
+    # Lex the token starting at or after (skipping blanks) string pos pos, returns (type, start, end) of its span
+    # Returns (None, len(src), len(src)) at the end of the input
+    pos = WHITESPACE.match(src, pos).end()
+    if pos >= len(src):
+        return None, pos, pos
+
+    c = src[pos]
+    entry = LEX_TABLE.get(c)
+    if entry is None:
+        # only non-ascii characters miss the table
+        if DIGITS.match(c):
+            entry = TokenType.NUMBER
+        elif WORD.match(c):
+            entry = TokenType.IDENTIFIER
+        else:
+            raise ValueError(f"Inappropriate symbol {c}")
+
+    if type(entry) is dict:
+        # a character that starts both a one and a two character operator, e.g. = and ==
+        nxt = src[pos+1:pos+2]
+        return (entry[nxt], pos, pos + 2) if nxt in entry else (entry[""], pos, pos + 1)
+    elif entry is TokenType.NUMBER:
+        return entry, pos, DIGITS.match(src, pos).end()
+    elif entry is TokenType.IDENTIFIER:
+        end = WORD.match(src, pos).end()
+        if end - pos <= KEYWORD_LEN:
+            entry = KEYWORDS.get(src[pos:end], entry)
+        return entry, pos, end
+    return entry, pos, pos + 1
+
+
+def lex_token(src:str, pos:int, symbols:"SymbolTable"):
+    # lex_span, but builds the Token with identifiers interned in symbols: returns (token, string pos after it)
+    typ, start, end = lex_span(src, pos)
+    if typ is None:
+        return None, end
+    if typ is TokenType.IDENTIFIER:
+        return Token(typ, symbols.intern(src[start:end])), end
+    return FIXED_TOKENS.get(typ) or Token(typ, src[start:end]), end
+
+
+class Symbol(str):
+    # An interned identifier. Compares and hashes like the plain string, and carries its index in its SymbolTable
+    # so tables keyed by names can be lists indexed by id
+    __slots__ = ("id",)
+
+
+class SymbolTable:
+    def __init__(self):
+        self.names = []  # Symbols by id
+        self.lookup = {}
+
+    def intern(self,name:str) -> Symbol:
+        sym = self.lookup.get(name)
+        if sym is None:
+            sym = Symbol(name)
+            sym.id = len(self.names)
+            self.names.append(sym)
+            self.lookup[sym] = sym
+        return sym
+
+    def id_of(self,name:str) -> int:
+        # names lexed against this table already know their id, anything else is interned first
+        if type(name) is Symbol and self.names[name.id] is name:
+            return name.id
+        return self.intern(name).id
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self,i:int) -> Symbol:
+        return self.names[i]
+
+
+class TokenStream:
+    # Compact token list: one byte of type code, the (start, end) span in the source, and for identifiers the
+    # symbol id, per token in parallel arrays
+    # Indexing it gives a Token, built on demand with its lexeme sliced out of the source (the interned Symbol for
+    # identifiers), and for punctuation and keywords a shared instance
+    TYPES = list(TokenType)
+
+    def __init__(self,src:str,symbols:SymbolTable):
+        self.src = src
+        self.symbols = symbols
+        self.types = array("B")
+        self.starts = array("I")
+        self.ends = array("I")
+        self.syms = array("I")
+
+    def append(self,typ:TokenType,start:int,end:int):
+        self.types.append(typ._value_)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.syms.append(self.symbols.intern(self.src[start:end]).id if typ is TokenType.IDENTIFIER else 0)
+
+    def type(self,i:int) -> TokenType:
+        return self.TYPES[self.types[i]]
+
+    def lexeme(self,i:int) -> str:
+        if self.types[i] == TokenType.IDENTIFIER.value:
+            return self.symbols[self.syms[i]]
+        return self.src[self.starts[i]:self.ends[i]]
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self,i):
+        if type(i) is slice:
+            return [self[j] for j in range(*i.indices(len(self)))]
+        typ = self.TYPES[self.types[i]]
+        return FIXED_TOKENS.get(typ) or Token(typ, self.lexeme(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def shifted(a:array,delta:int) -> array:
+    # a copy of the unsigned array a with delta added to every element (none of which may go negative or overflow)
+    # Done as one big integer addition of delta in every lane, which is far faster than adding element by element
+    width = a.itemsize
+    lanes = int.from_bytes((1).to_bytes(width, sys.byteorder) * len(a), sys.byteorder)
+    total = int.from_bytes(a.tobytes(), sys.byteorder) + delta * lanes
+    res = array(a.typecode)
+    res.frombytes(total.to_bytes(width * len(a), sys.byteorder))
+    return res
+
+
 class Tokenizer:
-    def __init__(self,s:str):
+    def __init__(self,s:str,symbols:SymbolTable=None):
         self.s = s
+        self.i = 0  # string pos of the first character not yet tokenized
         self.pos = 0
-        self.toks = []
+        self.symbols = SymbolTable() if symbols is None else symbols
+        self.toks = TokenStream(s, self.symbols)
 
     def peek(self) -> Token:
-        tok = self.get_next()
-        self.pos -= 1
-        return tok
+        if len(self.toks) > self.pos or self.lex_next():
+            return self.toks[self.pos]
+        return None
+
+    def peek_type(self) -> TokenType:
+        if len(self.toks) > self.pos or self.lex_next():
+            return self.toks.type(self.pos)
+        return None
+
+    def lex_next(self) -> bool:
+        # Lex one more token into the cache, False at the end of the input
+        typ, start, self.i = lex_span(self.s, self.i)
+        if typ is None:
+            return False
+        self.toks.append(typ, start, self.i)
+        return True
 
     def get_next(self) -> Token:
-        if len(self.toks) > self.pos:
+        if len(self.toks) > self.pos or self.lex_next():
             tok = self.toks[self.pos]
             self.pos += 1
             return tok
+        return None
+
+    def skip_until(self,stop:frozenset) -> int:
+        # Move to the next token whose type is in stop (or the end of the input) without building any Tokens
+        # Returns the number of newlines skipped
+        # The type column is searched as bytes, with a regex matching any of the stop type codes
+        self.lex_all()
+        with memoryview(self.toks.types) as types:
+            found = re.compile(b"[" + re.escape(bytes(typ.value for typ in stop)) + b"]").search(types, self.pos)
+            end = found.start() if found else len(types)
+            newlines = bytes(types[self.pos:end]).count(TokenType.NEWLINE.value)
+            del found
+        self.pos = end
+        return newlines
 
-        pos = 0  # string pos not the token cache pos
-        while(pos < len(self.s) and (c := self.s[pos]) in ["\t"," "]):
-            pos += 1
 
-        if pos >= len(self.s):
-            return None
-        pos += 1
-
-        tok = None
-        if c == "(":
-            tok = Token(TokenType.LPAREN, "(")
-        if c == ")":
-            tok = Token(TokenType.RPAREN, ")")
-        if c == "[":
-            tok = Token(TokenType.LSBRAC, "[")
-        if c == "]":
-            tok = Token(TokenType.RSBRAC, "]")
-        if c == "{":
-            tok = Token(TokenType.LCBRAC, "{")
-        if c == "}":
-            tok = Token(TokenType.RCBRAC, "}")
-        if c == "^":
-            tok = Token(TokenType.CARET, "^")
-        if c == ".":
-            tok = Token(TokenType.DOT, ".")
-        if c == ",":
-            tok = Token(TokenType.COMMA, ",")
-        if c == ":":
-            tok = Token(TokenType.COLON, ":")
-        if c == "&":
-            tok = Token(TokenType.AMP, "&")
-        if c == "@":
-            tok = Token(TokenType.AT, "@")
-        if c == "!":
-            if self.s[pos] == "=":
-                pos +=1
-                tok = Token(TokenType.NEQUAL,"!=")
-            else:
-                tok = Token(TokenType.EXCLAM, "!")
-        if c == "+":
-            tok = Token(TokenType.PLUS, "+")
-        if c == "-":
-            tok = Token(TokenType.MINUS, "-")
-        if c == "*":
-            tok = Token(TokenType.ASTER, "*")
-        if c == "/":
-            tok = Token(TokenType.SLASH, "/")
-        if c == "<":
-            tok = Token(TokenType.LABRAC, "<")
-        if c == ">":
-            tok = Token(TokenType.RABRAC, ">")
-        if c == "=":
-            if self.s[pos] == "=":
-                pos += 1
-                tok = Token(TokenType.DEQUAL,"==")
+    def tokenize(self):
+        self.lex_all()
+        self.pos = 0
+        return self.toks
+
+    def lex_all(self):
+        # lex the rest of the input into the cache
+        src, i = self.s, self.i
+        add_type, add_start, add_end = self.toks.types.append, self.toks.starts.append, self.toks.ends.append
+        add_sym, intern, interned = self.toks.syms.append, self.symbols.intern, self.symbols.lookup.get
+        ident = TokenType.IDENTIFIER
+        while True:
+            typ, start, i = lex_span(src, i)
+            if typ is None:
+                break
+            add_type(typ._value_)
+            add_start(start)
+            add_end(i)
+            if typ is ident:
+                s = src[start:i]
+                add_sym((interned(s) or intern(s)).id)
             else:
-                tok = Token(TokenType.EQUAL, "=")
-        if c == "_":
-            tok = Token(TokenType.UNDER, "_")
-        if c == "\n":
-            tok = Token(TokenType.NEWLINE,"\n")
-
-        s = str(c)
-        if c.isdigit():
-            while pos < len(self.s) and (c:= self.s[pos]).isdigit():
-                s += str(c)
-                pos += 1
-            tok = Token(TokenType.NUMBER,s)
-
-        if c.isalpha():
-            while pos < len(self.s) and (c := self.s[pos]).isalpha():
-                s += c
-                pos += 1
-            tok = Token(TokenType.IDENTIFIER,s)
-        if s == "if":
-            tok = Token(TokenType.IF,s)
-        if s == "else":
-            tok = Token(TokenType.ELSE,s)
-        if s == "ifonly":
-            tok = Token(TokenType.IFONLY,s)
-        if s == "while":
-            tok = Token(TokenType.WHILE,s)
-        if s == "return":
-            tok = Token(TokenType.RETURN,s)
-        if s == "print":
-            tok = Token(TokenType.PRINT,s)
-        if s == "this":
-            tok = Token(TokenType.THIS,s)
-        if s == "class":
-            tok = Token(TokenType.CLASS,s)
-        if s == "with":
-            tok = Token(TokenType.WITH,s)
-        if s == "locals":
-            tok = Token(TokenType.LOCALS,s)
-        if s == "fields":
-            tok = Token(TokenType.FIELDS,s)
-        if s == "method":
-            tok = Token(TokenType.METHOD,s)
-        if s == "main":
-            tok = Token(TokenType.MAIN,s)
-
-        self.s = self.s[pos:]
-        if tok is None:
-            raise ValueError(f"Inappropriate symbol {c}")
+                add_sym(0)
+        self.i = i
+
+
+    def edit(self,offset:int,deleted:int,inserted:str):
+        # Replace deleted characters at string pos offset with inserted, re-lexing only the tokens the edit damaged
+        # The cache is first completed, then the new tokens are spliced in over the old ones as soon as lexing
+        # resynchronizes with the old stream (the same token at the same, shifted, place after the edit)
+        # Returns (first, old_end, new_end): tokens first:old_end of the old stream became first:new_end
+        self.tokenize()
+        toks = self.toks
+        types, starts, ends, syms = toks.types, toks.starts, toks.ends, toks.syms
+        n = len(types)
+        src = self.s[:offset] + inserted + self.s[offset+deleted:]
+        delta = len(inserted) - deleted
+        edit_end = offset + deleted
+
+        # a token depends on its own characters and the one after it, so the first damaged token is the first one
+        # ending at or after the edit. Re-lexing from the end of the token before it is the same as from its start.
+        first = bisect_left(ends, offset)
+        i = ends[first-1] if first else 0
+        k = bisect_left(starts, edit_end, first)  # old tokens from k on are unchanged text, candidates to resync at
+        new_types, new_starts, new_ends, new_syms = array("B"), array("I"), array("I"), array("I")
+        intern = self.symbols.intern
+        while True:
+            typ, start, i = lex_span(src, i)
+            if typ is None:
+                k = n
+                break
+            while k < n and starts[k] + delta < start:
+                k += 1
+            if k < n and starts[k] + delta == start and ends[k] + delta == i and types[k] == typ._value_:
+                break
+            new_types.append(typ._value_)
+            new_starts.append(start)
+            new_ends.append(i)
+            new_syms.append(intern(src[start:i]).id if typ is TokenType.IDENTIFIER else 0)
+
+        if delta:
+            new_starts.extend(shifted(starts[k:], delta))
+            new_ends.extend(shifted(ends[k:], delta))
+            starts[first:] = new_starts
+            ends[first:] = new_ends
         else:
-            self.pos +=1
-            self.toks.append(tok)
-            return tok
+            starts[first:k] = new_starts
+            ends[first:k] = new_ends
+        types[first:k] = new_types
+        syms[first:k] = new_syms
+        self.s = toks.src = src
+        self.i = len(src)
+        self.pos = 0
+        return first, k, first + len(new_types)
+
+
+class StreamTokenizer:
+    # Tokenizes a file object (text or binary, e.g. open(path, "rb") or an mmap) a chunk at a time
+    # Only the unlexed tail of the current chunk and a window of lookahead tokens are held, never the whole input,
+    # so it can stand in for a Tokenizer under the Parser which only ever looks one token ahead
+    def __init__(self,f,chunk_size:int=1<<16,lookahead:int=1,symbols:SymbolTable=None):
+        self.f = f
+        self.symbols = SymbolTable() if symbols is None else symbols
+        self.chunk_size = chunk_size
+        self.lookahead = lookahead
+        self.window = deque()
+        self.stream = self.tokens()
+
+    def tokens(self):
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        buf = ""
+        pos = 0
+        eof = False
+        while True:
+            # a token is only complete once a character after it has been seen (identifiers and numbers run on,
+            # = may become ==), so stop one short of the end of the buffer until the input runs out
+            while True:
+                tok, end = lex_token(buf, pos, self.symbols)
+                if tok is None or (end >= len(buf) and not eof):
+                    break
+                pos = end
+                yield tok
+            if eof:
+                return
+            chunk = self.f.read(self.chunk_size)
+            if not chunk:
+                eof = True
+            if type(chunk) is not str:
+                chunk = decoder.decode(chunk, final=eof)
+            buf = buf[pos:] + chunk
+            pos = 0
+
+    def __iter__(self):
+        while (tok := self.get_next()) is not None:
+            yield tok
+
+    def peek(self,k:int=0) -> Token:
+        if k >= self.lookahead:
+            raise IndexError(f"Can only look {self.lookahead} tokens ahead")
+        while len(self.window) <= k:
+            tok = next(self.stream, None)
+            if tok is None:
+                return None
+            self.window.append(tok)
+        return self.window[k]
+
+    def peek_type(self) -> TokenType:
+        tok = self.peek()
+        return None if tok is None else tok.type
 
+    def get_next(self) -> Token:
+        if self.window:
+            return self.window.popleft()
+        return next(self.stream, None)
+
+
+def open_source(path:str):
+    # Map the file so it is paged in as the tokenizer reads it rather than read up front
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return io.BytesIO()  # empty files can't be mapped
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-    def tokenize(self):
-        while(self.get_next()):
-            pass
-        self.pos = 0
-        return self.toks
 
 class IRStatement(ABC):
     pass
@@ -207,23 +473,38 @@ class IRControlTransfer(ABC):
 @dataclass
 class IRVar(IRExpression):
     reg:str
+    def __str__(self):
+        return f"%{self.reg}"
 
 
 @dataclass
 class IRConst(IRExpression):
     n:int
+    def __str__(self):
+        return str(self.n)
 
 @dataclass
 class IRArray:
     # Since these are literally supposed to take on values that the same aspects in the blocks will take on they can have the same type, the IRBlockNames will match the block names of blocks etc
     vals:list[Union[str,IRConst]]
     name:str
+    def __str__(self):
+        # as an operand, the full contents are listed with the program's data
+        return f"@{self.name}"
+
+@dataclass
+class IRLabel(IRExpression):
+    # a function's code as a value, what a vtable entry is: named as in the data its vtable is listed with
+    name:str
+    def __str__(self):
+        return self.name
 
 @dataclass
 class IRBasicBlock:
     name:str
     statements:list[IRStatement]
     ctl_trans:IRControlTransfer
+    id:int = field(default=-1, repr=False, compare=False)  # its index in the CFG of the IRProgram it's in
 
     def add_statement(self,stmt:IRStatement):
         self.statements.append(stmt)
@@ -231,82 +512,138 @@ class IRBasicBlock:
     def add_ctl_trans(self,trans:IRControlTransfer):
         self.ctl_trans=trans
 
+    def __str__(self):
+        return "\n".join([f"{self.name}:", *(f"    {s}" for s in self.statements), f"    {self.ctl_trans}"])
+
 NONGLOBALS = Union[IRVar,IRConst]
 GLOBALS = Union[NONGLOBALS,IRArray]
+OPERAND_TYPES = frozenset([IRVar,IRConst,IRArray,IRLabel])
 
+def is_operand(v) -> bool:
+    return type(v) in OPERAND_TYPES
+
+# IROperation is arithmetic and comparison from the source program, IROp the compiler's own bit twiddling (tag checks)
 @dataclass
 class IROperation(IRExpression):
     l:NONGLOBALS
     op:str
     r:NONGLOBALS
+    def __str__(self):
+        return f"{self.l} {self.op} {self.r}"
 
 @dataclass
 class IRCall(IRExpression):
     c:IRVar
     r:IRVar
     args:list[NONGLOBALS]
+    def __str__(self):
+        return f"call({', '.join(map(str, [self.c, self.r, *self.args]))})"
 
 @dataclass
 class IRPhi(IRExpression):
     block_names:list[str]
     vars:list[IRVar]
+    def __str__(self):
+        return f"phi({', '.join(f'{b}, {v}' for b, v in zip(self.block_names, self.vars))})"
 
 @dataclass
 class IRAlloc(IRExpression):
     n:IRConst
+    def __str__(self):
+        return f"alloc({self.n})"
 
 @dataclass
 class IROp(IRExpression):
     l:NONGLOBALS
     op:str
     r:NONGLOBALS
+    def __str__(self):
+        return f"{self.l} {self.op} {self.r}"
 
 @dataclass
 class IRGetELT(IRExpression):
     base:IRVar
     i:NONGLOBALS
+    def __str__(self):
+        return f"getelt({self.base}, {self.i})"
 
 @dataclass
 class IRLoad(IRExpression):
     base:IRVar
+    def __str__(self):
+        return f"load({self.base})"
 
 @dataclass
 class IRStore(IRStatement):
     base:IRVar
     i:GLOBALS
+    def __str__(self):
+        return f"store({self.base}, {self.i})"
 
 @dataclass
 class IRSetELT(IRStatement):
     base:IRVar
     i:GLOBALS
     i2:GLOBALS
+    def __str__(self):
+        return f"setelt({self.base}, {self.i}, {self.i2})"
 
 @dataclass
 class IRPrint(IRStatement):
     v:NONGLOBALS
+    def __str__(self):
+        return f"print({self.v})"
 
 @dataclass
 class IRAssign(IRStatement):
     v:IRVar
     val:IRExpression
+    def __str__(self):
+        return f"{self.v} = {self.val}"
 
 @dataclass
 class IRIf(IRControlTransfer):
     v:IRVar
     b_true:str
     b_false:str
+    def __str__(self):
+        return f"if {self.v} then {self.b_true} else {self.b_false}"
 
 @dataclass
 class IRJump(IRControlTransfer):
     b:str
+    def __str__(self):
+        return f"jump {self.b}"
 
 @dataclass
 class IRRet(IRControlTransfer):
     v:NONGLOBALS
+    def __str__(self):
+        return f"ret {self.v}"
 
 @dataclass
 class IRFail(IRControlTransfer):
     m:str  # For the moment who knows
+    def __str__(self):
+        return f"fail {self.m}"
+
+def successors(trans:IRControlTransfer) -> list[str]:
+    # names of the blocks trans can go to
+    match trans:
+        case IRIf(_, b_true, b_false):
+            return [b_true] if b_true == b_false else [b_true, b_false]
+        case IRJump(b):
+            return [b]
+    return []
+
+def retarget(trans:IRControlTransfer,old:str,new:str) -> IRControlTransfer:
+    # trans going to the block named new wherever it went to old
+    match trans:
+        case IRIf(v, b_true, b_false):
+            return IRIf(v, new if b_true == old else b_true, new if b_false == old else b_false)
+        case IRJump(b):
+            return IRJump(new if b == old else b)
+    return trans
 
 @dataclass
 class IRProgram:
@@ -315,41 +652,2042 @@ class IRProgram:
     field_name_to_map_index: dict[str, int]
     blocks: list[IRBasicBlock] = field(default_factory=list)
     curr_block:IRBasicBlock = None
+    method_name_to_vtbl_index: dict[str, int] = field(default_factory=dict)
+    # The same two numberings as lists indexed by symbol id (-1 for names that aren't fields/methods of any class),
+    # used for names interned in symbols
+    symbols: "SymbolTable" = field(default=None, repr=False)
+    field_index: list[int] = field(default_factory=list, repr=False)
+    method_index: list[int] = field(default_factory=list, repr=False)
+    class_index: dict[str, int] = field(default_factory=dict)  # class name -> index of its vtable and field map
+    # Whether the tables are compact: names numbered by selector coloring, and each number's slot a pair of words,
+    # the selector (the name's symbol id + 1) of the name it holds in this class and then its entry
+    compact_tables: bool = False
+    tmp_counter: int = 0
+    label_counter: int = 0
+    fail_blocks: dict[str, str] = field(default_factory=dict, repr=False)  # failure message -> block failing with it
+    functions: dict[str, list[str]] = field(default_factory=dict)  # entry block name -> parameter names, in order
+    # The CFG, kept up to date as blocks are added and removed and their control transfers set
+    # Every block name gets an id when it's first seen, added or branched to, which indexes blocks_by_id (None until
+    # the block is added, and once it's removed) and the adjacency lists
+    block_map: dict[str, IRBasicBlock] = field(init=False, repr=False, compare=False)
+    block_ids: dict[str, int] = field(init=False, repr=False, compare=False)
+    blocks_by_id: list[IRBasicBlock] = field(init=False, repr=False, compare=False)
+    succ_ids: list[list[int]] = field(init=False, repr=False, compare=False)
+    pred_ids: list[list[int]] = field(init=False, repr=False, compare=False)
+    rpo_cache: dict[str, list[int]] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.reindex()
+
+    def reindex(self):
+        # rebuild the CFG from scratch, for when blocks have been changed directly
+        self.block_map = {}
+        self.block_ids = {}
+        self.blocks_by_id = []
+        self.succ_ids = []
+        self.pred_ids = []
+        self.rpo_cache = {}
+        for b in self.blocks:
+            self.index_block(b)
+        for b in self.blocks:
+            self.link(b)
+
+    def block_id(self,name:str) -> int:
+        i = self.block_ids.get(name)
+        if i is None:
+            i = self.block_ids[name] = len(self.blocks_by_id)
+            self.blocks_by_id.append(None)
+            self.succ_ids.append([])
+            self.pred_ids.append([])
+        return i
+
+    def index_block(self,block:IRBasicBlock):
+        if block.name in self.block_map:
+            raise ValueError(f"There's already a block named {block.name}")
+        block.id = self.block_id(block.name)
+        self.blocks_by_id[block.id] = block
+        self.block_map[block.name] = block
+
+    def link(self,block:IRBasicBlock):
+        # add the edges out of block
+        for name in successors(block.ctl_trans):
+            i = self.block_id(name)
+            self.succ_ids[block.id].append(i)
+            self.pred_ids[i].append(block.id)
+        self.rpo_cache.clear()
+
+    def unlink(self,block:IRBasicBlock):
+        for i in self.succ_ids[block.id]:
+            self.pred_ids[i].remove(block.id)
+        self.succ_ids[block.id] = []
+        self.rpo_cache.clear()
+
+    def set_ctl_trans(self,block:IRBasicBlock,trans:IRControlTransfer):
+        old = self.succ_ids[block.id]
+        self.unlink(block)
+        block.add_ctl_trans(trans)
+        self.link(block)
+        for i in set(old) - set(self.succ_ids[block.id]):
+            self.drop_phi_edge(i,block.name)
+
+    def drop_phi_edge(self,i:int,pred:str):
+        # remove the operands for the edge from pred from the phis of the block with id i, now that the edge's gone
+        block = self.blocks_by_id[i]
+        if block is None:
+            return
+        for stmt in takewhile(is_phi, block.statements):
+            phi = stmt.val
+            if pred in phi.block_names:
+                j = phi.block_names.index(pred)
+                del phi.block_names[j], phi.vars[j]
+
+    def remove_blocks(self,ids:set[int]):
+        # remove the blocks with ids, which nothing else may branch to
+        if any(p not in ids for i in ids for p in self.pred_ids[i]):
+            raise ValueError("Can't remove blocks that are still branched to")
+        for i in ids:
+            block = self.blocks_by_id[i]
+            for s in self.succ_ids[i]:
+                if s not in ids:
+                    self.drop_phi_edge(s,block.name)
+            self.unlink(block)
+            del self.block_map[block.name]
+            self.blocks_by_id[i] = None
+        self.compact()
+
+    def compact(self):
+        # drop blocks removed from the CFG (blocks_by_id) from the block list too, which passes removing blocks one at
+        # a time leave to the end rather than scanning it for each
+        self.blocks = [b for b in self.blocks if self.blocks_by_id[b.id] is b]
+        if self.curr_block is not None and self.blocks_by_id[self.curr_block.id] is not self.curr_block:
+            self.curr_block = self.blocks[-1] if self.blocks else None
+
+    def succs(self,block:IRBasicBlock) -> list[IRBasicBlock]:
+        return [self.blocks_by_id[i] for i in self.succ_ids[block.id]]
+
+    def preds(self,block:IRBasicBlock) -> list[IRBasicBlock]:
+        return [self.blocks_by_id[i] for i in self.pred_ids[block.id]]
+
+    def rpo(self,entry:str) -> list[int]:
+        # ids of the blocks reachable from entry in reverse postorder, cached until the CFG changes
+        order = self.rpo_cache.get(entry)
+        if order is None:
+            start = self.block_ids[entry]
+            seen = {start}  # not an array over every id, functions are small and programs have many of them
+            post = []
+            stack = [(start, iter(self.succ_ids[start]))]
+            while stack:
+                node, succs = stack[-1]
+                for s in succs:
+                    if s not in seen:
+                        seen.add(s)
+                        stack.append((s, iter(self.succ_ids[s])))
+                        break
+                else:
+                    stack.pop()
+                    post.append(node)
+            post.reverse()
+            order = self.rpo_cache[entry] = post
+        return order
+
+    def function_blocks(self,name:str) -> list[IRBasicBlock]:
+        # the blocks of the function entered at name that can be reached, in reverse postorder
+        return [self.blocks_by_id[i] for i in self.rpo(name)]
+
+    def remove_unreachable(self) -> int:
+        # remove the blocks no function can reach, returning how many there were
+        reachable = {i for f in self.functions for i in self.rpo(f)}
+        dead = {b.id for b in self.blocks if b.id not in reachable}
+        self.remove_blocks(dead)
+        return len(dead)
+
+    def split_edge(self,pred:IRBasicBlock,succ:str) -> IRBasicBlock:
+        # a new empty block on the edge from pred to the block named succ
+        block = IRBasicBlock(self.new_label("split"),[],None)
+        self.index_block(block)
+        self.blocks.append(block)
+        self.set_ctl_trans(block,IRJump(succ))
+        for stmt in takewhile(is_phi, self.block_map[succ].statements):
+            names = stmt.val.block_names
+            names[names.index(pred.name)] = block.name
+        self.set_ctl_trans(pred,retarget(pred.ctl_trans,succ,block.name))
+        return block
+
+    def new_tmp(self) -> IRVar:
+        # identifiers have no digits so these can't clash with program variables
+        tmp = IRVar(f"tmp{self.tmp_counter}")
+        self.tmp_counter += 1
+        return tmp
+
+    def new_label(self,prefix:str="l") -> str:
+        label = f"{prefix}{self.label_counter}"
+        self.label_counter += 1
+        return label
+
+    def object_size(self,class_i:int) -> int:
+        # vtable, field map, then the fields
+        offsets = self.field_maps[class_i].vals
+        return 2 + sum(1 for off in (offsets[1::2] if self.compact_tables else offsets) if off.n)
+
+    def table_sizes(self) -> dict[str, tuple[int, int]]:
+        # the words in all the vtables and in all the field maps, as dense tables with a slot for every name would
+        # have them and as they are
+        return {"vtables": (len(self.vtbls) * len(self.method_name_to_vtbl_index), sum(len(t.vals) for t in self.vtbls)),
+                "field maps": (len(self.field_maps) * len(self.field_name_to_map_index),
+                               sum(len(t.vals) for t in self.field_maps))}
+
+    def field_slot(self,name:str) -> int:
+        # index into every field map for field name (of its pair, if compact), None if no class has the field
+        if self.symbols is not None and type(name) is Symbol and self.symbols[name.id] is name:
+            i = self.field_index[name.id] if name.id < len(self.field_index) else -1
+            return None if i < 0 else i
+        return self.field_name_to_map_index.get(name)
+
+    def method_slot(self,name:str) -> int:
+        # index into every vtable for method name (of its pair, if compact), None if no class has the method
+        if self.symbols is not None and type(name) is Symbol and self.symbols[name.id] is name:
+            i = self.method_index[name.id] if name.id < len(self.method_index) else -1
+            return None if i < 0 else i
+        return self.method_name_to_vtbl_index.get(name)
 
     def add_block(self,block_name):
-        self.curr_block = IRBasicBlock(block_name,[],[])
+        self.curr_block = IRBasicBlock(block_name,[],None)
+        self.index_block(self.curr_block)
         self.blocks.append(self.curr_block)
         return self.curr_block
 
+    def begin_function(self,name:str,args:list[str],local_vars:list[str]):
+        # start lowering a function's body into a new entry block, with its locals zeroed
+        self.functions[name] = list(args)
+        self.fail_blocks = {}  # a failure block is only branched to from within its function
+        self.add_block(name)
+        for v in local_vars:
+            self.add_stmt(IRAssign(IRVar(v),IRConst(0)))
+
+    def end_function(self):
+        # falling off the end of a function returns 0
+        self.add_ctl_trans(IRRet(IRConst(0)))
+
     def get_block(self,block_name):
-        return self.curr_block
+        return self.block_map[block_name]
 
     def add_stmt(self,stmt:IRStatement):
         self.curr_block.add_statement(stmt)
 
+    def add_ctl_trans(self,trans:IRControlTransfer):
+        self.set_ctl_trans(self.curr_block,trans)
+
+    def emit_tmp(self,expr:IRExpression) -> IRVar:
+        tmp = self.new_tmp()
+        self.add_stmt(IRAssign(tmp,expr))
+        return tmp
+
+    def emit_operand(self,expr:IRExpression) -> NONGLOBALS:
+        # expr as a variable or constant, assigning it to a temp if it's anything else
+        return expr if isinstance(expr,(IRVar,IRConst)) else self.emit_tmp(expr)
+
+    def emit_condition(self,expr:"Expression",b_true:str,b_false:str):
+        # end the current block branching on the value of expr
+        cond = expr.to_ir(self)
+        self.add_ctl_trans(IRIf(cond if isinstance(cond,IRVar) else self.emit_tmp(cond),b_true,b_false))
+
+    def emit_jump(self,block_name:str):
+        self.add_ctl_trans(IRJump(block_name))
+
+    def fail_block(self,message:str) -> str:
+        # name of a block failing with message, shared by all the checks emitted since fail_blocks was last reset
+        if message not in self.fail_blocks:
+            curr = self.curr_block
+            fail = self.add_block(self.new_label(message))
+            self.set_ctl_trans(fail,IRFail(message))
+            self.fail_blocks[message] = fail.name
+            self.curr_block = curr
+        return self.fail_blocks[message]
+
+    def emit_branch_on(self,v:IRVar,fail_if:bool,message:str):
+        # end the current block on a branch to a failure block (if v is nonzero when fail_if else if it's zero) and
+        # continue in a new block
+        fail = self.fail_block(message)
+        ok = self.new_label()
+        self.add_ctl_trans(IRIf(v,fail,ok) if fail_if else IRIf(v,ok,fail))
+        self.add_block(ok)
+
+    def emit_tag_check(self,obj:NONGLOBALS):
+        # pointers have a clear low bit
+        self.emit_branch_on(self.emit_tmp(IROp(obj,"&",IRConst(1))),True,"NotAPointer")
+
+    def emit_nonzero_check(self,v:IRVar,message:str):
+        self.emit_branch_on(v,False,message)
+
+    def emit_lookup(self,table:IRVar,slot:int,name:str,message:str) -> IRVar:
+        # look up the entry for name, in slot, in a vtable or field map, failing with message if there isn't one
+        if not self.compact_tables:
+            entry = self.emit_tmp(IRGetELT(table,IRConst(slot)))
+            self.emit_nonzero_check(entry,message)
+            return entry
+        # the slot is shared with names no class has along with this one, so check whose entry it is
+        selector = self.emit_tmp(IRGetELT(table,IRConst(2 * slot)))
+        self.emit_branch_on(self.emit_tmp(IROp(selector,"!=",IRConst(self.symbols.id_of(name) + 1))),True,message)
+        return self.emit_tmp(IRGetELT(table,IRConst(2 * slot + 1)))
+
+    def emit_field_offset(self,obj:NONGLOBALS,field_name:str) -> IRVar:
+        # check obj is a pointer and look up the offset of field_name in its field map, failing if it has no such field
+        slot = self.field_slot(field_name)
+        if slot is None:
+            raise ValueError(f"No class has a field named {field_name}")
+        self.emit_tag_check(obj)
+        fields = self.emit_tmp(IRGetELT(obj,IRConst(1)))
+        return self.emit_lookup(fields,slot,field_name,"NoSuchField")
+
+    def __str__(self):
+        def data(arr):
+            return f"global array {arr.name}: {{ {', '.join(map(str, arr.vals))} }}"
+        def code(block):
+            if block.name not in self.functions:
+                return str(block)
+            params = ", ".join(self.functions[block.name])
+            return str(block).replace(":", f"({params}):", 1)
+        return "\n".join(["data:", *map(data, self.vtbls), *map(data, self.field_maps), "", "code:",
+                          *(f"\n{code(b)}" for b in self.blocks)])
+
+class IROpcode(Enum):
+    MOV = 0
+    OPERATION = 1
+    OP = 2
+    CALL = 3
+    PHI = 4
+    ALLOC = 5
+    GETELT = 6
+    LOAD = 7
+    STORE = 8
+    SETELT = 9
+    PRINT = 10
+    IF = 11
+    JUMP = 12
+    RET = 13
+    FAIL = 14
+
+# The opcode of each kind of IR node and its fields in the order they're packed, with how: v an operand, o an op
+# name or s a message (both indices into the string pool), l a block label (its index), and v*/l* a list of them
+# (its length then the items)
+# Expressions only ever appear as the value of an IRAssign, so their instructions have its variable first, and MOV
+# is an IRAssign of a plain operand
+PACKED_LAYOUTS = {
+    IROperation: (IROpcode.OPERATION, [("l", "v"), ("op", "o"), ("r", "v")]),
+    IROp: (IROpcode.OP, [("l", "v"), ("op", "o"), ("r", "v")]),
+    IRCall: (IROpcode.CALL, [("c", "v"), ("r", "v"), ("args", "v*")]),
+    IRPhi: (IROpcode.PHI, [("block_names", "l*"), ("vars", "v*")]),
+    IRAlloc: (IROpcode.ALLOC, [("n", "v")]),
+    IRGetELT: (IROpcode.GETELT, [("base", "v"), ("i", "v")]),
+    IRLoad: (IROpcode.LOAD, [("base", "v")]),
+    IRStore: (IROpcode.STORE, [("base", "v"), ("i", "v")]),
+    IRSetELT: (IROpcode.SETELT, [("base", "v"), ("i", "v"), ("i2", "v")]),
+    IRPrint: (IROpcode.PRINT, [("v", "v")]),
+    IRIf: (IROpcode.IF, [("v", "v"), ("b_true", "l"), ("b_false", "l")]),
+    IRJump: (IROpcode.JUMP, [("b", "l")]),
+    IRRet: (IROpcode.RET, [("v", "v")]),
+    IRFail: (IROpcode.FAIL, [("m", "s")]),
+}
+UNPACKED = {opcode: (cls, layout) for cls, (opcode, layout) in PACKED_LAYOUTS.items()}
+# The opcodes of instructions assigning a variable, which it's packed first in
+ASSIGNING = {IROpcode.MOV} | {opcode for cls, (opcode, _) in PACKED_LAYOUTS.items() if issubclass(cls, IRExpression)}
+
+def build_packed_shapes():
+    # opcode value -> (how many fields, the positions of the operands read among them) for the instructions without
+    # lists, whose shape is the same every time
+    shapes = {IROpcode.MOV._value_: (2, (1,))}
+    for opcode, (_, layout) in UNPACKED.items():
+        if all(kind[-1] != "*" for _, kind in layout):
+            first = int(opcode in ASSIGNING)
+            reads = tuple(first + j for j, (_, kind) in enumerate(layout) if kind == "v")
+            shapes[opcode._value_] = (first + len(layout), reads)
+    return shapes
+
+PACKED_SHAPES = build_packed_shapes()
+
+# The fields of each kind of IR node holding operands it reads, and whether each is a list of them
+OPERAND_FIELDS = {cls: [(name, kind == "v*") for name, kind in layout if kind[0] == "v"]
+                  for cls, (_, layout) in PACKED_LAYOUTS.items()}
+
+def operands(inst) -> list:
+    # the operands an IR statement or control transfer reads
+    if type(inst) is IRAssign:
+        inst = inst.val
+        if is_operand(inst):
+            return [inst]
+    vals = []
+    for name, many in OPERAND_FIELDS[type(inst)]:
+        if many:
+            vals.extend(getattr(inst, name))
+        else:
+            vals.append(getattr(inst, name))
+    return vals
+
+def map_operands(inst,f):
+    # replace each operand v an IR statement or control transfer reads with f(v), in place
+    if type(inst) is IRAssign:
+        if is_operand(inst.val):
+            inst.val = f(inst.val)
+            return
+        inst = inst.val
+    for name, many in OPERAND_FIELDS[type(inst)]:
+        val = getattr(inst, name)
+        setattr(inst, name, [f(v) for v in val] if many else f(val))
+
+# An operand is packed as an index shifted left past a 2 bit kind: into the register table, the constant pool, the
+# global arrays or the block labels
+REG, CONST, GLOBAL, LABEL = range(4)
+
+class PackedProgram:
+    # An IRProgram with each block's instructions (and then its control transfer) packed into a run of ints, all of
+    # them in one array, with registers, constants and strings interned in tables shared by the whole program
+    OPCODES = list(IROpcode)
+
+    def __init__(self,tables:IRProgram):
+        self.tables = tables  # the IRProgram with its blocks left out
+        self.regs = []
+        self.reg_index = {}
+        self.consts = []
+        self.const_index = {}
+        self.strings = []
+        self.string_index = {}
+        self.globals = [*tables.vtbls, *tables.field_maps]
+        self.global_index = {id(arr): i for i, arr in enumerate(self.globals)}
+        self.block_names = []
+        self.block_index = {}
+        self.code = array("i")
+        self.starts = array("I")  # where each block's run in code starts, then the end of the last one
+        self.ctl = array("I")  # where each block's control transfer starts
+
+    @classmethod
+    def from_ir(cls,prog:IRProgram) -> "PackedProgram":
+        packed = cls(replace(prog, blocks=[], curr_block=None))
+        for b in prog.blocks:
+            packed.label(b.name)
+        for b in prog.blocks:
+            packed.starts.append(len(packed.code))
+            for stmt in b.statements:
+                packed.pack(packed.code, stmt)
+            packed.ctl.append(len(packed.code))
+            packed.pack(packed.code, b.ctl_trans)
+        packed.starts.append(len(packed.code))
+        return packed
+
+    def to_ir(self) -> IRProgram:
+        blocks = []
+        for i, name in enumerate(self.block_names):
+            insts = [self.unpack(opcode, args) for opcode, args in self.instructions(i)]
+            blocks.append(IRBasicBlock(name, insts[:-1], insts[-1]))
+        return replace(self.tables, blocks=blocks, curr_block=blocks[-1] if blocks else None)
+
+    def intern(self,table:list,index:dict,key) -> int:
+        i = index.get(key)
+        if i is None:
+            i = index[key] = len(table)
+            table.append(key)
+        return i
+
+    def label(self,name:str) -> int:
+        return self.intern(self.block_names, self.block_index, name)
+
+    def operand(self,v) -> int:
+        if type(v) is IRVar:
+            return self.intern(self.regs, self.reg_index, v.reg) << 2 | REG
+        if type(v) is IRConst:
+            return self.intern(self.consts, self.const_index, v.n) << 2 | CONST
+        if type(v) is IRLabel:
+            return self.label(v.name) << 2 | LABEL
+        return self.global_index[id(v)] << 2 | GLOBAL
+
+    def value(self,x:int):
+        # the IR operand packed as x
+        kind, i = x & 3, x >> 2
+        if kind == LABEL:
+            return IRLabel(self.block_names[i])
+        return IRVar(self.regs[i]) if kind == REG else IRConst(self.consts[i]) if kind == CONST else self.globals[i]
+
+    def pack(self,code:array,inst):
+        if type(inst) is IRAssign:
+            if is_operand(inst.val):
+                code.extend((IROpcode.MOV._value_, self.operand(inst.v), self.operand(inst.val)))
+                return
+            code.append(PACKED_LAYOUTS[type(inst.val)][0]._value_)
+            code.append(self.operand(inst.v))
+            inst = inst.val
+        else:
+            code.append(PACKED_LAYOUTS[type(inst)][0]._value_)
+        for name, kind in PACKED_LAYOUTS[type(inst)][1]:
+            val = getattr(inst, name)
+            if kind[-1] == "*":
+                code.append(len(val))
+                pack = self.operand if kind == "v*" else self.label
+                code.extend(map(pack, val))
+            elif kind == "v":
+                code.append(self.operand(val))
+            elif kind == "l":
+                code.append(self.label(val))
+            else:
+                code.append(self.intern(self.strings, self.string_index, val))
+
+    def instructions(self,block:int):
+        # (opcode, packed fields) for each instruction of the block with index block, its control transfer last;
+        # for expressions the fields start with the variable assigned
+        for opcode, start, end in self.spans(block):
+            yield opcode, self.code[start:end]
+
+    def unpack(self,opcode:IROpcode,args:array):
+        if opcode is IROpcode.MOV:
+            return IRAssign(self.value(args[0]), self.value(args[1]))
+        cls, layout = UNPACKED[opcode]
+        assign = issubclass(cls, IRExpression)
+        i = int(assign)
+        vals = []
+        for _, kind in layout:
+            if kind[-1] == "*":
+                n = args[i]
+                unpack = self.value if kind == "v*" else self.block_names.__getitem__
+                vals.append([unpack(x) for x in args[i+1:i+1+n]])
+                i += n + 1
+            else:
+                x = args[i]
+                vals.append(self.value(x) if kind == "v" else self.block_names[x] if kind == "l" else self.strings[x])
+                i += 1
+        inst = cls(*vals)
+        return IRAssign(self.value(args[0]), inst) if assign else inst
+
+    def spans(self,block:int):
+        # (opcode, start, end) for each instruction of the block with index block, with its fields in code[start:end]
+        i, end = self.starts[block], self.starts[block + 1]
+        while i < end:
+            start = i + 1
+            i = self.end(self.code[i], start)
+            yield self.OPCODES[self.code[start - 1]], start, i
+
+    def end(self,op:int,start:int) -> int:
+        # where the instruction with opcode value op and its fields from start ends
+        shape = PACKED_SHAPES.get(op)
+        if shape is not None:
+            return start + shape[0]
+        i = start + 1  # calls and phis both assign
+        for _, kind in UNPACKED[self.OPCODES[op]][1]:
+            i += self.code[i] + 1 if kind[-1] == "*" else 1
+        return i
+
+    def reads(self,op:int,start:int) -> list[int]:
+        # the positions in code of the operands the instruction with opcode value op and its fields from start reads
+        shape = PACKED_SHAPES.get(op)
+        if shape is not None:
+            return [start + j for j in shape[1]]
+        code = self.code
+        i = start + 1
+        positions = []
+        for _, kind in UNPACKED[self.OPCODES[op]][1]:
+            if kind == "v":
+                positions.append(i)
+            elif kind == "v*":
+                positions.extend(range(i + 1, i + 1 + code[i]))
+            i += code[i] + 1 if kind[-1] == "*" else 1
+        return positions
+
+    def successors(self,block:int) -> list[int]:
+        # the blocks the control transfer ending the block with index block can go to
+        i = self.ctl[block]
+        if self.code[i] == IROpcode.IF._value_:
+            return [self.code[i + 2], self.code[i + 3]]
+        return [self.code[i + 1]] if self.code[i] == IROpcode.JUMP._value_ else []
+
+    def function_blocks(self,name:str) -> list[int]:
+        # the blocks of the function entered at name that can be reached
+        seen = {self.block_index[name]}
+        work = list(seen)
+        while work:
+            for succ in self.successors(work.pop()):
+                if succ not in seen:
+                    seen.add(succ)
+                    work.append(succ)
+        return sorted(seen)
+
+    def dce(self) -> dict[str, dict[str, int]]:
+        # Dead code elimination on the packed form: starting from what prints, stores, calls and branches read,
+        # variables (by their register table entries) are marked live back through the assignments to them, and
+        # the assignments to the rest go unless computing the value could fail (a division by what may be 0) or do
+        # more (a call); the code is walked as ints and rebuilt once at the end without what every function lost
+        # Returns the number of instructions removed from each function
+        code, consts = self.code, self.consts
+        pure = {opcode._value_ for opcode in ASSIGNING if opcode is not IROpcode.CALL}
+        operation, divide = IROpcode.OPERATION._value_, self.string_index.get("/")
+        report = {}
+        dead = []  # (start, end) of the instructions removed, opcodes included
+        for f in self.tables.functions:
+            defs = {}  # register -> (start, end, registers read) of each side effect free assignment to it
+            live = set()
+            work = []
+            for b in self.function_blocks(f):
+                i, end = self.starts[b], self.starts[b + 1]
+                while i < end:
+                    op, start = code[i], i + 1
+                    shape = PACKED_SHAPES.get(op)
+                    if shape is None:
+                        after = self.end(op, start)
+                        regs = [x for p in self.reads(op, start) if (x := code[p]) & 3 == REG]
+                    else:
+                        after = start + shape[0]
+                        regs = [x for j in shape[1] if (x := code[start + j]) & 3 == REG]
+                    if op in pure and not (op == operation and code[start + 2] == divide and not (
+                            code[start + 3] & 3 == CONST and consts[code[start + 3] >> 2] != 0)):
+                        defs.setdefault(code[start], []).append((i, after, regs))
+                    else:
+                        for x in regs:
+                            if x not in live:
+                                live.add(x)
+                                work.append(x)
+                    i = after
+            while work:
+                for _, _, regs in defs.get(work.pop(), ()):
+                    for x in regs:
+                        if x not in live:
+                            live.add(x)
+                            work.append(x)
+            removed = [(i, e) for x, insts in defs.items() if x not in live for i, e, _ in insts]
+            dead.extend(removed)
+            report[f] = {"instructions": len(removed)}
+        if dead:
+            self.remove(sorted(dead))
+        return report
+
+    def remove(self,spans:list[tuple[int,int]]):
+        # remove the instructions at the given (start, end) positions in code, in order, moving everything after
+        # them back
+        code = array("i")
+        shifted = []  # (position, how far back what's from it on has moved)
+        prev = 0
+        for start, end in spans:
+            code.extend(self.code[prev:start])
+            prev = end
+            shifted.append((end, end - start + (shifted[-1][1] if shifted else 0)))
+        code.extend(self.code[prev:])
+        self.code = code
+        for positions in [self.starts, self.ctl]:
+            j = 0
+            for k, p in enumerate(positions):
+                while j < len(shifted) and shifted[j][0] <= p:
+                    j += 1
+                positions[k] = p - (shifted[j - 1][1] if j else 0)
+
+def truncating_div(l:int,r:int) -> int:
+    q = abs(l) // abs(r)
+    return q if (l < 0) == (r < 0) else -q
+
+# How IROperations and IROps compute their values
+IR_OPS = {
+    "+": operator.add, "-": operator.sub, "*": operator.mul, "/": truncating_div,
+    "<": lambda l, r: int(l < r), ">": lambda l, r: int(l > r),
+    "==": lambda l, r: int(l == r), "!=": lambda l, r: int(l != r),
+    "&": operator.and_, "<<": operator.lshift,
+}
+
+class IRInterpreter:
+    # Runs an IRProgram, collecting what it prints and counting the statements and control transfers executed
+    # Objects live in one flat heap of words, pointed to by even addresses (the word index doubled, so the tag bit is
+    # clear) with 0 never allocated; global arrays and code labels are values in their own right
+    def __init__(self,prog:IRProgram):
+        self.prog = prog
+        self.blocks = prog.block_map
+        self.heap = [0, 0]
+        self.output = []
+        self.steps = 0
+
+    def value(self,env:dict,v):
+        if type(v) is IRVar:
+            return env[v.reg]
+        if type(v) is IRConst:
+            return v.n
+        if type(v) is IRLabel:
+            return v.name  # as in a vtable
+        return v  # an IRArray
+
+    def element(self,base,i:int):
+        if type(base) is IRArray:
+            val = base.vals[i]
+            return val.n if type(val) is IRConst else val
+        return self.heap[self.address(base) + i]
+
+    def address(self,ptr) -> int:
+        if type(ptr) is not int or ptr <= 0 or ptr & 1 or ptr // 2 >= len(self.heap):
+            raise RuntimeError(f"{ptr} is not a pointer")
+        return ptr // 2
+
+    def eval(self,env:dict,expr):
+        match expr:
+            case IROperation(l, op, r) | IROp(l, op, r):
+                return IR_OPS[op](self.value(env, l), self.value(env, r))
+            case IRGetELT(base, i):
+                return self.element(self.value(env, base), self.value(env, i))
+            case IRLoad(base):
+                return self.element(self.value(env, base), 0)
+            case IRAlloc(n):
+                ptr = 2 * len(self.heap)
+                self.heap.extend([0] * self.value(env, n))
+                return ptr
+        return self.value(env, expr)
+
+    def run(self,entry:str="main") -> list[int]:
+        # Calls push the caller's frame (where to resume, its variables and the variable the result goes in) on an
+        # explicit stack, so deep recursion in the program doesn't recurse here
+        stack = []
+        env = {}
+        block, i = self.blocks[entry], 0
+        pred = None  # the block control came from
+        while True:
+            stmts = block.statements
+            if i == 0 and stmts and type(stmts[0]) is IRAssign and type(stmts[0].val) is IRPhi:
+                # the phis at the start of a block all take their values from the edge in at once
+                phis = list(takewhile(lambda s: type(s) is IRAssign and type(s.val) is IRPhi, stmts))
+                vals = [self.value(env, s.val.vars[s.val.block_names.index(pred)]) for s in phis]
+                for s, val in zip(phis, vals):
+                    env[s.v.reg] = val
+                self.steps += len(phis)
+                i = len(phis)
+            while i < len(stmts):
+                stmt = stmts[i]
+                i += 1
+                self.steps += 1
+                match stmt:
+                    case IRAssign(v, IRCall(c, r, args)):
+                        code = self.value(env, c)
+                        params = self.prog.functions[code]
+                        vals = [self.value(env, a) for a in [r, *args]]
+                        if len(vals) != len(params):
+                            raise RuntimeError(f"{code} called with {len(vals) - 1} arguments")
+                        stack.append((block, i, env, v.reg))
+                        env = dict(zip(params, vals))
+                        block, i = self.blocks[code], 0
+                        break
+                    case IRAssign(v, val):
+                        env[v.reg] = self.eval(env, val)
+                    case IRStore(base, val):
+                        self.heap[self.address(self.value(env, base))] = self.value(env, val)
+                    case IRSetELT(base, off, val):
+                        self.heap[self.address(self.value(env, base)) + self.value(env, off)] = self.value(env, val)
+                    case IRPrint(v):
+                        self.output.append(self.value(env, v))
+            else:
+                self.steps += 1
+                match block.ctl_trans:
+                    case IRJump(b):
+                        pred, block, i = block.name, self.blocks[b], 0
+                    case IRIf(v, b_true, b_false):
+                        pred, block, i = block.name, self.blocks[b_true if self.value(env, v) else b_false], 0
+                    case IRRet(v):
+                        ret = self.value(env, v)
+                        if not stack:
+                            return self.output
+                        block, i, env, dest = stack.pop()
+                        env[dest] = ret
+                    case IRFail(m):
+                        raise RuntimeError(f"fail {m}")
+
+class Dominators:
+    # The dominator tree of the blocks reachable from entry, by the Cooper-Harvey-Kennedy iterative algorithm
+    # Blocks are numbered by their position in reverse postorder (order, holding their ids), so the entry is 0 and
+    # every block's immediate dominator comes before it
+    def __init__(self,prog:IRProgram,entry:str):
+        self.prog = prog
+        self.order = order = prog.rpo(entry)
+        self.pos = pos = {b: i for i, b in enumerate(order)}  # block id -> position, for the reachable blocks
+        self.preds = preds = [[pos[p] for p in prog.pred_ids[b] if p in pos] for b in order]
+
+        idom = [-1] * len(order)
+        idom[0] = 0
+        changed = True
+        while changed:
+            changed = False
+            for b in range(1, len(order)):
+                new = -1
+                for p in preds[b]:
+                    if idom[p] < 0:
+                        continue
+                    if new < 0:
+                        new = p
+                        continue
+                    while p != new:  # walk the two fingers up to where their paths to the entry meet
+                        while p > new:
+                            p = idom[p]
+                        while new > p:
+                            new = idom[new]
+                if idom[b] != new:
+                    idom[b] = new
+                    changed = True
+        self.idom = idom
+        self.children = [[] for _ in order]
+        for b in range(1, len(order)):
+            self.children[idom[b]].append(b)
+
+    def block(self,b:int) -> IRBasicBlock:
+        return self.prog.blocks_by_id[self.order[b]]
+
+    def frontiers(self) -> list[list[int]]:
+        df = [[] for _ in self.order]
+        for b, preds in enumerate(self.preds):
+            if len(preds) < 2:
+                continue
+            for runner in preds:
+                while runner != self.idom[b]:
+                    if not df[runner] or df[runner][-1] != b:
+                        df[runner].append(b)
+                    runner = self.idom[runner]
+        return df
+
+    def dominates(self,a:int,b:int) -> bool:
+        while b > a:
+            b = self.idom[b]
+        return a == b
+
+    def preorder(self) -> list[int]:
+        order = []
+        stack = [0]
+        while stack:
+            b = stack.pop()
+            order.append(b)
+            stack.extend(reversed(self.children[b]))
+        return order
+
+
+def is_phi(stmt) -> bool:
+    return type(stmt) is IRAssign and type(stmt.val) is IRPhi
+
+def phis(block:IRBasicBlock) -> list[IRAssign]:
+    # the phis a block starts with
+    return list(takewhile(is_phi, block.statements))
+
+def live_in(dom:Dominators) -> list[set[str]]:
+    # the variables live on entry to each block, by position in dom, iterating backwards to a fixed point
+    # A phi reads its operands at the end of the corresponding predecessor, not in its own block
+    blocks = [dom.block(b) for b in range(len(dom.order))]
+    uses, defs, phi_uses = [], [], [dict() for _ in blocks]
+    for b, block in enumerate(blocks):
+        use, kill = set(), set()
+        for stmt in block.statements:
+            if is_phi(stmt):
+                for name, v in zip(stmt.val.block_names, stmt.val.vars):
+                    if type(v) is IRVar:
+                        phi_uses[b].setdefault(name, set()).add(v.reg)
+            else:
+                use.update(v.reg for v in operands(stmt) if type(v) is IRVar and v.reg not in kill)
+            if type(stmt) is IRAssign:
+                kill.add(stmt.v.reg)
+        use.update(v.reg for v in operands(block.ctl_trans) if type(v) is IRVar and v.reg not in kill)
+        uses.append(use)
+        defs.append(kill)
+
+    succs = [[dom.pos[s] for s in dom.prog.succ_ids[dom.order[b]]] for b in range(len(blocks))]
+    live = [set(u) for u in uses]
+    changed = True
+    while changed:
+        changed = False
+        for b in reversed(range(len(blocks))):
+            out = set()
+            for s in succs[b]:
+                out |= live[s]
+                out |= phi_uses[s].get(blocks[b].name, set())
+            new = uses[b] | (out - defs[b])
+            if len(new) != len(live[b]):
+                live[b] = new
+                changed = True
+    return live
+
+def to_ssa(prog:IRProgram,variables:set[str]=None):
+    # Put every function in prog into SSA form, or just the given variables, with pruned phis at the dominance
+    # frontiers where the variable is live, and each variable assigned more than once renamed to x.1, x.2, ...
+    # (a variable with just one assignment and no phis keeps its name)
+    # The parameters (this included) are assigned on entry, so one the function assigns too is renamed, with the
+    # uses of the value it came in with keeping its name
+    # Unreachable blocks are removed first, their edges would only give phis operands that can never be used
+    prog.remove_unreachable()
+    for f, params in prog.functions.items():
+        dom = Dominators(prog, f)
+        blocks = [dom.block(b) for b in range(len(dom.order))]
+        def_blocks = {}
+        for b, block in enumerate(blocks):
+            for stmt in block.statements:
+                if type(stmt) is IRAssign and (variables is None or stmt.v.reg in variables):
+                    def_blocks.setdefault(stmt.v.reg, []).append(b)
+        for param in params:
+            if param in def_blocks:
+                def_blocks[param].insert(0, 0)
+        if not def_blocks:
+            continue
+
+        live = live_in(dom)
+        df = dom.frontiers()
+        block_phis = [[] for _ in blocks]  # (variable, phi) for the phis added to each block
+        for var, defs in def_blocks.items():
+            placed = set()
+            work = list(set(defs))
+            while work:
+                for y in df[work.pop()]:
+                    if y not in placed and var in live[y]:
+                        placed.add(y)
+                        preds = [dom.order[p] for p in dom.preds[y]]
+                        phi = IRPhi([prog.blocks_by_id[p].name for p in preds], [IRVar(var) for _ in preds])
+                        block_phis[y].append((var, phi))
+                        work.append(y)
+        for block, added in zip(blocks, block_phis):
+            block.statements[:0] = [IRAssign(IRVar(var), phi) for var, phi in added]
+
+        renamed = {var for var, defs in def_blocks.items() if len(defs) > 1} | \
+                  {var for added in block_phis for var, _ in added}
+        rename_ssa(prog, dom, blocks, block_phis, renamed)
+
+def rename_ssa(prog:IRProgram,dom:Dominators,blocks:list[IRBasicBlock],block_phis:list,renamed:set[str]):
+    # Give each assignment to the renamed variables a fresh name, walking the dominator tree so every use sees the
+    # name assigned by the closest dominating assignment (the original name where there isn't one)
+    current = {var: [] for var in renamed}
+    counts = dict.fromkeys(renamed, 0)
+
+    def use(v):
+        if type(v) is IRVar and v.reg in current and current[v.reg]:
+            return current[v.reg][-1]
+        return v
+
+    def define(var:str) -> IRVar:
+        counts[var] += 1
+        name = IRVar(f"{var}.{counts[var]}")
+        current[var].append(name)
+        return name
+
+    stack = [(0, None)]
+    while stack:
+        b, pushed = stack.pop()
+        if pushed is not None:
+            for var in pushed:
+                current[var].pop()
+            continue
+        pushed = []
+        block = blocks[b]
+        for stmt in block.statements:
+            if not is_phi(stmt):
+                map_operands(stmt, use)
+            if type(stmt) is IRAssign and stmt.v.reg in current:
+                pushed.append(stmt.v.reg)
+                stmt.v = define(stmt.v.reg)
+        map_operands(block.ctl_trans, use)
+        for s in prog.succ_ids[block.id]:
+            for var, phi in block_phis[dom.pos[s]]:
+                phi.vars[phi.block_names.index(block.name)] = use(IRVar(var))
+        stack.append((b, pushed))
+        stack.extend((c, None) for c in dom.children[b])
+
+def from_ssa(prog:IRProgram):
+    # Replace the phis in prog with copies on the edges into their blocks, splitting edges from blocks that branch
+    # elsewhere too
+    # The copies go through a temp per phi, so phis reading each other's results all see the values from before
+    for block in list(prog.blocks):
+        block_phis = phis(block)
+        if not block_phis:
+            continue
+        temps = [prog.new_tmp() for _ in block_phis]
+        for pred in prog.preds(block):
+            copies = [IRAssign(t, phi.val.vars[phi.val.block_names.index(pred.name)]) for phi, t in zip(block_phis, temps)]
+            if len(prog.succ_ids[pred.id]) > 1:
+                pred = prog.split_edge(pred, block.name)
+            pred.statements.extend(copies)
+        block.statements[:len(block_phis)] = [IRAssign(phi.v, t) for phi, t in zip(block_phis, temps)]
+
+
+def operand_key(v):
+    # what identifies an operand's value in the value numbering tables
+    if type(v) is IRVar:
+        return v.reg
+    if type(v) is IRConst:
+        return ("c", v.n)
+    if type(v) is IRLabel:
+        return ("l", v.name)
+    return ("g", v.name)
+
+COMMUTATIVE = frozenset(["+", "*", "==", "!=", "&"])
+
+def fold(op:str,l:int,r:int):
+    # the constant op of constants l and r, None where that would fail at run time
+    if op == "/" and r == 0:
+        return None
+    return IR_OPS[op](l, r)
+
+def gvn(prog:IRProgram) -> dict[str, dict[str, int]]:
+    # Dominator-based global value numbering over SSA form: walking each function's dominator tree, an instruction
+    # computing a value already available from a dominating one is removed and its uses given the earlier result
+    # Besides arithmetic that's the reads that can't change after an object is allocated: its vtable (load) and field
+    # map (getelt of 1), and entries of either table, so redundant method and field lookups go along with the
+    # pointer tag checks
+    # A branch on a value whose truth is known, because the block is only reached along one edge of an earlier
+    # branch on it (or it's a constant, or a tag check on a fresh allocation), becomes a jump, and the blocks that no
+    # longer can be reached (mostly failure blocks) are removed
+    # Returns the number of instructions and blocks removed from each function
+    sizes = {f: len(prog.rpo(f)) for f in prog.functions}
+    report = {f: {"instructions": gvn_function(prog, Dominators(prog, f))} for f in prog.functions}
+    prog.remove_unreachable()
+    for f in prog.functions:
+        report[f]["blocks"] = sizes[f] - len(prog.rpo(f))
+    return report
+
+def gvn_function(prog:IRProgram,dom:Dominators) -> int:
+    vals = {}  # variable -> the operand it's been found to equal
+    table = {}  # expression key -> the variable holding its value
+    facts = {}  # operand key -> whether it's known to be nonzero
+    fresh = set()  # variables holding newly allocated objects
+    tables = set()  # variables holding a vtable or field map
+    removed = 0
+
+    def val(v):
+        return vals.get(v.reg, v) if type(v) is IRVar else v
+
+    def key(expr):
+        # expr's key, with its operands already replaced by their values, None if it can't be numbered
+        match expr:
+            case IROperation(l, op, r) | IROp(l, op, r):
+                kl, kr = operand_key(l), operand_key(r)
+                if op in COMMUTATIVE and repr(kl) > repr(kr):
+                    kl, kr = kr, kl
+                return (type(expr).__name__, op, kl, kr)
+            case IRLoad(base):
+                return ("load", operand_key(base))
+            case IRGetELT(base, i) if i == IRConst(1) or (type(base) is IRVar and base.reg in tables):
+                return ("getelt", operand_key(base), operand_key(i))
+        return None
+
+    def simplify(expr):
+        # the operand expr is known to equal without looking anything up, if any
+        match expr:
+            case IROperation(IRConst(l), op, IRConst(r)) | IROp(IRConst(l), op, IRConst(r)):
+                n = fold(op, l, r)
+                return None if n is None else IRConst(n)
+            case IROp(IRVar(reg), "&", IRConst(1)) if reg in fresh:
+                return IRConst(0)  # the tag check of a new object
+        return None
+
+    stack = [(0, None)]
+    while stack:
+        b, log = stack.pop()
+        if log is not None:
+            # leaving b's subtree, so what was only available in it goes
+            for d, k, old in reversed(log):
+                if old is None:
+                    del d[k]
+                else:
+                    d[k] = old
+            continue
+        log = []
+        block = dom.block(b)
+        if len(dom.preds[b]) == 1:
+            pred = dom.block(dom.preds[b][0])
+            if type(pred.ctl_trans) is IRIf:
+                k = operand_key(val(pred.ctl_trans.v))
+                log.append((facts, k, facts.get(k)))
+                facts[k] = block.name == pred.ctl_trans.b_true
+
+        kept = []
+        for stmt in block.statements:
+            if type(stmt) is not IRAssign:
+                map_operands(stmt, val)
+                kept.append(stmt)
+                continue
+            dest, expr = stmt.v.reg, stmt.val
+            if type(expr) is IRPhi:
+                ops = [val(v) for v in expr.vars]
+                if ops and all(operand_key(v) == operand_key(ops[0]) for v in ops) and operand_key(ops[0]) != dest:
+                    vals[dest] = ops[0]  # every way in has the same value
+                    removed += 1
+                    continue
+                k = ("phi", block.name, tuple(map(operand_key, ops)))
+            elif is_operand(expr):
+                vals[dest] = val(expr)  # copies are propagated
+                removed += 1
+                continue
+            else:
+                map_operands(stmt, val)
+                known = simplify(expr)
+                if known is not None:
+                    vals[dest] = known
+                    removed += 1
+                    continue
+                k = key(expr)
+                if type(expr) is IRAlloc:
+                    fresh.add(dest)
+                elif type(expr) is IRLoad or (type(expr) is IRGetELT and expr.i == IRConst(1)):
+                    tables.add(dest)
+            if k is not None:
+                if k in table:
+                    vals[dest] = table[k]
+                    removed += 1
+                    continue
+                log.append((table, k, None))
+                table[k] = stmt.v
+            kept.append(stmt)
+        block.statements = kept
+
+        map_operands(block.ctl_trans, val)
+        if type(block.ctl_trans) is IRIf:
+            cond = block.ctl_trans.v
+            known = bool(cond.n) if type(cond) is IRConst else True if type(cond) is IRLabel else \
+                facts.get(operand_key(cond))
+            if known is not None:
+                prog.set_ctl_trans(block, IRJump(block.ctl_trans.b_true if known else block.ctl_trans.b_false))
+                removed += 1
+        stack.append((b, log))
+        stack.extend((c, None) for c in dom.children[b])
+
+    # phi operands along back edges come from blocks the phi doesn't dominate, so are only known now
+    for b in range(len(dom.order)):
+        for stmt in takewhile(is_phi, dom.block(b).statements):
+            map_operands(stmt, val)
+    return removed
+
+
+OVERDEFINED = object()  # the lattice value of a variable that isn't one constant, no value at all being unknown yet
+
+def sccp(prog:IRProgram) -> dict[str, dict[str, int]]:
+    # Sparse conditional constant propagation over SSA form (Wegman and Zadeck): values are assumed constant until
+    # shown otherwise and only the CFG edges shown to be executable are followed, so constants get through loops
+    # and branches that can never be taken don't spoil them
+    # Constant assignments are then removed and their uses given the constant, branches on constants become jumps
+    # and the blocks that were never executable are removed
+    # Returns the number of constant assignments, branches and blocks removed from each function
+    sizes = {f: len(prog.rpo(f)) for f in prog.functions}
+    report = {f: sccp_function(prog, Dominators(prog, f)) for f in prog.functions}
+    prog.remove_unreachable()
+    for f in prog.functions:
+        report[f]["blocks"] = sizes[f] - len(prog.rpo(f))
+    return report
+
+def sccp_function(prog:IRProgram,dom:Dominators) -> dict[str, int]:
+    blocks = [dom.block(b) for b in range(len(dom.order))]
+    defined = set()
+    uses = {}  # variable -> (position of block, instruction) of everything reading it
+    for b, block in enumerate(blocks):
+        for inst in [*block.statements, block.ctl_trans]:
+            for v in operands(inst):
+                if type(v) is IRVar:
+                    uses.setdefault(v.reg, []).append((b, inst))
+            if type(inst) is IRAssign:
+                defined.add(inst.v.reg)
+
+    vals = {}
+    def value(v):
+        if type(v) is IRConst:
+            return v.n
+        if type(v) is IRVar and v.reg in defined:
+            return vals.get(v.reg)
+        return OVERDEFINED  # parameters and globals
+
+    def evaluate(b:int,expr):
+        match expr:
+            case IRPhi(names, vars):
+                val = None
+                for name, v in zip(names, vars):
+                    if (dom.pos[prog.block_ids[name]], b) in edges:
+                        v = value(v)
+                        if val is None or v is OVERDEFINED:
+                            val = v
+                        elif v is not None and v != val:
+                            val = OVERDEFINED
+                return val
+            case IRVar() | IRConst():
+                return value(expr)
+            case IROperation(l, op, r) | IROp(l, op, r):
+                l, r = value(l), value(r)
+                if l is OVERDEFINED or r is OVERDEFINED:
+                    return OVERDEFINED
+                if l is None or r is None:
+                    return None
+                n = fold(op, l, r)
+                return OVERDEFINED if n is None else n
+        return OVERDEFINED
+
+    edges = set()
+    visited = set()
+    flow = [(-1, 0)]
+    work = []
+
+    def visit(b:int,inst):
+        if type(inst) is IRAssign:
+            # the value only ever goes down the lattice, from unknown to a constant to overdefined, so this ends
+            # even on a variable assigned more than once
+            new = evaluate(b, inst.val)
+            old = vals.get(inst.v.reg)
+            if new is None or old is OVERDEFINED or new == old:
+                return
+            vals[inst.v.reg] = new if old is None else OVERDEFINED
+            work.append(inst.v.reg)
+        elif type(inst) is IRIf:
+            cond = value(inst.v)
+            targets = [] if cond is None else successors(inst) if cond is OVERDEFINED else \
+                      [inst.b_true if cond else inst.b_false]
+            flow.extend((b, dom.pos[prog.block_ids[t]]) for t in targets)
+        elif type(inst) is IRJump:
+            flow.append((b, dom.pos[prog.block_ids[inst.b]]))
+
+    while flow or work:
+        while flow:
+            edge = flow.pop()
+            if edge in edges:
+                continue
+            edges.add(edge)
+            b = edge[1]
+            if b in visited:
+                for stmt in takewhile(is_phi, blocks[b].statements):
+                    visit(b, stmt)
+                continue
+            visited.add(b)
+            for stmt in blocks[b].statements:
+                visit(b, stmt)
+            visit(b, blocks[b].ctl_trans)
+        while work:
+            for b, inst in uses.get(work.pop(), ()):
+                if b in visited:
+                    visit(b, inst)
+
+    def constant(v):
+        val = value(v)
+        return v if val is None or val is OVERDEFINED else IRConst(val)
+
+    report = {"constants": 0, "branches": 0}
+    for b in visited:
+        block = blocks[b]
+        kept = []
+        for stmt in block.statements:
+            if type(stmt) is IRAssign and type(stmt.val) is not IRCall and type(vals.get(stmt.v.reg)) is int:
+                report["constants"] += 1
+                continue
+            map_operands(stmt, constant)
+            kept.append(stmt)
+        block.statements = kept
+        map_operands(block.ctl_trans, constant)
+        if type(block.ctl_trans) is IRIf and type(block.ctl_trans.v) is IRConst:
+            trans = block.ctl_trans
+            prog.set_ctl_trans(block, IRJump(trans.b_true if trans.v.n else trans.b_false))
+            report["branches"] += 1
+    return report
+
+
+def side_effect_free(expr) -> bool:
+    # whether computing expr does nothing but give its value, so it can go if the value isn't used
+    # Reads through pointers are guarded by the checks before them, but a division can still fail
+    if type(expr) is IRCall:
+        return False
+    if type(expr) is IROperation and expr.op == "/":
+        return type(expr.r) is IRConst and expr.r.n != 0
+    return True
+
+def dce(prog:IRProgram) -> dict[str, dict[str, int]]:
+    # Remove the assignments of side effect free values to variables nothing needs: starting from what prints,
+    # stores, calls and branches read, variables are marked live back through the assignments to them, and the
+    # assignments to the rest are removed
+    # Works on names, so in or out of SSA form; returns the number of instructions removed from each function
+    report = {}
+    for f in prog.functions:
+        blocks = prog.function_blocks(f)
+        defs = {}
+        live = set()
+        work = []
+
+        def mark(inst):
+            for v in operands(inst):
+                if type(v) is IRVar and v.reg not in live:
+                    live.add(v.reg)
+                    work.append(v.reg)
+
+        for block in blocks:
+            for stmt in block.statements:
+                if type(stmt) is IRAssign and side_effect_free(stmt.val):
+                    defs.setdefault(stmt.v.reg, []).append(stmt)
+                else:
+                    mark(stmt)
+            mark(block.ctl_trans)
+        while work:
+            for stmt in defs.get(work.pop(), ()):
+                mark(stmt)
+
+        removed = 0
+        for block in blocks:
+            kept = [s for s in block.statements if type(s) is not IRAssign or s.v.reg in live or not side_effect_free(s.val)]
+            removed += len(block.statements) - len(kept)
+            block.statements = kept
+        report[f] = {"instructions": removed}
+    return report
+
+def simplify_cfg(prog:IRProgram) -> dict[str, dict[str, int]]:
+    # Tidy up each function's CFG to a fixed point: branches to the same place either way become jumps, branches to
+    # empty blocks that only jump on are threaded through to where they end up, a block only reached by a jump is
+    # merged into the block jumping to it, and blocks left unreachable are removed
+    # Function entries are left where they are, they're reached by calls; and edges into blocks with phis aren't
+    # threaded, that would need new phi operands
+    # Returns the number of jumps threaded, blocks merged and unreachable blocks removed from each function
+    report = {}
+    for f in prog.functions:
+        counts = report[f] = {"threaded": 0, "merged": 0, "unreachable": 0}
+        size = len(prog.rpo(f))
+        changed = True
+        while changed:
+            changed = False
+            for block in prog.function_blocks(f):
+                if prog.blocks_by_id[block.id] is not block:
+                    continue  # merged into an earlier block
+                trans = block.ctl_trans
+                if type(trans) is IRIf and trans.b_true == trans.b_false:
+                    prog.set_ctl_trans(block, IRJump(trans.b_true))
+                    changed = True
+
+                for succ in successors(block.ctl_trans):
+                    target = thread_target(prog, succ)
+                    if target != succ:
+                        prog.set_ctl_trans(block, retarget(block.ctl_trans, succ, target))
+                        counts["threaded"] += 1
+                        changed = True
+
+                while type(block.ctl_trans) is IRJump:
+                    succ = prog.block_map[block.ctl_trans.b]
+                    if succ is block or succ.name in prog.functions or len(prog.pred_ids[succ.id]) != 1:
+                        break
+                    merge_blocks(prog, block, succ)
+                    counts["merged"] += 1
+                    changed = True
+        counts["unreachable"] = size - len(prog.rpo(f)) - counts["merged"]
+    prog.compact()
+    prog.remove_unreachable()
+    return report
+
+def thread_target(prog:IRProgram,name:str) -> str:
+    # where a branch to the block named name ends up going through empty blocks that only jump
+    seen = {name}
+    while True:
+        block = prog.block_map[name]
+        if block.statements or type(block.ctl_trans) is not IRJump or name in prog.functions:
+            return name
+        target = block.ctl_trans.b
+        if target in seen or phis(prog.block_map[target]):
+            return name
+        seen.add(target)
+        name = target
+
+def merge_blocks(prog:IRProgram,block:IRBasicBlock,succ:IRBasicBlock):
+    # append succ, only reached by the jump ending block, to block and remove it
+    # With one way in, succ's phis are just copies
+    block.statements.extend(IRAssign(s.v, s.val.vars[0]) if is_phi(s) else s for s in succ.statements)
+    for name in successors(succ.ctl_trans):
+        for stmt in takewhile(is_phi, prog.block_map[name].statements):
+            names = stmt.val.block_names
+            names[names.index(succ.name)] = block.name
+    trans = succ.ctl_trans
+    prog.unlink(succ)
+    prog.set_ctl_trans(block, trans)
+    del prog.block_map[succ.name]
+    prog.blocks_by_id[succ.id] = None  # left in prog.blocks until simplify_cfg compacts it
+
+def cleanup(prog:IRProgram) -> dict[str, dict[str, int]]:
+    # dead code elimination and CFG simplification until neither changes anything, with their reports added up
+    report = {f: {} for f in prog.functions}
+    changed = True
+    while changed:
+        changed = False
+        for counts in [dce(prog), simplify_cfg(prog)]:
+            for f, fcounts in counts.items():
+                for what, n in fcounts.items():
+                    report[f][what] = report[f].get(what, 0) + n
+                    changed = changed or n > 0
+    return report
+
+
+@dataclass
+class Loop:
+    # A natural loop, by the positions of its blocks in the Dominators it was found with
+    header:int
+    blocks:set[int]  # the header included
+    latches:list[int]  # the blocks branching back to the header
+
+def natural_loops(dom:Dominators) -> list[Loop]:
+    # The natural loops of dom's function, one per back edge (into a block that dominates where it's from) with the
+    # loops sharing a header merged, innermost first: a loop nested in another has fewer blocks
+    loops = {}
+    for b, preds in enumerate(dom.preds):
+        for p in preds:
+            if not dom.dominates(b, p):
+                continue
+            loop = loops.setdefault(b, Loop(b, {b}, []))
+            loop.latches.append(p)
+            work = [p]
+            while work:
+                x = work.pop()
+                if x not in loop.blocks:
+                    loop.blocks.add(x)
+                    work.extend(dom.preds[x])
+    return sorted(loops.values(), key=lambda loop: len(loop.blocks))
+
+def add_preheader(prog:IRProgram,header:IRBasicBlock,entries:list[IRBasicBlock]) -> IRBasicBlock:
+    # A new block the edges into header from entries (its predecessors outside the loop) go through instead, with
+    # the header's phis given their values for those edges from phis in it, if there's more than one
+    block = IRBasicBlock(prog.new_label("preheader"),[],None)
+    prog.index_block(block)
+    prog.blocks.append(block)
+    prog.set_ctl_trans(block,IRJump(header.name))
+    names = [e.name for e in entries]
+    moved = []
+    for stmt in takewhile(is_phi, header.statements):
+        phi = stmt.val
+        vals = [phi.vars[phi.block_names.index(name)] for name in names]
+        if len(vals) > 1:
+            block.statements.append(IRAssign(prog.new_tmp(), IRPhi(list(names), vals)))
+            vals = [block.statements[-1].v]
+        moved.append((phi, vals[0]))
+    for e in entries:
+        prog.set_ctl_trans(e,retarget(e.ctl_trans,header.name,block.name))
+    for phi, v in moved:
+        phi.block_names.append(block.name)
+        phi.vars.append(v)
+    return block
+
+def licm(prog:IRProgram) -> dict[str, dict[str, int]]:
+    # Loop invariant code motion over SSA form: every natural loop gets a preheader, a block its entries all go
+    # through, and the computations in the loop whose operands are all defined outside it are moved there, innermost
+    # loops first so what's hoisted out of one loop can be hoisted out of the next
+    # Returns the number of loops and instructions hoisted out of them in each function
+    return {f: licm_function(prog, f) for f in prog.functions}
+
+def licm_function(prog:IRProgram,f:str) -> dict[str, int]:
+    # The hoisted instructions run even if the loop doesn't, or stops at a check before reaching them, so only those
+    # that can't fail are: not division, and only the reads known to be from an object or table and in bounds. That's
+    # the vtable and field map of something known to be a pointer (this, a new object or a variable whose tag check
+    # comes before the loop), the entries in either, and the field at an offset from its own field map
+    # The vtable and field map of an object never change, but a field is only invariant in a loop that doesn't store
+    # to one or call anything
+    dom = Dominators(prog, f)
+    loops = natural_loops(dom)
+    for loop in loops:
+        entries = [dom.block(p) for p in dom.preds[loop.header] if p not in loop.blocks]
+        if entries:
+            add_preheader(prog, dom.block(loop.header), entries)
+    if not loops:
+        return {"loops": 0, "hoisted": 0}
+    dom = Dominators(prog, f)
+    loops = natural_loops(dom)
+
+    def_pos = {reg: 0 for reg in prog.functions[f]}  # variable -> position of the block assigning it
+    exprs = {}  # variable -> the expression assigned to it
+    kinds = {}  # variable -> ("vtable" or "fields", p) for p's tables, or ("offset", p) for an entry in p's field map
+    pointers = {"this"} if prog.functions[f][:1] == ["this"] else set()
+    checked = {}  # variable -> positions of the blocks only reached once its tag check has passed
+    for b in range(len(dom.order)):
+        for stmt in dom.block(b).statements:
+            if type(stmt) is not IRAssign:
+                continue
+            dest, expr = stmt.v.reg, stmt.val
+            def_pos[dest] = b
+            exprs[dest] = expr
+            match expr:
+                case IRAlloc():
+                    pointers.add(dest)
+                case IRLoad(IRVar(p)):
+                    kinds[dest] = ("vtable", p)
+                case IRGetELT(IRVar(t), IRConst()) if t in kinds:
+                    if kinds[t][0] == "fields":
+                        kinds[dest] = ("offset", kinds[t][1])
+                case IRGetELT(IRVar(p), IRConst(1)):
+                    kinds[dest] = ("fields", p)
+    for b, preds in enumerate(dom.preds):
+        if len(preds) != 1:
+            continue
+        trans = dom.block(preds[0]).ctl_trans
+        if type(trans) is IRIf and trans.b_false == dom.block(b).name != trans.b_true and type(trans.v) is IRVar:
+            match exprs.get(trans.v.reg):
+                case IROp(IRVar(v), "&", IRConst(1)):
+                    checked.setdefault(v, []).append(b)
+
+    def is_pointer(v,pre:int) -> bool:
+        return type(v) is IRVar and (v.reg in pointers or any(dom.dominates(b, pre) for b in checked.get(v.reg, ())))
+
+    def in_table(t,i,pre:int) -> bool:
+        # whether t[i] is an entry of a table
+        if type(i) is not IRConst or i.n < 0:
+            return False
+        if type(t) is IRArray:
+            return i.n < len(t.vals)
+        if type(t) is IRVar and t.reg in kinds:
+            tables = prog.vtbls if kinds[t.reg][0] == "vtable" else prog.field_maps
+            return kinds[t.reg][0] != "offset" and i.n < min(len(table.vals) for table in tables)
+        return False
+
+    def can_hoist(expr,pre:int,writes:bool) -> bool:
+        match expr:
+            case IROperation(_, "/", r) | IROp(_, "/", r):
+                return type(r) is IRConst and r.n != 0
+            case IROp(_, "<<", r):
+                return type(r) is IRConst and r.n >= 0
+            case IROperation() | IROp():
+                return True
+            case IRLoad(base):
+                return is_pointer(base, pre)
+            case IRGetELT(base, IRConst(1)) if is_pointer(base, pre):
+                return True
+            case IRGetELT(IRVar(p), IRVar(off)):
+                return not writes and kinds.get(off) == ("offset", p)
+            case IRGetELT(base, i):
+                return in_table(base, i, pre)
+        return False
+
+    hoisted = 0
+    for loop in loops:
+        pre = [p for p in dom.preds[loop.header] if p not in loop.blocks]
+        if len(pre) != 1:
+            continue
+        pre = pre[0]
+        preheader = dom.block(pre)
+        blocks = [dom.block(b) for b in sorted(loop.blocks)]
+        writes = any(type(stmt) in (IRStore, IRSetELT) or (type(stmt) is IRAssign and type(stmt.val) is IRCall)
+                     for block in blocks for stmt in block.statements)
+        for block in blocks:
+            kept = []
+            for stmt in block.statements:
+                if (type(stmt) is IRAssign and not is_phi(stmt)
+                        and all(type(v) is not IRVar or def_pos.get(v.reg, 0) not in loop.blocks for v in operands(stmt))
+                        and can_hoist(stmt.val, pre, writes)):
+                    preheader.statements.append(stmt)
+                    def_pos[stmt.v.reg] = pre
+                    hoisted += 1
+                else:
+                    kept.append(stmt)
+            block.statements = kept
+    return {"loops": len(loops), "hoisted": hoisted}
+
+
+INLINE_BUDGET = 16  # the most instructions (control transfers included) a function can have to be inlined
+
+def method_implementations(prog:IRProgram) -> list[set[str]]:
+    # Class hierarchy analysis: the functions any class has in each vtable slot, over the vtables the program's
+    # classes were lowered to. There's no inheritance, so a slot holds either the class's own method or nothing
+    return [{vtbl.vals[slot] for vtbl in prog.vtbls if type(vtbl.vals[slot]) is str}
+            for slot in range(len(prog.vtbls[0].vals) if prog.vtbls else 0)]
+
+def class_tables(prog:IRProgram) -> tuple[dict[str, int], dict[int, int]]:
+    # the index of the class of each method, by its label, and of each vtable, by its id
+    owners = {label: i for i, vtbl in enumerate(prog.vtbls) for label in vtbl.vals if type(label) is str}
+    return owners, {id(vtbl): i for i, vtbl in enumerate(prog.vtbls)}
+
+def receiver_classes(prog:IRProgram,f:str,tables:tuple=None) -> dict[str, int]:
+    # Type flow over f in SSA form: the variables known to hold an object of a single class, by its index. That's
+    # this in a method (no other class has the method to be called with), new objects, and copies and phis of only
+    # those, found optimistically so the phis of a loop can keep their class
+    # tables are the program's class_tables, to save working them out for every function
+    owners, vtbl_index = tables or class_tables(prog)
+    known = {"this": owners[f]} if f in owners else {}
+    allocs = set()
+    flow = []  # the copies and phis
+    for block in prog.function_blocks(f):
+        for stmt in block.statements:
+            if type(stmt) is IRAssign:
+                if type(stmt.val) is IRAlloc:
+                    allocs.add(stmt.v.reg)
+                elif type(stmt.val) in (IRVar, IRPhi):
+                    flow.append(stmt)
+            elif type(stmt) is IRStore and type(stmt.base) is IRVar and stmt.base.reg in allocs:
+                known[stmt.base.reg] = vtbl_index[id(stmt.i)]  # the vtable stored when the object's allocated
+
+    classes = {stmt.v.reg: None for stmt in flow}  # None until an operand with a class is seen, -1 for none
+    changed = True
+    while changed:
+        changed = False
+        for stmt in flow:
+            seen = set()
+            for v in stmt.val.vars if type(stmt.val) is IRPhi else [stmt.val]:
+                c = known.get(v.reg, classes.get(v.reg, -1)) if type(v) is IRVar else -1
+                if c is not None:
+                    seen.add(c)
+            new = None if not seen else seen.pop() if len(seen) == 1 else -1
+            if new != classes[stmt.v.reg] and classes[stmt.v.reg] != -1:
+                classes[stmt.v.reg] = new
+                changed = True
+    known.update((reg, c) for reg, c in classes.items() if c is not None and c >= 0)
+    return known
+
+def devirtualize(prog:IRProgram) -> dict[str, dict[str, int]]:
+    # Make calls through vtables direct calls to the function they must reach, over SSA form: when only one class
+    # has a method with the name, or the receiver's class is known (see receiver_classes)
+    # The check that the receiver has the method stays in the first case, in the second its vtable entry is known
+    # too so the check goes with the next pass that propagates it
+    # Returns the number of calls made direct in each function
+    impls = method_implementations(prog)
+    tables = class_tables(prog)
+    report = {}
+    for f in prog.functions:
+        defs = {}  # variable -> the assignment to it
+        classes = receiver_classes(prog, f, tables)
+        for block in prog.function_blocks(f):
+            for stmt in block.statements:
+                if type(stmt) is IRAssign:
+                    defs[stmt.v.reg] = stmt
+
+        def resolve(v):
+            # follow v back through copies
+            while type(v) is IRVar and v.reg in defs and is_operand(defs[v.reg].val):
+                v = defs[v.reg].val
+            return v
+
+        def vtable_of(v):
+            # the vtable v is known to be, if any
+            v = resolve(v)
+            if type(v) is IRVar and v.reg in defs and type(defs[v.reg].val) is IRLoad:
+                obj = defs[v.reg].val.base
+                return prog.vtbls[classes[obj.reg]] if type(obj) is IRVar and obj.reg in classes else None
+            return v if type(v) is IRArray else None
+
+        calls = 0
+        for stmt in list(defs.values()):
+            if type(stmt.val) is not IRCall or type(stmt.val.c) is not IRVar or stmt.val.c.reg not in defs:
+                continue
+            lookup = defs[stmt.val.c.reg]
+            match lookup.val:
+                case IRGetELT(vtbl, IRConst(slot)):
+                    vtbl = vtable_of(vtbl)
+                    if vtbl is not None:
+                        if type(vtbl.vals[slot]) is not str:
+                            continue  # the call fails, there's no such method
+                        lookup.val = stmt.val.c = IRLabel(vtbl.vals[slot])
+                    elif len(impls[slot]) == 1:
+                        stmt.val.c = IRLabel(next(iter(impls[slot])))
+                    else:
+                        continue
+                    calls += 1
+        report[f] = {"calls": calls}
+    return report
+
+def function_size(prog:IRProgram,f:str) -> int:
+    return sum(len(block.statements) + 1 for block in prog.function_blocks(f))
+
+def inline(prog:IRProgram,budget:int=INLINE_BUDGET) -> dict[str, dict[str, int]]:
+    # Replace the direct calls to functions of at most budget instructions with a copy of their blocks, over SSA
+    # form: the caller's block is split at the call, the arguments copied to the callee's (renamed) parameters, and
+    # its returns become jumps to the rest of the caller's block, with a phi for the result if there's more than one
+    # Only the calls in the functions as they were are inlined, so recursion can't go on forever, and never a call
+    # to the function it's in
+    # Returns the number of calls inlined into each function and the instructions they added
+    sizes = {f: function_size(prog, f) for f in prog.functions}
+    report = {}
+    for f in prog.functions:
+        calls = added = 0
+        for block in prog.function_blocks(f):
+            # from the end of the block, so splitting it leaves the earlier calls where they were
+            for i in reversed(range(len(block.statements))):
+                stmt = block.statements[i]
+                if type(stmt) is not IRAssign or type(stmt.val) is not IRCall or type(stmt.val.c) is not IRLabel:
+                    continue
+                callee = stmt.val.c.name
+                if (callee == f or callee not in prog.functions or sizes[callee] > budget
+                        or len(prog.functions[callee]) != len(stmt.val.args) + 1
+                        or prog.pred_ids[prog.block_id(callee)]):
+                    continue
+                inline_call(prog, block, i, callee)
+                calls += 1
+                added += sizes[callee]
+        report[f] = {"calls": calls, "instructions": added}
+    return report
+
+def inline_call(prog:IRProgram,block:IRBasicBlock,i:int,callee:str):
+    # replace the call that's statement i of block with the blocks of callee
+    stmt = block.statements[i]
+    rest = IRBasicBlock(prog.new_label(),block.statements[i+1:],None)
+    prog.index_block(rest)
+    prog.blocks.append(rest)
+    for succ in successors(block.ctl_trans):
+        for phi in takewhile(is_phi, prog.block_map[succ].statements):
+            phi.val.block_names = [rest.name if b == block.name else b for b in phi.val.block_names]
+    prog.set_ctl_trans(rest,block.ctl_trans)
+
+    body = prog.function_blocks(callee)
+    labels = {b.name: prog.new_label() for b in body}
+    regs = {}
+
+    def rename(v):
+        if type(v) is IRVar:
+            if v.reg not in regs:
+                regs[v.reg] = prog.new_tmp()
+            return regs[v.reg]
+        return v
+
+    block.statements = block.statements[:i]
+    for param, arg in zip(prog.functions[callee], [stmt.val.r, *stmt.val.args]):
+        block.statements.append(IRAssign(rename(IRVar(param)), arg))
+    returns = []
+    copies = []
+    for b in body:
+        statements = []
+        for s in b.statements:
+            if type(s) is IRAssign:
+                s = IRAssign(rename(s.v), s.val if is_operand(s.val) else replace(s.val))
+                if type(s.val) is IRPhi:
+                    s.val.block_names = [labels[name] for name in s.val.block_names]
+            else:
+                s = replace(s)
+            map_operands(s, rename)
+            statements.append(s)
+        copy = IRBasicBlock(labels[b.name],statements,None)
+        prog.index_block(copy)
+        prog.blocks.append(copy)
+        trans = b.ctl_trans
+        if type(trans) is IRRet:
+            returns.append((copy, rename(trans.v)))
+            trans = IRJump(rest.name)
+        else:
+            match trans:
+                case IRIf(v, b_true, b_false):
+                    trans = IRIf(rename(v), labels[b_true], labels[b_false])
+                case IRJump(b):
+                    trans = IRJump(labels[b])
+        copies.append((copy, trans))
+    for copy, trans in copies:
+        prog.set_ctl_trans(copy, trans)
+    if len(returns) == 1:
+        returns[0][0].statements.append(IRAssign(stmt.v, returns[0][1]))
+    elif returns:
+        rest.statements.insert(0, IRAssign(stmt.v, IRPhi([b.name for b, _ in returns], [v for _, v in returns])))
+    prog.set_ctl_trans(block, IRJump(labels[callee]))
+
+
+def resolve_fields(prog:IRProgram) -> dict[str, dict[str, int]]:
+    # Use the field maps of the objects whose class is known (see receiver_classes), over SSA form: the offset of a
+    # field is looked up in the class's field map at compile time instead of the object's at run time, and the
+    # object's tag check is known to pass
+    # What was looked up only in the field map is then dead, and the checks that the object is a pointer and has the
+    # field go with the next pass that propagates constants
+    # Returns the number of field offsets and tag checks resolved in each function
+    tables = class_tables(prog)
+    report = {}
+    for f in prog.functions:
+        classes = receiver_classes(prog, f, tables)
+        field_maps = {}  # variable -> the field map it's been found to hold
+        fields = checks = 0
+        for block in prog.function_blocks(f):
+            for stmt in block.statements:
+                if type(stmt) is not IRAssign:
+                    continue
+                match stmt.val:
+                    case IROp(IRVar(obj), "&", IRConst(1)) if obj in classes:
+                        stmt.val = IRConst(0)
+                        checks += 1
+                    case IRGetELT(IRVar(obj), IRConst(1)) if obj in classes:
+                        stmt.val = field_maps[stmt.v.reg] = prog.field_maps[classes[obj]]
+                    case IRGetELT(IRVar(fm), IRConst(slot)) if fm in field_maps:
+                        stmt.val = field_maps[fm].vals[slot]
+                        fields += not prog.compact_tables or slot % 2  # not the selectors of compact tables
+        report[f] = {"fields": fields, "checks": checks}
+    return report
+
+
+def scalar_replace(prog:IRProgram) -> dict[str, dict[str, int]]:
+    # Escape analysis and scalar replacement over SSA form: an object that's only ever the base of the reads and
+    # writes of its own words at constant offsets (or has its tag checked), directly or through copies, can't be
+    # reached from outside the function, as it isn't stored anywhere, passed to a call, returned or merged by a phi
+    # Its words can then be variables instead: the allocation becomes their zeroing, the reads and writes copies
+    # from and to them, and the tag checks 0, with the variables put into SSA form after
+    # Returns the number of allocations replaced in each function and of the reads, writes and checks of them
+    report = {}
+    words = set()
+    for f in prog.functions:
+        blocks = prog.function_blocks(f)
+        sizes = {}  # allocation -> the number of words in its object
+        aliases = {}  # variable -> the allocation it holds, itself included
+        for block in blocks:
+            for stmt in block.statements:
+                if type(stmt) is not IRAssign:
+                    continue
+                if type(stmt.val) is IRAlloc and type(stmt.val.n) is IRConst:
+                    sizes[stmt.v.reg] = stmt.val.n.n
+                    aliases[stmt.v.reg] = stmt.v.reg
+                elif type(stmt.val) is IRVar and stmt.val.reg in aliases:
+                    aliases[stmt.v.reg] = aliases[stmt.val.reg]
+
+        def word(v,i) -> bool:
+            # whether v is one of the objects and i a constant offset into it
+            return type(v) is IRVar and v.reg in aliases and type(i) is IRConst and 0 <= i.n < sizes[aliases[v.reg]]
+
+        escaped = set()
+        for block in blocks:
+            for inst in [*block.statements, block.ctl_trans]:
+                match inst:
+                    case IRAssign(_, IRVar() | IRAlloc()):
+                        continue
+                    case IRAssign(_, IRLoad(base)) if word(base, IRConst(0)):
+                        continue
+                    case IRAssign(_, IRGetELT(base, i)) if word(base, i):
+                        continue
+                    case IRAssign(_, IROp(base, "&", IRConst(1))) if word(base, IRConst(0)):
+                        continue
+                    case IRStore(base, val) if word(base, IRConst(0)):
+                        used = [val]
+                    case IRSetELT(base, i, val) if word(base, i):
+                        used = [val]
+                    case _:
+                        used = operands(inst)
+                escaped.update(aliases[v.reg] for v in used if type(v) is IRVar and v.reg in aliases)
+
+        replaced = {obj: [prog.new_tmp() for _ in range(n)] for obj, n in sizes.items() if obj not in escaped}
+        rewritten = 0
+        for block in blocks:
+            statements = []
+            for stmt in block.statements:
+                match stmt:
+                    case IRAssign(v, IRAlloc()) if v.reg in replaced:
+                        statements.extend(IRAssign(w, IRConst(0)) for w in replaced[v.reg])
+                        continue
+                    case IRAssign(v, IRVar(obj)) if aliases.get(obj) in replaced:
+                        continue
+                    case IRAssign(v, IRLoad(IRVar(obj))) if aliases.get(obj) in replaced:
+                        stmt = IRAssign(v, replaced[aliases[obj]][0])
+                    case IRAssign(v, IRGetELT(IRVar(obj), IRConst(i))) if aliases.get(obj) in replaced:
+                        stmt = IRAssign(v, replaced[aliases[obj]][i])
+                    case IRAssign(v, IROp(IRVar(obj), "&", IRConst(1))) if aliases.get(obj) in replaced:
+                        stmt = IRAssign(v, IRConst(0))
+                    case IRStore(IRVar(obj), val) if aliases.get(obj) in replaced:
+                        stmt = IRAssign(replaced[aliases[obj]][0], val)
+                    case IRSetELT(IRVar(obj), IRConst(i), val) if aliases.get(obj) in replaced:
+                        stmt = IRAssign(replaced[aliases[obj]][i], val)
+                    case _:
+                        statements.append(stmt)
+                        continue
+                statements.append(stmt)
+                rewritten += 1
+            block.statements = statements
+        words.update(w.reg for ws in replaced.values() for w in ws)
+        report[f] = {"allocations": len(replaced), "instructions": rewritten}
+    if words:
+        to_ssa(prog, words)
+    return report
+
+
+# Peephole rules, by the kind of expression (and op) they apply to, so each instruction is matched with one lookup
+# A rule takes the expression, with its operands already propagated, and what's known about memory in the block so
+# far ((base key, index) -> the operand last stored there or read from there), and returns what to replace it with
+# or None; the fire counts of the rules are reported by name
+PEEPHOLE_RULES = {}
+POINTER_TAG = -1  # the index memory knows a fresh allocation's tag bit by, which nothing can overwrite
+
+def peephole_rule(*keys):
+    def register(rule):
+        for key in keys:
+            PEEPHOLE_RULES.setdefault(key, []).append(rule)
+        return rule
+    return register
+
+ALL_OPS = [(cls, op) for cls in (IROperation, IROp) for op in IR_OPS]
+
+@peephole_rule(*ALL_OPS)
+def fold_constants(expr,memory):
+    if type(expr.l) is IRConst and type(expr.r) is IRConst:
+        n = fold(expr.op, expr.l.n, expr.r.n)
+        return None if n is None else IRConst(n)
+
+@peephole_rule((IROperation, "+"), (IROperation, "-"))
+def add_zero(expr,memory):
+    if expr.r == IRConst(0):
+        return expr.l
+    if expr.op == "+" and expr.l == IRConst(0):
+        return expr.r
+
+@peephole_rule((IROperation, "*"))
+def multiply_by_constant(expr,memory):
+    for x, c in [(expr.l, expr.r), (expr.r, expr.l)]:
+        if type(c) is IRConst:
+            if c.n == 0:
+                return c
+            if c.n == 1:
+                return x
+            if c.n > 0 and c.n & (c.n - 1) == 0:
+                return IROp(x, "<<", IRConst(c.n.bit_length() - 1))
+
+@peephole_rule((IROperation, "-"), (IROperation, "=="), (IROperation, "!="), (IROperation, "<"), (IROperation, ">"))
+def same_operands(expr,memory):
+    if type(expr.l) is IRVar and expr.l == expr.r:
+        return IRConst(IR_OPS[expr.op](0, 0))
+
+@peephole_rule((IROp, "&"))
+def pointer_tag(expr,memory):
+    # the low bit of something allocated, that it isn't an integer
+    if expr.r == IRConst(1):
+        return memory.get((operand_key(expr.l), POINTER_TAG))
+
+@peephole_rule((IRLoad, None))
+def load_after_store(expr,memory):
+    return memory.get((operand_key(expr.base), 0))
+
+@peephole_rule((IRGetELT, None))
+def getelt_after_setelt(expr,memory):
+    if type(expr.i) is IRConst:
+        return memory.get((operand_key(expr.base), expr.i.n))
+
+@peephole_rule((IRGetELT, None))
+def table_entry(expr,memory):
+    # an offset read straight out of a field map, or a method out of a vtable
+    if type(expr.base) is IRArray and type(expr.i) is IRConst:
+        val = expr.base.vals[expr.i.n]
+        return IRLabel(val) if type(val) is str else val
+
+def peephole(prog:IRProgram) -> dict[str, dict[str, int]]:
+    # Rewrite each instruction by the first peephole rule matching it, again while one does, after propagating the
+    # copies made earlier into it
+    # What's known is carried along chains of blocks with a single predecessor, the only ones where everything before
+    # is sure to have run. Memory is tracked for the rules forwarding stores to loads: objects' vtables and field
+    # maps (words 0 and 1) are only written when they're allocated, but a store to any other word could be to the
+    # same place as one through another variable, as could anything a call does
+    # Returns the number of times each rule fired in each function, copy propagation and branches on constants made
+    # jumps included
+    report = {}
+    for f in prog.functions:
+        counts = report[f] = {}
+        known = {}  # block id -> (copies, memory) at its end
+
+        def fired(name:str):
+            counts[name] = counts.get(name, 0) + 1
+
+        for block in prog.function_blocks(f):
+            preds = prog.preds(block)
+            if len(preds) == 1 and preds[0].id in known:
+                copies, memory = (dict(d) for d in known[preds[0].id])
+            else:
+                copies = {}  # variable -> the operand it was last assigned
+                memory = {}
+
+            def propagate(v):
+                if type(v) is IRVar and v.reg in copies:
+                    fired("propagate_copy")
+                    return copies[v.reg]
+                return v
+
+            def forget(reg:str):
+                # reg is being assigned, so what was known about its old value no longer holds
+                copies.pop(reg, None)
+                for k, v in list(copies.items()):
+                    if v == IRVar(reg):
+                        del copies[k]
+                for k, v in list(memory.items()):
+                    if k[0] == reg or v == IRVar(reg):
+                        del memory[k]
+
+            def forget_words(keep):
+                for k in [k for k in memory if not keep(k[1])]:
+                    del memory[k]
+
+            for stmt in block.statements:
+                if not is_phi(stmt):
+                    map_operands(stmt, propagate)
+                match stmt:
+                    case IRAssign(v, expr):
+                        for _ in range(8):  # rules only ever simplify, but don't trust that to terminate
+                            rules = PEEPHOLE_RULES.get((type(expr), getattr(expr, "op", None)), ())
+                            new = next(((rule, n) for rule in rules if (n := rule(expr, memory)) is not None), None)
+                            if new is None:
+                                break
+                            fired(new[0].__name__)
+                            expr = new[1]
+                        stmt.val = expr
+                        if copies or memory:
+                            forget(v.reg)
+                        if is_operand(expr):
+                            copies[v.reg] = expr
+                        elif type(expr) is IRAlloc:
+                            memory[(v.reg, POINTER_TAG)] = IRConst(0)
+                        elif type(expr) is IRLoad:
+                            memory[(operand_key(expr.base), 0)] = v
+                        elif type(expr) is IRGetELT and type(expr.i) is IRConst:
+                            memory[(operand_key(expr.base), expr.i.n)] = v
+                        elif type(expr) is IRCall:
+                            forget_words(keep=lambda i: i < 2)
+                    case IRStore(base, val):
+                        forget_words(keep=lambda i: i != 0)
+                        memory[(operand_key(base), 0)] = val
+                    case IRSetELT(base, IRConst(i), val):
+                        forget_words(keep=lambda j: j != i)
+                        memory[(operand_key(base), i)] = val
+                    case IRSetELT():
+                        forget_words(keep=lambda i: i < 2)
+
+            map_operands(block.ctl_trans, propagate)
+            if type(block.ctl_trans) is IRIf and type(block.ctl_trans.v) in (IRConst, IRLabel):
+                trans = block.ctl_trans
+                taken = type(trans.v) is IRLabel or trans.v.n
+                prog.set_ctl_trans(block, IRJump(trans.b_true if taken else trans.b_false))
+                fired("constant_branch")
+            known[block.id] = (copies, memory)
+    return report
+
+
+def optimize(prog:IRProgram) -> dict[str, dict[str, dict[str, int]]]:
+    # Run the optimization passes over prog, in SSA form between them, returning each pass's report
+    to_ssa(prog)
+    report = {"devirtualize": devirtualize(prog), "inline": inline(prog), "fields": resolve_fields(prog)}
+    report |= {"sccp": sccp(prog), "gvn": gvn(prog), "escape": scalar_replace(prog), "licm": licm(prog), "peephole": peephole(prog), "cleanup": cleanup(prog)}
+    from_ssa(prog)
+    # the copies for the phis can leave blocks (and edges split for them) empty
+    report["cleanup after ssa"] = cleanup(prog)
+    return report
+
+
 class ASTNode(ABC):
     # to_ir()
-    pass
+    # Nodes are slotted dataclasses, there can be millions of them and a __dict__ each would dominate their size
+    __slots__ = ()
 
 class Statement(ASTNode):
-    pass
+    __slots__ = ()
 
 class Expression(ASTNode):
-    pass
+    __slots__ = ()
 
-@dataclass
+    def subexpressions(self):
+        return ()
+
+    @abstractmethod
+    def emit(self,prog,operands):
+        # Emit the code for this node into prog, given its subexpressions lowered to operands, returning the
+        # IR expression for its value
+        pass
+
+    def to_ir(self,prog):
+        return lower_expr(self,prog)
+
+@dataclass(slots=True)
 class Method(ASTNode):
     method_name:str
     args:list[str]
     local_vars:list[str]
     statements:list[Statement]
-
-    def to_ir(prog:IRProgram):
-        for s in statements:
-            s.to_ir(IRProgram)
-
-
-@dataclass
+    parse_body:Callable[[], list[Statement]] = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def lazy(cls,method_name:str,args:list[str],local_vars:list[str],parse_body):
+        # A Method whose statements are left unset until they're first used, then parsed by calling parse_body
+        m = cls.__new__(cls)
+        m.method_name = method_name
+        m.args = args
+        m.local_vars = local_vars
+        m.parse_body = parse_body
+        return m
+
+    def parsed(self) -> bool:
+        return self.parse_body is None
+
+    def __getattr__(self,name):
+        # Only called for attributes that aren't set, so for statements this is a lazy Method's first use of them
+        if name != "statements" or self.parse_body is None:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        self.statements = self.parse_body()
+        self.parse_body = None
+        return self.statements
+
+    def to_ir(self,prog:IRProgram,class_name:str):
+        # methods are called with their receiver as the first argument, this
+        prog.begin_function(class_name + self.method_name,["this",*self.args],self.local_vars)
+        lower_stmts(self.statements,prog)
+        prog.end_function()
+
+
+@dataclass(slots=True)
 class Class(ASTNode):
     class_name:str
     fields:list[str]
@@ -357,364 +2695,715 @@ class Class(ASTNode):
 
     def to_ir(self,prog:IRProgram):
         for m in self.methods:
-            prog.add_block(self.class_name,m.method_name)
-            m.to_ir()
-
-
-
-@dataclass
+            m.to_ir(prog,self.class_name)
+
+
+
+def number_symbols(id_lists,n:int):
+    # Number the distinct symbol ids across id_lists in order of first appearance
+    # Returns the numbering as a list indexed by symbol id (-1 for ids that don't appear), and the ids in order
+    index = [-1] * n
+    order = []
+    for ids in id_lists:
+        for i in ids:
+            if index[i] < 0:
+                index[i] = len(order)
+                order.append(i)
+    return index, order
+
+def color_symbols(id_lists,n:int):
+    # Selector coloring: number the distinct symbol ids across id_lists so that no two in the same list get the same
+    # number, greedily taking the lowest free one in order of first appearance
+    # Returns the numbering as a list indexed by symbol id (-1 for ids that don't appear), and how many numbers
+    lists_of = {}  # id -> the indices of the lists it's in
+    for li, ids in enumerate(id_lists):
+        for i in ids:
+            lists_of.setdefault(i, []).append(li)
+    index = [-1] * n
+    ncolors = 0
+    for i, lists in lists_of.items():
+        used = {index[j] for li in lists for j in id_lists[li]}
+        color = 0
+        while color in used:
+            color += 1
+        index[i] = color
+        ncolors = max(ncolors, color + 1)
+    return index, ncolors
+
+@dataclass(slots=True)
 class Program(ASTNode):
     classes:list[Class]
     local_vars:list[str]
     statements:list[Statement]
-    
-    def to_ir_program(self):
-        field_map = {}
-        counter = 0
-        for c in self.classes:
-            for field in c.fields:
-                if field not in field_map:
-                    field_map[field] = counter
-                    counter += 1
+    # the table the names in the tree were interned in, if it came from the Parser
+    symbols:SymbolTable = field(default=None, repr=False, compare=False)
+
+    def to_ir_tables(self,compact:bool=False) -> IRProgram:
+        # The IRProgram with just the vtables and field maps of the classes
+        # Every distinct field name gets a slot in every field map holding the offset of the field in objects of that
+        # class (0 if it doesn't have it), and likewise every method name a slot in every vtable holding the code label
+        # That's a table the size of every name for every class, so with compact the names are colored instead, only
+        # names in the same class needing different slots, and the slots hold which name's entry they are as well
+        symbols = SymbolTable() if self.symbols is None else self.symbols
+        class_fields = [[symbols.id_of(f) for f in c.fields] for c in self.classes]
+        class_methods = [[symbols.id_of(m.method_name) for m in c.methods] for c in self.classes]
+        field_index, field_order = number_symbols(class_fields, len(symbols))
+        method_index, method_order = number_symbols(class_methods, len(symbols))
+        field_names = {symbols[f]: i for i, f in enumerate(field_order)}
+        method_names = {symbols[m]: i for i, m in enumerate(method_order)}
+        nfields, nmethods = len(field_order), len(method_order)
+        if compact:
+            field_index, nfields = color_symbols(class_fields, len(symbols))
+            method_index, nmethods = color_symbols(class_methods, len(symbols))
+            field_names = {name: field_index[symbols.id_of(name)] for name in field_names}
+            method_names = {name: method_index[symbols.id_of(name)] for name in method_names}
+
+        def table(entries:dict[int, Union[str,IRConst]], index:list[int], n:int) -> list:
+            # entries by symbol id, in their slots
+            if not compact:
+                vals = [IRConst(0)] * n
+                for i, entry in entries.items():
+                    vals[index[i]] = entry
+                return vals
+            vals = [IRConst(0)] * (2 * n)
+            for i, entry in entries.items():
+                vals[2 * index[i]:2 * index[i] + 2] = [IRConst(i + 1), entry]
+            return vals
 
         vtbls = []
         class_field_maps = []
-        for c in self.classes:
+        for c, fields, methods in zip(self.classes, class_fields, class_methods):
+            # slots 0 and 1 of an object hold its vtable and field map
+            offsets = {f: IRConst(offset) for offset, f in enumerate(fields, 2)}
+            class_field_maps.append(IRArray(table(offsets, field_index, nfields), f"fields{c.class_name}"))
+            labels = {mid: c.class_name + m.method_name for m, mid in zip(c.methods, methods)}
+            vtbls.append(IRArray(table(labels, method_index, nmethods), f"vtbl{c.class_name}"))
 
-            counter = 2 # first field offset
-            class_map = []
-            for i in range(len(field_map)):
-                class_map.append(0)
+        return IRProgram(vtbls, class_field_maps, field_names, method_name_to_vtbl_index=method_names,
+                         symbols=symbols, field_index=field_index, method_index=method_index,
+                         class_index={c.class_name: i for i, c in enumerate(self.classes)}, compact_tables=compact)
 
-            for field in c.fields:
-                class_map[field_map[field]] = counter
-                counter += 1
-            class_field_maps.append(IRArray(class_map))
+    def to_ir_program(self,compact:bool=False):
+        return self.to_ir(self.to_ir_tables(compact))
 
-            vtbl = []
-            for m in c.methods:
-                vtbl.append(c.class_name + mthd.method_name)
-            vtbls.append(IRArray(vtbl))
-
-        prog = IRProgram(vtbls,class_field_maps,field_map)
-        return self.to_ir(prog)
-
-    def to_ir(prog:IRProgram):
+    def to_ir(self,prog:IRProgram):
         for c in self.classes:
             c.to_ir(prog)
 
-        
-        prog.add_block("main")
-        for stmt in stmts:
-            stmt.to_ir(prog)
-
+        prog.begin_function("main",[],self.local_vars)
+        lower_stmts(self.statements,prog)
+        prog.end_function()
         return prog
 
-@dataclass
+@dataclass(slots=True)
 class NumExpression(Expression):
     num:int
     def __post_init__(self):
         self.num = int(self.num)
-    def to_ir(self,counter):
-        return [],IRConst(self.num),counter
+    def emit(self,prog,operands):
+        return IRConst(self.num)
 
 
-@dataclass
+@dataclass(slots=True)
 class VarExpression(Expression):
     var_name:str
-    def to_ir(self,counter):
-        return [],IRVar(self.var_name),counter
-    
+    def emit(self,prog,operands):
+        return IRVar(self.var_name)
 
-def is_flat(Expression):
-    return isinstance(Expression, (NumExpression,VarExpression))
 
-@dataclass
+@dataclass(slots=True)
 class ParenExpression(Expression):
     left:Expression
     op:str
     right:Expression
-    def to_ir(self,counter):
-        print("nested")
-        stmts=[]
-        if not is_flat(self.left):
-            s,expr,counter = self.left.to_ir(counter)
-            stmts.extend(s)
-            tmp = f"tmp{counter}"
-            counter+=1
-            s = IRAssign(IRVar(tmp),expr)
-            stmts.append(s)
-            left = IRVar(tmp)
-        else:
-            _, left, _=self.left.to_ir(counter)
-
-        if not is_flat(self.right):
-            s,expr,counter = self.right.to_ir(counter)
-            stmts.extend(s)
-            tmp = f"tmp{counter}"
-            counter+=1
-            s = IRAssign(IRVar(tmp),expr)
-            stmts.append(s)
-            right = IRVar(tmp)
-        else:
-            _, right, _ = self.right.to_ir(counter)
-        ret= stmts,IROperation(left,self.op,right), counter
-        print(ret)
-        return ret
+    def subexpressions(self):
+        return self.left, self.right
+    def emit(self,prog,operands):
+        left, right = operands
+        return IROperation(left,self.op,right)
 
-@dataclass
+@dataclass(slots=True)
 class MethodExpression(Expression):
     expr:Expression
     method_name:str
     args:list[str]
-    def to_ir():
-        pass
-
-@dataclass
+    def subexpressions(self):
+        return self.expr, *self.args
+    def emit(self,prog,operands):
+        obj, *args = operands
+        slot = prog.method_slot(self.method_name)
+        if slot is None:
+            raise ValueError(f"No class has a method named {self.method_name}")
+        prog.emit_tag_check(obj)
+        vtbl = prog.emit_tmp(IRLoad(obj))
+        code = prog.emit_lookup(vtbl,slot,self.method_name,"NoSuchMethod")
+        return IRCall(code,obj,args)
+
+@dataclass(slots=True)
 class FieldReadExpression(Expression):
     expr:Expression
     field_name:str
-    def to_ir():
-        pass
+    def subexpressions(self):
+        return self.expr,
+    def emit(self,prog,operands):
+        obj, = operands
+        return IRGetELT(obj,prog.emit_field_offset(obj,self.field_name))
 
-@dataclass
+@dataclass(slots=True)
 class NewObjExpression(Expression):
     class_name:str
-    def to_ir():
-        pass
-
-@dataclass
+    def emit(self,prog,operands):
+        i = prog.class_index.get(self.class_name)
+        if i is None:
+            raise ValueError(f"No class named {self.class_name}")
+        obj = prog.emit_tmp(IRAlloc(IRConst(prog.object_size(i))))
+        prog.add_stmt(IRStore(obj,prog.vtbls[i]))
+        prog.add_stmt(IRSetELT(obj,IRConst(1),prog.field_maps[i]))
+        return obj
+
+@dataclass(slots=True)
 class ThisExpression(Expression):
-    def to_ir():
-        pass
-
-@dataclass
+    def emit(self,prog,operands):
+        return IRVar("this")
+
+
+def lower_expr(expr:Expression,prog:IRProgram) -> IRExpression:
+    # Emit the code computing expr into prog and return the IR expression for its value
+    # The tree is walked post-order with an explicit stack so expressions nested arbitrarily deep don't hit the
+    # recursion limit: each node's subexpressions are lowered first, to operands (anything other than a variable or
+    # constant is assigned to a temp), and then handed to the node's emit
+    vals = []
+    stack = [(expr, False)]
+    while stack:
+        node, ready = stack.pop()
+        subs = node.subexpressions()
+        if subs and not ready:
+            stack.append((node, True))
+            stack.extend((s, False) for s in reversed(subs))
+            continue
+        if subs:
+            operands = vals[len(vals)-len(subs):]
+            del vals[len(vals)-len(subs):]
+        else:
+            operands = ()
+        val = node.emit(prog, operands)
+        if stack and not isinstance(val, (IRVar, IRConst)):
+            val = prog.emit_tmp(val)
+        vals.append(val)
+    return vals[0]
+
+def lower_stmts(stmts:list[Statement],prog:IRProgram):
+    for stmt in stmts:
+        stmt.to_ir(prog)
+
+@dataclass(slots=True)
 class AssignVarStatement(Statement):
     var_name:str
     val:Expression
     def to_ir(self,prog:IRProgram):
-        stmts, expr, _ = self.val.to_ir(0)
-        for stmt in stmts:
-            prog.add_stmt(stmt)
-        s = IRAssign(IRVar(self.var_name),expr)
-        prog.add_stmt(s)
+        val = self.val.to_ir(prog)
+        if self.var_name == "_":
+            # only evaluated for its effects, so the value only needs keeping if it was computed by the root node
+            prog.emit_operand(val)
+        else:
+            prog.add_stmt(IRAssign(IRVar(self.var_name),val))
 
 
-@dataclass
+@dataclass(slots=True)
 class AssignFieldStatement(Statement):
-    class_name:str
+    class_name:str  # the variable holding the object
     field_name:str
     val:Expression
-    def to_ir():
-        pass
+    def to_ir(self,prog:IRProgram):
+        val = prog.emit_operand(self.val.to_ir(prog))
+        obj = IRVar(self.class_name)
+        prog.add_stmt(IRSetELT(obj,prog.emit_field_offset(obj,self.field_name),val))
 
-@dataclass
+@dataclass(slots=True)
 class IfStatement(Statement):
     condition:Expression
     statements_true:list[Statement]
     statements_false:list[Statement]
-    def to_ir():
-        pass
-
-@dataclass
+    def to_ir(self,prog:IRProgram):
+        b_true, b_false, join = prog.new_label(), prog.new_label(), prog.new_label()
+        prog.emit_condition(self.condition,b_true,b_false)
+        prog.add_block(b_true)
+        lower_stmts(self.statements_true,prog)
+        prog.emit_jump(join)
+        prog.add_block(b_false)
+        lower_stmts(self.statements_false,prog)
+        prog.emit_jump(join)
+        prog.add_block(join)
+
+@dataclass(slots=True)
 class IfOnlyStatement(Statement):
     condition:Expression
     statements:list[Statement]
-    def to_ir():
-        pass
-
-@dataclass
+    def to_ir(self,prog:IRProgram):
+        b_true, join = prog.new_label(), prog.new_label()
+        prog.emit_condition(self.condition,b_true,join)
+        prog.add_block(b_true)
+        lower_stmts(self.statements,prog)
+        prog.emit_jump(join)
+        prog.add_block(join)
+
+@dataclass(slots=True)
 class WhileStatement(Statement):
     condition:Expression
     statements:list[Statement]
-    def to_ir():
-        pass
-
-@dataclass
+    def to_ir(self,prog:IRProgram):
+        head, body, done = prog.new_label(), prog.new_label(), prog.new_label()
+        prog.emit_jump(head)
+        prog.add_block(head)
+        prog.emit_condition(self.condition,body,done)
+        prog.add_block(body)
+        lower_stmts(self.statements,prog)
+        prog.emit_jump(head)
+        prog.add_block(done)
+
+@dataclass(slots=True)
 class ReturnStatement(Statement):
     val:Expression
-    def to_ir():
-        pass
+    def to_ir(self,prog:IRProgram):
+        prog.add_ctl_trans(IRRet(prog.emit_operand(self.val.to_ir(prog))))
+        # anything after the return is unreachable, but still needs a block to go in
+        prog.add_block(prog.new_label())
 
-@dataclass
+@dataclass(slots=True)
 class PrintStatement(Statement):
     val:Expression
-    def to_ir():
-        pass
+    def to_ir(self,prog:IRProgram):
+        prog.add_stmt(IRPrint(prog.emit_operand(self.val.to_ir(prog))))
 
 
 class Parser:
-    def __init__(self,t:Tokenizer):
+    def __init__(self,t:Tokenizer,lazy:bool=False):
+        # A lazy parser skips over method bodies, only parsing them when their statements are first used
+        # That needs to go back to the body's tokens, so a Tokenizer rather than a StreamTokenizer
+        if lazy and not isinstance(t, Tokenizer):
+            raise ValueError("Lazy parsing needs a Tokenizer")
         self.t = t
+        self.lazy = lazy
         self.line_number = 1
 
-    def get_next(self):
-        if self.t.peek() is None:
-            raise SyntaxError("Expected a token but got end of file")
+    def get_next(self) -> Token:
         tok = self.t.get_next()
-        if tok.type == TokenType.NEWLINE:
+        if tok is None:
+            raise SyntaxError("Expected a token but got end of file")
+        if tok.type is TokenType.NEWLINE:
             self.line_number += 1
         return tok
 
-    def parse(self,*typeset):
-        ret = []
-        for t in typeset:
-            if t is Expression:
-                expr = self.parse_expr()
-                ret.append(expr)
-            elif t is Statement:
-                stmt = self.parse_stmt()
-                ret.append(stmt)
-            elif t is Method:
-                mth = self.parse_mthd()
-                ret.append(mth)
-            elif t is Class:
-                cls = self.parse_cls()
-                ret.append(cls)
-            else:
-                tok = self.get_next()
-                if type(t) is list:
-                    if tok.type not in t:
-                        self.parse_error(f"Expected a token of types: {t}, instead got {tok.lexeme} of type {tok.type}")
-                else:
-                    if tok.type != t:
-                        self.parse_error(f"Expected a token of type: {t}, instead got {tok.lexeme} of type {tok.type}")
-                ret.append(tok.lexeme)
-        return ret
-
-    def parse_until(self, until, *typeset, grab_trail = True):
-        ret = []
-        for _ in range(len(typeset)):
-            ret.append([])
-        stop = (lambda: self.t.peek().type in until) if type(until) is list else (lambda: self.t.peek().type == until)
-        while not stop():
-            parsed = self.parse(*typeset)
-            for i in range(len(typeset)):
-                ret[i].append(parsed[i])
-            
-        if grab_trail:
-            self.parse(until)
-        return ret
+    def expect(self,typ:TokenType) -> Token:
+        tok = self.get_next()
+        if tok.type is not typ:
+            self.parse_error(f"Expected a token of type: {typ}, instead got {tok.lexeme} of type {tok.type}")
+        return tok
+
+    def expect_name(self) -> Symbol:
+        # an identifier, or this where it can be used as a name
+        tok = self.get_next()
+        if tok.type is TokenType.IDENTIFIER:
+            return tok.lexeme
+        if tok.type is not TokenType.THIS:
+            self.parse_error(f"Expected a token of types: {[TokenType.IDENTIFIER,TokenType.THIS]}, instead got {tok.lexeme} of type {tok.type}")
+        return self.t.symbols.intern(tok.lexeme)
 
     def parse_error(self,explaination):
         raise SyntaxError(f"Syntax Error on line: {self.line_number}\n{explaination}")
 
     def parse_expr(self) -> Expression:
-        tok = self.t.get_next()
-        match tok.type:
-            case TokenType.LPAREN:
-                left, op, right, _ = self.parse(Expression,OPERATORS,Expression,TokenType.RPAREN)
-                return ParenExpression(left,op,right)
-            case TokenType.IDENTIFIER:
-                return VarExpression(tok.lexeme)
-            case TokenType.NUMBER:
-                return NumExpression(tok.lexeme)
-            case TokenType.CARET:
-                e, _, method_name, _ = self.parse(Expression,TokenType.DOT,[TokenType.IDENTIFIER,TokenType.THIS],TokenType.LPAREN)
-                args = []
-                t = self.t.peek()
-                if t.type != TokenType.RPAREN:
-                    args.append(self.parse_expr())
-                    while((t := self.t.get_next()).type == TokenType.COMMA):
-                        args.append(self.parse_expr())
-                    if t.type != TokenType.RPAREN:
-                        raise SyntaxError("Invalid argument structure to method")
-                else:
-                    self.t.get_next()
-
-                return MethodExpression(e,method_name,args)
-            case TokenType.AMP:
-                e, _, field_name = self.parse(Expression,TokenType.DOT,TokenType.IDENTIFIER)
-                return FieldReadExpression(e,field_name)
-            case TokenType.AT:
-                cl = self.parse(TokenType.IDENTIFIER)[0]
-                return NewObjExpression(cl)
-            case TokenType.THIS:
-                return ThisExpression()
-        raise SyntaxError(f"{tok.type}: {tok.lexeme} cannot start an expression")
-    
-    def parse_stmt(self):
-        def parse_conditional_block():
-            expr, _, _, _, s, _ = self.parse(Expression,TokenType.COLON,TokenType.LCBRAC,TokenType.NEWLINE, Statement, TokenType.NEWLINE)
-            ss, _ = self.parse_until(TokenType.RCBRAC,Statement,TokenType.NEWLINE)
-            return expr,[s,*ss]
+        # Iterative, so expressions nested arbitrarily deep don't hit the recursion limit
+        # Constructs waiting on a subexpression are kept on an explicit stack as frames [state, partial results...],
+        # the state being the token type of what they wait on: LPAREN/RPAREN the left/right of a parenthesized
+        # expression, CARET the receiver of a call, COMMA an argument, AMP the object of a field read
+        stack = []
+        while True:
+            tok = self.get_next()
+            match tok.type:
+                case TokenType.LPAREN | TokenType.CARET | TokenType.AMP:
+                    stack.append([tok.type])
+                    continue
+                case TokenType.IDENTIFIER:
+                    expr = VarExpression(tok.lexeme)
+                case TokenType.NUMBER:
+                    expr = NumExpression(tok.lexeme)
+                case TokenType.AT:
+                    expr = NewObjExpression(self.expect(TokenType.IDENTIFIER).lexeme)
+                case TokenType.THIS:
+                    expr = ThisExpression()
+                case _:
+                    self.parse_error(f"{tok.type}: {tok.lexeme} cannot start an expression")
+
+            # hand the finished expression to the innermost waiting construct, until one needs another subexpression
+            while stack:
+                frame = stack[-1]
+                match frame[0]:
+                    case TokenType.LPAREN:
+                        op = self.get_next()
+                        if op.type not in OPERATOR_TYPES:
+                            self.parse_error(f"Expected a token of types: {OPERATORS}, instead got {op.lexeme} of type {op.type}")
+                        frame[:] = [TokenType.RPAREN, expr, op.lexeme]
+                        break
+                    case TokenType.RPAREN:
+                        self.expect(TokenType.RPAREN)
+                        stack.pop()
+                        expr = ParenExpression(frame[1],frame[2],expr)
+                    case TokenType.CARET:
+                        self.expect(TokenType.DOT)
+                        method_name = self.expect_name()
+                        self.expect(TokenType.LPAREN)
+                        if self.t.peek_type() is not TokenType.RPAREN:
+                            frame[:] = [TokenType.COMMA, expr, method_name, []]
+                            break
+                        self.get_next()
+                        stack.pop()
+                        expr = MethodExpression(expr,method_name,[])
+                    case TokenType.COMMA:
+                        frame[3].append(expr)
+                        t = self.get_next()
+                        if t.type is TokenType.COMMA:
+                            break
+                        if t.type is not TokenType.RPAREN:
+                            self.parse_error("Invalid argument structure to method")
+                        stack.pop()
+                        expr = MethodExpression(frame[1],frame[2],frame[3])
+                    case TokenType.AMP:
+                        self.expect(TokenType.DOT)
+                        stack.pop()
+                        expr = FieldReadExpression(expr,self.expect(TokenType.IDENTIFIER).lexeme)
+            else:
+                return expr
+
+    def parse_block(self) -> list[Statement]:
+        # the statements of a { ... } block, from the newline after the { up to and including the }
+        self.expect(TokenType.NEWLINE)
+        stmts = [self.parse_stmt()]
+        self.expect(TokenType.NEWLINE)
+        while self.t.peek_type() is not TokenType.RCBRAC:
+            stmts.append(self.parse_stmt())
+            self.expect(TokenType.NEWLINE)
+        self.get_next()
+        return stmts
 
-        tok = self.t.get_next()
+    def parse_stmt(self):
+        tok = self.get_next()
         match tok.type:
             case TokenType.IDENTIFIER | TokenType.UNDER:
-                _, expr = self.parse(TokenType.EQUAL,Expression)
-                return AssignVarStatement(tok.lexeme,expr)
+                self.expect(TokenType.EQUAL)
+                return AssignVarStatement(self.t.symbols.intern(tok.lexeme),self.parse_expr())
             case TokenType.EXCLAM:
-                cls, _, field_name, _, expr = self.parse([TokenType.IDENTIFIER,TokenType.THIS],TokenType.DOT,TokenType.IDENTIFIER,TokenType.EQUAL,Expression)
-                return AssignFieldStatement(cls,field_name,expr)
-            case TokenType.IF:
-                expr, stmts_if = parse_conditional_block()
-                _,_,_,s,_ = self.parse(TokenType.ELSE,TokenType.LCBRAC,TokenType.NEWLINE,Statement,TokenType.NEWLINE)
-                ss, _ = self.parse_until(TokenType.RCBRAC,Statement,TokenType.NEWLINE)
-                return IfStatement(expr,stmts_if,[s,*ss])
-            case TokenType.IFONLY:
-                return IfOnlyStatement(*parse_conditional_block())
-            case TokenType.WHILE:
-                return WhileStatement(*parse_conditional_block())
-            case TokenType.RETURN:
+                cls = self.expect_name()
+                self.expect(TokenType.DOT)
+                field_name = self.expect(TokenType.IDENTIFIER).lexeme
+                self.expect(TokenType.EQUAL)
+                return AssignFieldStatement(cls,field_name,self.parse_expr())
+            case TokenType.IF | TokenType.IFONLY | TokenType.WHILE:
                 expr = self.parse_expr()
-                return ReturnStatement(expr)
+                self.expect(TokenType.COLON)
+                self.expect(TokenType.LCBRAC)
+                stmts = self.parse_block()
+                if tok.type is TokenType.IFONLY:
+                    return IfOnlyStatement(expr,stmts)
+                if tok.type is TokenType.WHILE:
+                    return WhileStatement(expr,stmts)
+                self.expect(TokenType.ELSE)
+                self.expect(TokenType.LCBRAC)
+                return IfStatement(expr,stmts,self.parse_block())
+            case TokenType.RETURN:
+                return ReturnStatement(self.parse_expr())
             case TokenType.PRINT:
-                _, expr, _ = self.parse(TokenType.LPAREN,Expression,TokenType.RPAREN)
+                self.expect(TokenType.LPAREN)
+                expr = self.parse_expr()
+                self.expect(TokenType.RPAREN)
                 return PrintStatement(expr)
-        raise Exception(f"how did we get here: {tok}")
+        self.parse_error(f"{tok.type}: {tok.lexeme} cannot start a statement")
 
     def parse_identifier_list(self):
         identifiers = []
-        if self.t.peek().type == TokenType.IDENTIFIER:
-            identifiers.append(self.t.get_next())
-            while(self.t.peek().type == TokenType.COMMA):
-                self.t.get_next()
-                name = self.t.get_next()
-                if name.type != TokenType.IDENTIFIER:
-                    raise SyntaxError("identifier list isn't formatted correctly")
+        if self.t.peek_type() is TokenType.IDENTIFIER:
+            identifiers.append(self.get_next().lexeme)
+            while self.t.peek_type() is TokenType.COMMA:
+                self.get_next()
+                name = self.get_next()
+                if name.type is not TokenType.IDENTIFIER:
+                    self.parse_error("identifier list isn't formatted correctly")
                 identifiers.append(name.lexeme)
         return identifiers
 
 
     def parse_cls(self):
-        _, ident, _, _, _ = self.parse(TokenType.CLASS,TokenType.IDENTIFIER,TokenType.LSBRAC,TokenType.NEWLINE,TokenType.FIELDS)
+        self.expect(TokenType.CLASS)
+        ident = self.expect(TokenType.IDENTIFIER).lexeme
+        self.expect(TokenType.LSBRAC)
+        self.expect(TokenType.NEWLINE)
+        self.expect(TokenType.FIELDS)
         field_names = self.parse_identifier_list()
-        self.parse(TokenType.NEWLINE)
-        mths_nested = self.parse_until(TokenType.RSBRAC,Method) # parse_until returns list-of-lists (one list per typeset entry)
-        methods = mths_nested[0]
+        self.expect(TokenType.NEWLINE)
+        methods = []
+        while self.t.peek_type() is not TokenType.RSBRAC:
+            methods.append(self.parse_mthd())
+        self.get_next()
         return Class(ident,field_names,methods)
 
 
     def parse_mthd(self):
-        mth, ident, _ = self.parse(TokenType.METHOD,TokenType.IDENTIFIER,TokenType.LPAREN)
+        self.expect(TokenType.METHOD)
+        ident = self.expect(TokenType.IDENTIFIER).lexeme
+        self.expect(TokenType.LPAREN)
         arg_names = self.parse_identifier_list()
-        _, _, _ = self.parse(TokenType.RPAREN,TokenType.WITH,TokenType.LOCALS)
+        self.expect(TokenType.RPAREN)
+        self.expect(TokenType.WITH)
+        self.expect(TokenType.LOCALS)
         local_names = self.parse_identifier_list()
-        _, _, s, _ = self.parse(TokenType.COLON,TokenType.NEWLINE,Statement,TokenType.NEWLINE)
-        ss, _ = self.parse_until([TokenType.METHOD,TokenType.RSBRAC],Statement,TokenType.NEWLINE,grab_trail=False)
-
-        return Method(ident,arg_names,local_names,[s,*ss])
-
-    def parse_program(self):
+        self.expect(TokenType.COLON)
+        self.expect(TokenType.NEWLINE)
+        if self.lazy:
+            # a body runs up to the next method or the end of the class, neither of which can appear inside it
+            start, line = self.t.pos, self.line_number
+            self.line_number += self.t.skip_until(METHOD_BODY_END)
+            return Method.lazy(ident,arg_names,local_names,partial(self.parse_body_at,start,line))
+        return Method(ident,arg_names,local_names,self.parse_body())
+
+    def parse_body(self) -> list[Statement]:
+        # the statements of a method
+        stmts = [self.parse_stmt()]
+        self.expect(TokenType.NEWLINE)
+        while (typ := self.t.peek_type()) is not TokenType.METHOD and typ is not TokenType.RSBRAC:
+            stmts.append(self.parse_stmt())
+            self.expect(TokenType.NEWLINE)
+        return stmts
+
+    def parse_body_at(self,start:int,line_number:int) -> list[Statement]:
+        # parse_body on the method body skipped by a lazy parse, at token start on line line_number
+        pos, self.t.pos = self.t.pos, start
+        line_number, self.line_number = self.line_number, line_number
+        try:
+            return self.parse_body()
+        finally:
+            self.t.pos = pos
+            self.line_number = line_number
+
+    def parse_program(self,jobs:int=1):
+        # With jobs > 1 the classes are parsed in that many worker processes while this one parses main
         cls = []
-        if self.t.peek().type != TokenType.MAIN:
-            cls, _ = self.parse_until(TokenType.NEWLINE,Class,TokenType.NEWLINE)
-        _, _ = self.parse(TokenType.MAIN,TokenType.WITH)
+        if self.t.peek_type() is not TokenType.MAIN:
+            if jobs > 1:
+                return self.parse_program_parallel(jobs)
+            while self.t.peek_type() is not TokenType.NEWLINE:
+                cls.append(self.parse_cls())
+                self.expect(TokenType.NEWLINE)
+            self.get_next()
+        locs, stmts = self.parse_main()
+        return Program(cls,locs,stmts,self.t.symbols)
+
+    def parse_program_parallel(self,jobs:int):
+        # Class declarations are independent and run from class to the first ], so their boundaries are found by
+        # scanning the token types, and the source of each is sent to the pool in batches
+        # Each worker has a copy of the symbol table (every identifier is interned by lexing the whole input first),
+        # so the classes come back pickled with symbols as ids into it
+        if not isinstance(self.t, Tokenizer):
+            raise ValueError("Parallel parsing needs a Tokenizer")
+        self.t.lex_all()
+        src, starts, ends = self.t.s, self.t.toks.starts, self.t.toks.ends
+        decls = []
+        while self.t.peek_type() is not TokenType.NEWLINE:
+            if self.t.peek_type() is not TokenType.CLASS:
+                tok = self.get_next()
+                self.parse_error(f"Expected a token of type: {TokenType.CLASS}, instead got {tok.lexeme} of type {tok.type}")
+            start, line = self.t.pos, self.line_number
+            self.line_number += self.t.skip_until(CLASS_END)
+            self.expect(TokenType.RSBRAC)
+            decls.append((src[starts[start]:ends[self.t.pos-1]], line))
+            self.expect(TokenType.NEWLINE)
+        self.get_next()
+        if not decls:
+            locs, stmts = self.parse_main()
+            return Program([],locs,stmts,self.t.symbols)
+
+        batch = max(1, -(-len(decls) // (4 * jobs)))
+        with ProcessPoolExecutor(jobs, initializer=init_parse_worker, initargs=(self.t.symbols.names,)) as pool:
+            parsed = pool.map(parse_classes, [decls[i:i+batch] for i in range(0, len(decls), batch)])
+            locs, stmts = self.parse_main()
+            cls = [c for classes in parsed for c in SymbolUnpickler(io.BytesIO(classes), self.t.symbols).load()]
+        return Program(cls,locs,stmts,self.t.symbols)
+
+    def parse_main(self):
+        # the main declaration after the classes, returns its locals and statements
+        self.expect(TokenType.MAIN)
+        self.expect(TokenType.WITH)
         locs = self.parse_identifier_list()
-        _ = self.parse(TokenType.COLON)
+        self.expect(TokenType.COLON)
 
         stmts=[]
-        while self.t.peek() is not None:
-            nl = self.t.get_next()
-            if nl.type != TokenType.NEWLINE:
+        while self.t.peek_type() is not None:
+            nl = self.get_next()
+            if nl.type is not TokenType.NEWLINE:
                 self.parse_error("No newlines between statements in program entry point (main)")
-            if self.t.peek() is None:
+            if self.t.peek_type() is None:
                 break
 
             stmt = self.parse_stmt()
             stmts.append(stmt)
-        return Program(cls,locs,stmts)
+        return locs, stmts
+
+
+class SymbolPickler(pickle.Pickler):
+    # Pickles Symbols by their id, for unpickling with a SymbolUnpickler against the same table
+    # Symbols with ids from known on have been interned since the tables were copied and are pickled by name
+    def __init__(self,f,known:int):
+        super().__init__(f)
+        self.known = known
+
+    def persistent_id(self,obj):
+        if type(obj) is Symbol:
+            return obj.id if obj.id < self.known else str(obj)
+        return None
+
+class SymbolUnpickler(pickle.Unpickler):
+    def __init__(self,f,symbols:SymbolTable):
+        super().__init__(f)
+        self.symbols = symbols
+
+    def persistent_load(self,pid):
+        return self.symbols[pid] if type(pid) is int else self.symbols.intern(pid)
+
+worker_symbols = None  # a parse worker process's copy of the symbol table
+
+def init_parse_worker(names:list[str]):
+    global worker_symbols
+    worker_symbols = SymbolTable()
+    for name in names:
+        worker_symbols.intern(name)
+
+def parse_classes(decls:list[tuple[str,int]]) -> bytes:
+    # Parse class declarations given as (source, line it starts on) in a worker, returned pickled by SymbolPickler
+    known = len(worker_symbols)
+    classes = []
+    for src, line in decls:
+        p = Parser(Tokenizer(src, worker_symbols))
+        p.line_number = line
+        classes.append(p.parse_cls())
+    f = io.BytesIO()
+    SymbolPickler(f, known).dump(classes)
+    return f.getvalue()
+
+
+COMPILER_VERSION = "1"  # bump whenever the token stream or AST changes shape, so old cache entries are ignored
+
+class ParseCache:
+    # On-disk cache of the token stream and AST for a source, keyed by the hash of its contents and the compiler
+    # version, evicting the least recently used entries (by mtime, touched on every hit) past max_bytes
+    # Hit and miss counts are kept in a stats file alongside the entries, totalled over every run
+    # Entries are pickles, and unpickling runs code, so the directory is created private to the user (0o700) and
+    # nothing is loaded from one anyone else can write to; each entry starts with a header line giving the compiler
+    # version, its key and the sha256 of the pickle after it, checked before it's unpickled
+    def __init__(self,path:str=None,max_bytes:int=64<<20):
+        self.path = path or os.environ.get("MINIPYTHON_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "minipython"))
+        self.max_bytes = max_bytes
+        self.hits, self.misses = self.read_stats()
+
+    def key(self,src:bytes) -> str:
+        return hashlib.sha256(COMPILER_VERSION.encode() + b"\0" + src).hexdigest()
+
+    def entry(self,key:str) -> str:
+        return os.path.join(self.path, key + ".ast")
+
+    def load(self,src:bytes):
+        # The (Tokenizer, Program) cached for src, None on a miss
+        # An entry whose header doesn't match (damaged, or written by another version) is dropped
+        key = self.key(src)
+        entry = self.entry(key)
+        try:
+            if not self.private():
+                raise PermissionError(f"{self.path} can be written to by other users")
+            with open(entry, "rb") as f:
+                header, payload = f.readline(), f.read()
+            if header != self.header(key, payload):
+                os.remove(entry)
+                raise pickle.UnpicklingError(f"{entry} has a bad header")
+            names, columns, tree = pickle.loads(payload)
+            os.utime(entry)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            self.write_stats()
+            return None
+        self.hits += 1
+        self.write_stats()
+
+        t = Tokenizer(src.decode())
+        for name in names:
+            t.symbols.intern(name)
+        for col, data in zip((t.toks.types, t.toks.starts, t.toks.ends, t.toks.syms), columns):
+            col.frombytes(data)
+        t.i = len(t.s)
+        cls, locs, stmts = SymbolUnpickler(io.BytesIO(tree), t.symbols).load()
+        return t, Program(cls, locs, stmts, t.symbols)
+
+    def header(self,key:str,payload:bytes) -> bytes:
+        return f"minipython {COMPILER_VERSION} {key} {hashlib.sha256(payload).hexdigest()}\n".encode()
+
+    def private(self) -> bool:
+        # whether the directory belongs to this user and no one else can write to it
+        st = os.stat(self.path)
+        return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+    def make_dir(self):
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+
+    def store(self,src:bytes,t:Tokenizer,prog:Program):
+        # Cache the fully lexed t and prog parsed from it for src
+        if any(isinstance(m, Method) and not m.parsed() for c in prog.classes for m in c.methods):
+            raise ValueError("Can't cache a lazily parsed program")
+        f = io.BytesIO()
+        SymbolPickler(f, len(t.symbols)).dump((prog.classes, prog.local_vars, prog.statements))
+        columns = [col.tobytes() for col in (t.toks.types, t.toks.starts, t.toks.ends, t.toks.syms)]
+        record = ([str(name) for name in t.symbols.names], columns, f.getvalue())
+
+        self.make_dir()
+        key = self.key(src)
+        entry = self.entry(key)
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        tmp = f"{entry}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.header(key, payload))
+            f.write(payload)
+        os.replace(tmp, entry)  # atomic, so concurrent runs never see half an entry
+        self.evict()
+
+    def entries(self) -> list[os.DirEntry]:
+        try:
+            return [e for e in os.scandir(self.path) if e.name.endswith(".ast")]
+        except FileNotFoundError:
+            return []
+
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda e: e.stat().st_mtime)
+        total = sum(e.stat().st_size for e in entries)
+        for e in entries:
+            if total <= self.max_bytes:
+                break
+            total -= e.stat().st_size
+            os.remove(e.path)
+
+    def clear(self):
+        for e in self.entries():
+            os.remove(e.path)
+        self.hits = self.misses = 0
+        self.write_stats()
+
+    def read_stats(self) -> tuple[int,int]:
+        try:
+            with open(os.path.join(self.path, "stats")) as f:
+                hits, misses = map(int, f.read().split())
+            return hits, misses
+        except (OSError, ValueError):
+            return 0, 0
+
+    def write_stats(self):
+        self.make_dir()
+        with open(os.path.join(self.path, "stats"), "w") as f:
+            f.write(f"{self.hits} {self.misses}\n")
 
 
 
@@ -722,12 +3411,11 @@ class Parser:
 # convert to ir_context for purpose of uniform interface
 # to string methods
 # map field names to new name as we go through
-# Peephole optimization
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="MiniPython Compiler")
-    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group = parser.add_mutually_exclusive_group()
 
     input_group.add_argument("-f","--file")
     input_group.add_argument("-s","--str","--string")
@@ -738,21 +3426,70 @@ if __name__ == "__main__":
     stage_group.add_argument("-a","--ast",action='store_true')
     stage_group.add_argument("-c","--cfg","--noopt",action='store_true')
     stage_group.add_argument("-o","--opt","--optimize","--optimization",action='store_true')
+    parser.add_argument("-j","--jobs",type=int,default=1,help="processes to parse classes with")
+    parser.add_argument("--no-cache",action='store_true',help="always lex and parse files, without the parse cache")
+    parser.add_argument("--clear-cache",action='store_true',help="empty the parse cache")
+    parser.add_argument("--cache-stats",action='store_true',help="print the parse cache's hit and miss counts")
+    parser.add_argument("--report",action='store_true',help="print what each optimization pass did to each function")
+    parser.add_argument("--compact-tables",action='store_true',
+                        help="give names only the vtable and field map slots their classes need, by selector coloring")
     args = parser.parse_args()
 
-    if args.file:
+    cache = None if args.no_cache else ParseCache()
+    if args.clear_cache:
+        (cache or ParseCache()).clear()
+    if not (args.file or args.str):
+        if not args.clear_cache:
+            parser.error("one of the arguments -f/--file -s/--str/--string is required")
+        sys.exit()
+
+    prog = None
+    if args.file and cache is not None and (args.ast or args.cfg or args.opt):
+        # whole programs from files go through the cache, which needs the source in full to hash it
+        with open(args.file, "rb") as f:
+            src = f.read()
+        hit = cache.load(src)
+        if hit is not None:
+            t, prog = hit
+        else:
+            t = Tokenizer(src.decode())
+            prog = Parser(t).parse_program(jobs=args.jobs)
+            cache.store(src, t, prog)
+    elif args.file and (args.jobs > 1 or args.tokenize or args.parse):
+        # parallel parsing splits the token stream up front, and -t/-p print it in full, so they need it all
         with open(args.file) as f:
-            inp = f.read()
+            t = Tokenizer(f.read())
+    elif args.file:
+        # stream the file through the tokenizer rather than reading it into memory up front
+        t = StreamTokenizer(open_source(args.file))
     elif args.str:
-        inp = args.str
+        t = Tokenizer(args.str)
 
     if args.tokenize or args.parse:
-        t = Tokenizer(inp)
-        toks = t.tokenize()
-        print(toks)
+        print(t.tokenize())
 
     if args.parse:
         p = Parser(t)
         parse_tree = p.parse_expr()
         print(parse_tree)
         # use objgraph
+
+    if args.ast:
+        print(prog or Parser(t).parse_program(jobs=args.jobs))
+
+    if args.cfg:
+        print((prog or Parser(t).parse_program(jobs=args.jobs)).to_ir_program(args.compact_tables))
+
+    if args.opt:
+        ir = (prog or Parser(t).parse_program(jobs=args.jobs)).to_ir_program(args.compact_tables)
+        report = optimize(ir)
+        print(ir)
+        if args.report:
+            for name, (dense, size) in ir.table_sizes().items():
+                print(f"tables: {name}: {dense} words dense, {size} as laid out", file=sys.stderr)
+            for name, functions in report.items():
+                for f, counts in functions.items():
+                    print(f"{name}: {f}: {', '.join(f'{n} {what}' for what, n in counts.items())}", file=sys.stderr)
+
+    if args.cache_stats and cache is not None:
+        print(f"parse cache: {cache.hits} hits, {cache.misses} misses", file=sys.stderr)
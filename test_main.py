@@ -1,4 +1,6 @@
 from main import *
+import io
+from contextlib import nullcontext
 import time
 import pytest
 
@@ -555,3 +557,702 @@ def test_cfg_of_paren_exprs_and_assign():
     assert isinstance(final_assign.val.r, IRVar) and final_assign.val.r.reg == "tmp0"
     assert isinstance(final_assign.val.l, IRConst) and final_assign.val.l.n == 5
 
+
+def test_tokenize_large_input():
+    # tokenizing walks a cursor over the source, so repeating a program just repeats its tokens
+    single = Tokenizer(simple_stack).tokenize()
+    toks = Tokenizer(simple_stack * 200).tokenize()
+    assert len(toks) == 200 * len(single)
+    assert [(t.type, t.lexeme) for t in toks[-len(single):]] == [(t.type, t.lexeme) for t in single]
+
+def test_tokenize_operators_and_keywords():
+    toks = Tokenizer("x==!y != ifonly iffy\n=").tokenize()
+    assert [t.type for t in toks] == [TokenType.IDENTIFIER, TokenType.DEQUAL, TokenType.EXCLAM, TokenType.IDENTIFIER, TokenType.NEQUAL,
+                                      TokenType.IFONLY, TokenType.IDENTIFIER, TokenType.NEWLINE, TokenType.EQUAL]
+    assert toks[6].lexeme == "iffy"
+
+    with pytest.raises(ValueError):
+        Tokenizer("x = $").tokenize()
+
+def test_stream_tokenize():
+    # tiny chunks split numbers, identifiers, == and newlines across chunk boundaries
+    expected = [(t.type, t.lexeme) for t in Tokenizer(complex_stack).tokenize()]
+    for f in [io.StringIO(complex_stack), io.BytesIO(complex_stack.encode())]:
+        t = StreamTokenizer(f, chunk_size=3)
+        assert [(tok.type, tok.lexeme) for tok in t] == expected
+
+    t = StreamTokenizer(io.StringIO("(1 + 22)"), chunk_size=2)
+    assert t.peek().type == TokenType.LPAREN and t.peek().type == TokenType.LPAREN
+    with pytest.raises(IndexError):
+        t.peek(1)
+    tree = Parser(t).parse_expr()
+    assert isinstance(tree, ParenExpression) and tree.right.num == 22
+    assert t.get_next() is None
+
+def test_stream_tokenize_mmap(tmp_path):
+    path = tmp_path / "prog.mp"
+    path.write_text(simple_stack)
+    tree = Parser(StreamTokenizer(open_source(path), chunk_size=16)).parse_program()
+    assert tree == Parser(Tokenizer(simple_stack)).parse_program()
+
+    path.write_text("")
+    assert StreamTokenizer(open_source(path)).get_next() is None
+
+def test_token_stream_columns():
+    src = "x = (42 + y)\nwhile"
+    toks = Tokenizer(src).tokenize()
+    assert isinstance(toks, TokenStream) and len(toks) == 9
+    assert toks.type(3) == TokenType.NUMBER and toks.lexeme(3) == "42"
+    assert (toks.starts[3], toks.ends[3]) == (5, 7)
+    assert toks[0].type == TokenType.IDENTIFIER and toks[0].lexeme == "x"
+    assert toks[-1].type == TokenType.WHILE and toks[-1].lexeme == "while"
+    assert [t.lexeme for t in toks[2:5]] == ["(", "42", "+"]
+
+def test_symbols_interned():
+    tree = Parser(Tokenizer(simple_stack)).parse_program()
+    stack = tree.classes[1]
+    push, pop = stack.methods
+    assert stack.fields == ["list"] and tree.classes[0].fields == ["val", "next"]
+    assert isinstance(push.args[0], Symbol) and push.args[0] == "v"
+    # the same name is the same object everywhere it appears
+    assert push.local_vars[0] is pop.local_vars[0] is push.statements[0].var_name
+    assert tree.symbols[push.local_vars[0].id] is push.local_vars[0]
+
+    prog = tree.to_ir_tables()
+    assert prog.field_name_to_map_index == {"val": 0, "next": 1, "list": 2}
+    assert prog.field_slot(stack.fields[0]) == 2 and prog.field_slot("next") == 1 and prog.field_slot("nope") is None
+    assert prog.method_slot(pop.method_name) == 3
+    assert [f.n for f in prog.field_maps[0].vals] == [2, 3, 0] and [f.n for f in prog.field_maps[1].vals] == [0, 0, 2]
+    assert prog.vtbls[1].vals[2:] == ["Stackpush", "Stackpop"] and prog.vtbls[0].vals[:2] == ["ListNodegetNext", "ListNodegetVal"]
+
+def test_tokenize_edit():
+    import random
+    rng = random.Random(441)
+    t = Tokenizer(complex_stack)
+    t.tokenize()
+    for inserted in ["x", " ", "\n", "=", "==", "9", "", "(3 + y)", "if", "x = !"]:
+        for _ in range(20):
+            offset = rng.randrange(len(t.s) + 1)
+            deleted = rng.randrange(min(3, len(t.s) - offset) + 1)
+            first, old_end, new_end = t.edit(offset, deleted, inserted)
+            assert first <= old_end and first <= new_end
+            expected = Tokenizer(t.s).tokenize()
+            assert [(tok.type, tok.lexeme) for tok in t.toks] == [(tok.type, tok.lexeme) for tok in expected]
+            assert list(t.toks.starts) == list(expected.starts) and list(t.toks.ends) == list(expected.ends)
+
+    # an edit in the middle of an identifier only re-lexes that identifier
+    t = Tokenizer("abc = de + fgh")
+    assert t.edit(6, 1, "xyz") == (2, 3, 3) and t.toks[2].lexeme == "xyze"
+
+def test_parse_error_line_number():
+    with pytest.raises(SyntaxError, match="line: 3"):
+        Parser(Tokenizer("main with x:\nx = 1\nx = (1 + )\n")).parse_program()
+    with pytest.raises(SyntaxError, match="end of file"):
+        Parser(Tokenizer("(1 + ")).parse_expr()
+
+def test_deeply_nested_expr():
+    depth = 100_000
+    stmt = Parser(Tokenizer("x = " + "(" * depth + "a" + " + b)" * depth)).parse_stmt()
+    prog = IRProgram([],[],{})
+    prog.add_block("foo")
+    stmt.to_ir(prog)
+    stmts = prog.curr_block.statements
+    assert len(stmts) == depth
+    assert stmts[0] == IRAssign(IRVar("tmp0"), IROperation(IRVar("a"), "+", IRVar("b")))
+    assert stmts[-1] == IRAssign(IRVar("x"), IROperation(IRVar(f"tmp{depth - 2}"), "+", IRVar("b")))
+
+    prog = Parser(Tokenizer(first_example)).parse_program().to_ir_tables()
+    prog.add_block("main")
+    depth = 10_000
+    expr = Parser(Tokenizer("^" * depth + "&x.x" + ".m()" * depth)).parse_expr()
+    assert isinstance(expr.expr.expr, MethodExpression)
+    assert isinstance(expr.to_ir(prog), IRCall)
+    # each call or field read checks its receiver is a pointer and that it has the method/field
+    assert len(prog.blocks) == 2 * (depth + 1) + 4
+
+def test_lower_field_read_and_call():
+    prog = Parser(Tokenizer(first_example)).parse_program().to_ir_tables()
+    prog.add_block("main")
+    val = Parser(Tokenizer("&@A.x")).parse_expr().to_ir(prog)
+    entry, fail_ptr, ok_ptr, fail_field, ok_field = prog.blocks
+    assert entry.statements == [IRAssign(IRVar("tmp0"), IRAlloc(IRConst(3))),
+                                IRStore(IRVar("tmp0"), prog.vtbls[0]),
+                                IRSetELT(IRVar("tmp0"), IRConst(1), prog.field_maps[0]),
+                                IRAssign(IRVar("tmp1"), IROp(IRVar("tmp0"), "&", IRConst(1)))]
+    assert entry.ctl_trans == IRIf(IRVar("tmp1"), fail_ptr.name, ok_ptr.name) and fail_ptr.ctl_trans == IRFail("NotAPointer")
+    assert ok_ptr.statements == [IRAssign(IRVar("tmp2"), IRGetELT(IRVar("tmp0"), IRConst(1))),
+                                 IRAssign(IRVar("tmp3"), IRGetELT(IRVar("tmp2"), IRConst(0)))]
+    assert ok_ptr.ctl_trans == IRIf(IRVar("tmp3"), ok_field.name, fail_field.name) and fail_field.ctl_trans == IRFail("NoSuchField")
+    assert val == IRGetELT(IRVar("tmp0"), IRVar("tmp3")) and prog.curr_block is ok_field
+
+    val = Parser(Tokenizer("^this.m(1, (2 * 3))")).parse_expr().to_ir(prog)
+    assert val == IRCall(IRVar("tmp7"), IRVar("this"), [IRConst(1), IRVar("tmp4")])
+    assert len(prog.blocks) == 8  # the failure blocks are shared
+
+def test_lazy_method_bodies():
+    for prg in [nothing, first_example, simple_stack, complex_stack]:
+        assert Parser(Tokenizer(prg), lazy=True).parse_program() == Parser(Tokenizer(prg)).parse_program()
+
+    tree = Parser(Tokenizer(complex_stack), lazy=True).parse_program()
+    do = tree.classes[2].methods[0]
+    assert not do.parsed()
+    assert tree.to_ir_tables().method_slot("do") == 4  # class shapes don't need the bodies
+    assert not do.parsed()
+    assert isinstance(do.statements[1], WhileStatement) and do.statements[1].statements[1].var_name == "x"
+    assert do.parsed()
+
+    # errors in a body surface when it's parsed, with the right line
+    tree = Parser(Tokenizer("class A [\nfields\nmethod m() with locals:\nreturn 0\nx = (1 +)\n]\n\nmain with:"), lazy=True).parse_program()
+    with pytest.raises(SyntaxError, match="line: 5"):
+        tree.classes[0].methods[0].statements
+
+    with pytest.raises(ValueError):
+        Parser(StreamTokenizer(io.StringIO(nothing)), lazy=True)
+
+def test_ast_nodes_are_slotted():
+    tree = Parser(Tokenizer(first_example)).parse_program()
+    for node in [tree, tree.classes[0], tree.classes[0].methods[0], *tree.statements, tree.statements[0].val]:
+        assert not hasattr(node, "__dict__")
+
+def test_parse_program_parallel():
+    for prg in [optimal, first_example, complex_stack, "class A [\nfields\n]\n\nmain with:"]:
+        tree = Parser(Tokenizer(prg)).parse_program(jobs=2)
+        assert tree == Parser(Tokenizer(prg)).parse_program()
+    # symbols come back as the parent's own Symbol objects
+    tree = Parser(Tokenizer(complex_stack)).parse_program(jobs=2)
+    stack = tree.classes[1]
+    assert stack.fields[0] is tree.symbols.intern("list") and stack.methods[1].statements[0].condition.left.field_name is stack.fields[0]
+    assert stack.methods[0].statements[1].class_name is tree.symbols.intern("tmp")
+
+    # no classes to hand out, so no pool either
+    src = "\nmain with x:\nprint(1)"
+    assert Parser(Tokenizer(src)).parse_program(jobs=2) == Parser(Tokenizer(src)).parse_program()
+
+    src = "class A [\nfields\nmethod m() with locals:\nreturn 0\n]\nclass B [\nfields\nmethod m() with locals:\nreturn (1 +)\n]\n\nmain with:"
+    with pytest.raises(SyntaxError, match="line: 9"):
+        Parser(Tokenizer(src)).parse_program(jobs=2)
+
+def test_parse_cache(tmp_path):
+    cache = ParseCache(str(tmp_path))
+    src = complex_stack.encode()
+    assert cache.load(src) is None
+    t = Tokenizer(complex_stack)
+    tree = Parser(t).parse_program()
+    cache.store(src, t, tree)
+
+    cached_t, cached = cache.load(src)
+    assert cached == tree and repr(cached) == repr(tree)
+    assert [(tok.type, tok.lexeme) for tok in cached_t.toks] == [(tok.type, tok.lexeme) for tok in t.toks]
+    assert cached.classes[1].fields[0] is cached.symbols.intern("list")
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert ParseCache(str(tmp_path)).hits == 1  # counts persist across runs
+
+    # the least recently used entry goes first once over the size bound
+    cache.max_bytes = os.path.getsize(cache.entry(cache.key(src))) * 2
+    for prg in [simple_stack, optimal]:
+        t = Tokenizer(prg)
+        cache.store(prg.encode(), t, Parser(t).parse_program())
+        time.sleep(0.01)
+    assert cache.load(src) is None and cache.load(optimal.encode()) is not None
+
+    # an entry whose header doesn't check out is a miss, never unpickled, and gets rebuilt
+    cache.max_bytes = 64 << 20
+    t = Tokenizer(complex_stack)
+    cache.store(src, t, Parser(t).parse_program())
+    entry = cache.entry(cache.key(src))
+    with open(entry, "rb") as f:
+        header, payload = f.readline(), f.read()
+    tampered = header + payload[:-1] + b"\0"
+    for damaged in [b"not a pickle", pickle.dumps(None), tampered, header.replace(b"minipython", b"other") + payload]:
+        with open(entry, "wb") as f:
+            f.write(damaged)
+        misses = cache.misses
+        assert cache.load(src) is None and cache.misses == misses + 1 and not os.path.exists(entry)
+        t = Tokenizer(complex_stack)
+        cache.store(src, t, Parser(t).parse_program())
+        assert cache.load(src)[1] == tree
+
+    # nothing is loaded from a directory others can write to
+    assert os.stat(cache.path).st_mode & 0o777 == 0o700 or not os.stat(cache.path).st_mode & 0o022
+    os.chmod(cache.path, 0o777)
+    assert cache.load(src) is None and os.path.exists(entry)
+    os.chmod(cache.path, 0o700)
+    assert cache.load(src) is not None
+
+    cache.clear()
+    assert cache.entries() == [] and (cache.hits, cache.misses) == (0, 0)
+
+def working(prg):
+    # the stack examples call getVal and getNext on the Stack rather than its list, so fail at run time
+    return prg.replace("^this.getVal()", "^&this.list.getVal()").replace("^this.getNext()", "^&this.list.getNext()")
+
+def run(prg):
+    return IRInterpreter(Parser(Tokenizer(prg)).parse_program().to_ir_program()).run()
+
+def test_lower_program():
+    assert run(first_example) == [3]
+    assert run(optimal) == [9, 9]
+    assert run(nothing) == []
+    assert run(working(simple_stack)) == [9, 5, 3, 1, 0]
+    assert run(working(complex_stack)) == list(range(1, 21))
+    with pytest.raises(RuntimeError, match="NoSuchMethod"):
+        run(simple_stack)
+
+    prog = Parser(Tokenizer(nothing)).parse_program().to_ir_program()
+    assert prog.functions == {"FoodoStuff": ["this", "x", "y", "z"], "main": []}
+    entry = prog.blocks[0]
+    assert entry.name == "FoodoStuff" and entry.statements[0] == IRAssign(IRVar("r"), IRConst(0))
+    assert entry.ctl_trans == IRIf(IRVar("tmp0"), "l0", "l1") and entry.statements[-1] == IRAssign(IRVar("tmp0"), IROperation(IRVar("x"), "<", IRVar("y")))
+    # every block ends in a control transfer, falling off the end returning 0
+    assert all(b.ctl_trans is not None for b in prog.blocks) and prog.blocks[-1].ctl_trans == IRRet(IRConst(0))
+    assert "FoodoStuff(this, x, y, z):\n    %r = 0" in str(prog)
+
+def test_packed_ir():
+    for prg in [first_example, working(simple_stack), working(complex_stack), optimal, nothing]:
+        prog = Parser(Tokenizer(prg)).parse_program().to_ir_program()
+        packed = PackedProgram.from_ir(prog)
+        assert packed.to_ir() == prog
+
+    prog = Parser(Tokenizer(first_example)).parse_program().to_ir_program()
+    packed = PackedProgram.from_ir(prog)
+    assert IRInterpreter(packed.to_ir()).run() == [3]
+    main = packed.block_index["main"]
+    insts = list(packed.instructions(main))
+    assert insts[0] == (IROpcode.MOV, array("i", [packed.operand(IRVar("x")), packed.operand(IRConst(0))]))
+    assert insts[1][0] is IROpcode.ALLOC and insts[-1][0] is IROpcode.IF
+    assert packed.value(insts[2][1][1]) is prog.vtbls[0]  # the store of A's vtable into the new object
+
+    # dead code elimination on the packed form: z's zeroing goes, but not the division by 0 that needs x and y
+    prog = Parser(Tokenizer("main with x, y, z:\n    x = (y * 2)\n    z = (x / 0)\n    y = 3\n    print(y)")).parse_program().to_ir_program()
+    packed = PackedProgram.from_ir(prog)
+    assert packed.dce() == {"main": {"instructions": 1}}
+    assert [str(s) for s in packed.to_ir().get_block("main").statements] == ["%x = 0", "%y = 0", "%x = %y * 2", "%z = %x / 0",
+                                                                            "%y = 3", "print(%y)"]
+    for prg in [first_example, working(simple_stack), working(complex_stack), optimal, nothing]:
+        prog = Parser(Tokenizer(prg)).parse_program().to_ir_program()
+        packed = PackedProgram.from_ir(prog)
+        packed.dce()
+        assert IRInterpreter(packed.to_ir()).run() == run(prg)
+
+def test_cfg_index():
+    prog = Parser(Tokenizer(complex_stack)).parse_program().to_ir_program()
+    for b in prog.blocks:
+        assert prog.get_block(b.name) is b and prog.blocks_by_id[b.id] is b
+        assert [s.name for s in prog.succs(b)] == successors(b.ctl_trans)
+        assert all(b in prog.succs(p) for p in prog.preds(b))
+
+    do = prog.function_blocks("Stackerdo")
+    assert do[0].name == "Stackerdo" and all(b.name not in prog.functions for b in do[1:])
+    # the first loop's head comes before everything after it
+    head = prog.get_block(do[0].ctl_trans.b)
+    assert len(prog.preds(head)) == 2
+    order = prog.rpo("Stackerdo")
+    assert order.index(head.id) == 1 and min(order.index(prog.block_ids[b]) for b in successors(head.ctl_trans)) > 1
+
+    # the index follows changes to control transfers and blocks
+    body = prog.get_block(head.ctl_trans.b_true)
+    prog.set_ctl_trans(head, IRJump(head.ctl_trans.b_false))
+    assert body not in prog.succs(head) and prog.rpo("Stackerdo") is not order
+    with pytest.raises(ValueError):
+        prog.remove_blocks({prog.block_ids[head.ctl_trans.b]})
+    dead = {b.id for b in do if b.id not in prog.rpo("Stackerdo")}
+    prog.remove_blocks(dead)
+    assert body.name not in prog.block_map and body not in prog.blocks and prog.preds(head) == [do[0]]
+
+def test_ssa():
+    for prg in [first_example, working(simple_stack), working(complex_stack), optimal, nothing]:
+        prog = Parser(Tokenizer(prg)).parse_program().to_ir_program()
+        expected = IRInterpreter(prog).run()
+        to_ssa(prog)
+        for f in prog.functions:
+            assigned = [s.v.reg for b in prog.function_blocks(f) for s in b.statements if type(s) is IRAssign]
+            assert len(assigned) == len(set(assigned))
+        assert IRInterpreter(prog).run() == expected
+        from_ssa(prog)
+        assert not any(phis(b) for b in prog.blocks) and IRInterpreter(prog).run() == expected
+
+    prog = Parser(Tokenizer(working(complex_stack))).parse_program().to_ir_program()
+    to_ssa(prog)
+    entry = prog.get_block("Stackerdo")
+    head = prog.get_block(entry.ctl_trans.b)
+    # only x needs a phi at the first loop's head, v isn't live there and the temps are assigned once
+    assert [str(phi) for phi in phis(head)] == [f"%x.3 = phi(Stackerdo, %x.2, {head.statements[0].val.block_names[1]}, %x.4)"]
+    dom = Dominators(prog, "Stackerdo")
+    assert dom.idom[dom.pos[head.id]] == 0 and all(dom.dominates(0, b) for b in range(len(dom.order)))
+    # in nothing, r is only live after the if, so it gets a phi there but not at the branches
+    prog = Parser(Tokenizer(nothing)).parse_program().to_ir_program()
+    to_ssa(prog)
+    assert [len(phis(b)) for b in prog.function_blocks("FoodoStuff")] == [0, 0, 0, 1]
+
+    # a parameter assigned in the body is renamed there, the uses before that keep the argument
+    reassigned = """class A [
+    fields
+    method m(p) with locals:
+        p = (p + 1)
+        ifonly (p == 2): {
+            print(5)
+        }
+        return p
+]
+
+main with a:
+    a = @A
+    print(^a.m(1))"""
+    prog = Parser(Tokenizer(reassigned)).parse_program().to_ir_program()
+    to_ssa(prog)
+    assert [str(s) for s in prog.get_block("Am").statements] == ["%p.1 = %p + 1", "%tmp0 = %p.1 == 2"]
+    assert IRInterpreter(prog).run() == [5, 2]
+    prog = Parser(Tokenizer(reassigned)).parse_program().to_ir_program()
+    optimize(prog)
+    assert IRInterpreter(prog).run() == [5, 2]
+
+def test_gvn():
+    for prg in [first_example, working(simple_stack), working(complex_stack), optimal, nothing, simple_stack]:
+        prog = Parser(Tokenizer(prg)).parse_program().to_ir_program()
+        expected = IRInterpreter(prog)
+        with pytest.raises(RuntimeError) if prg is simple_stack else nullcontext():
+            expected.run()
+        optimized = IRInterpreter(prog)
+        report = optimize(prog)["gvn"]
+        with pytest.raises(RuntimeError) if prg is simple_stack else nullcontext():
+            optimized.run()
+        assert optimized.output == expected.output and optimized.steps <= expected.steps
+
+    def count(prog, f, text):
+        return sum(str(s).count(text) for b in prog.function_blocks(f) for s in b.statements)
+
+    # stk is a fresh object in main, so none of its tag checks survive, and of the lookups only its vtable, field map,
+    # and the first of each method and field do
+    prog = Parser(Tokenizer(simple_stack)).parse_program().to_ir_program()
+    to_ssa(prog)
+    report = gvn(prog)
+    assert count(prog, "main", "& 1") == 0 and count(prog, "main", "load") == 1 and count(prog, "main", "getelt") == 4
+    assert report["main"]["blocks"] == 1 and "NotAPointer" not in str(prog.function_blocks("main"))
+
+    # the second loop is dominated by the check on stk before it, the first isn't
+    prog = Parser(Tokenizer(complex_stack)).parse_program().to_ir_program()
+    to_ssa(prog)
+    gvn(prog)
+    assert count(prog, "Stackerdo", "%stk & 1") == 2 and count(prog, "Stackerdo", "load(%stk)") == 2
+
+    # the sums in nothing don't dominate each other, so all stay
+    prog = Parser(Tokenizer(nothing)).parse_program().to_ir_program()
+    to_ssa(prog)
+    gvn(prog)
+    assert count(prog, "FoodoStuff", "%x + %y") == 3
+
+    # and optimal's (4 + 5)s are all the same value, which is a constant
+    prog = Parser(Tokenizer(optimal)).parse_program().to_ir_program()
+    to_ssa(prog)
+    gvn(prog)
+    assert prog.get_block("main").statements == [IRPrint(IRConst(9)), IRPrint(IRConst(9))]
+
+constants = """main with x, y, z:
+    x = 3
+    y = (x * 4)
+    if (y == 12): {
+        print(y)
+    } else {
+        print(0)
+    }
+    z = 1
+    while (x < 10): {
+        ifonly (z != 1): {
+            z = 2
+        }
+        x = (x + 1)
+    }
+    print(z)
+    print(x)
+"""
+
+def test_sccp():
+    prog = Parser(Tokenizer(constants)).parse_program().to_ir_program()
+    expected = IRInterpreter(prog).run()
+    to_ssa(prog)
+    report = sccp(prog)["main"]
+    assert IRInterpreter(prog).run() == expected == [12, 1, 10]
+    # the else and the ifonly in the loop are never taken (z can only stay 1 if it never changes), the loop itself is
+    assert report["branches"] == 2 and report["blocks"] == 2
+    text = "\n".join(str(b) for b in prog.function_blocks("main"))
+    assert "print(12)" in text and "print(1)" in text and "%z" not in text and "%x." in text
+
+    for prg in [first_example, working(simple_stack), working(complex_stack), optimal, nothing]:
+        prog = Parser(Tokenizer(prg)).parse_program().to_ir_program()
+        expected = IRInterpreter(prog).run()
+        to_ssa(prog)
+        sccp(prog)
+        assert IRInterpreter(prog).run() == expected
+
+    # out of SSA form, a variable assigned different constants ends up overdefined rather than changing forever
+    prog = Parser(Tokenizer("main with x, i:\n    while (i < 3): {\n        x = (x + 1)\n        i = (i + 1)\n    }\n"
+                            "    print(x)")).parse_program().to_ir_program()
+    assert sccp(prog)["main"]["constants"] == 0 and IRInterpreter(prog).run() == [3]
+
+def test_dce_and_cfg_cleanup():
+    prog = Parser(Tokenizer("main with x, y, z:\n    x = (y * 2)\n    z = (x + 1)\n    y = (z / 0)\n    x = (x / 2)\n    print(y)")).parse_program().to_ir_program()
+    to_ssa(prog)
+    # x and z's zeroing and the last x go, but not the division by 0
+    assert dce(prog)["main"]["instructions"] == 3
+    assert [str(s) for s in prog.get_block("main").statements] == ["%y.1 = 0", "%x.2 = %y.1 * 2", "%z.2 = %x.2 + 1",
+                                                                   "%y.2 = %z.2 / 0", "print(%y.2)"]
+
+    # the packed form's dce removes just the same
+    for prg in [first_example, working(simple_stack), working(complex_stack), optimal, nothing, constants]:
+        progs = [Parser(Tokenizer(prg)).parse_program().to_ir_program() for _ in range(2)]
+        for prog in progs:
+            to_ssa(prog)
+        packed = PackedProgram.from_ir(progs[1])
+        assert packed.dce() == dce(progs[0]) and str(packed.to_ir()) == str(progs[0])
+
+    for prg in [first_example, working(simple_stack), working(complex_stack), optimal, nothing, constants]:
+        prog = Parser(Tokenizer(prg)).parse_program().to_ir_program()
+        expected = IRInterpreter(prog).run()
+        report = optimize(prog)
+        assert IRInterpreter(prog).run() == expected
+        for f in prog.functions:
+            for b in prog.function_blocks(f):
+                # nothing left to thread through or merge
+                assert b.statements or type(b.ctl_trans) is not IRJump or b.name in prog.functions
+                if type(b.ctl_trans) is IRJump:
+                    assert len(prog.preds(prog.get_block(b.ctl_trans.b))) > 1 or b.ctl_trans.b in prog.functions
+        assert all(b.id in prog.rpo(f) for f in prog.functions for b in prog.function_blocks(f))
+        assert len(prog.blocks) == sum(len(prog.rpo(f)) for f in prog.functions)
+
+    prog = Parser(Tokenizer(working(simple_stack))).parse_program().to_ir_program()
+    report = optimize(prog)["cleanup"]["main"]
+    # main's calls were each followed by a block for the check gvn removed, and peephole resolved the rest (the
+    # tags, field and methods of the new object) so it's all one block
+    assert report["merged"] + report["threaded"] >= 10 and len(prog.function_blocks("main")) == 1
+
+def test_peephole():
+    prog = Parser(Tokenizer("class A [\n    fields\n    method m(y) with locals x, z:\n        x = (y + 0)\n"
+                            "        z = (x * 1)\n        print(z)\n        z = (x * 8)\n        print(z)\n"
+                            "        print((x - x))\n        print((2 * 3))\n        return 0\n]\n\nmain with a:\n"
+                            "    print(0)")).parse_program().to_ir_program()
+    report = peephole(prog)["Am"]
+    assert [str(s) for s in prog.get_block("Am").statements] == ["%x = 0", "%z = 0", "%x = %y", "%z = %y", "print(%y)",
+        "%z = %y << 3", "print(%z)", "%tmp0 = 0", "print(0)", "%tmp1 = 6", "print(6)"]
+    assert report["add_zero"] == report["same_operands"] == report["fold_constants"] == 1
+    assert report["multiply_by_constant"] == 2 and report["propagate_copy"] == 7
+
+    prog = Parser(Tokenizer(first_example)).parse_program().to_ir_program()
+    report = peephole(prog)["main"]
+    # the fresh object's tag, field map and vtable are all known, so are the offset of its field, its method and
+    # that it has both
+    assert report["pointer_tag"] == 2 and report["table_entry"] == 2 and report["constant_branch"] == 4
+    assert report["load_after_store"] == report["getelt_after_setelt"] == 1
+
+    for prg in [first_example, working(simple_stack), working(complex_stack), optimal, nothing, constants]:
+        prog = Parser(Tokenizer(prg)).parse_program().to_ir_program()
+        expected = IRInterpreter(prog).run()
+        peephole(prog)
+        assert IRInterpreter(prog).run() == expected
+        to_ssa(prog)
+        peephole(prog)
+        from_ssa(prog)
+        assert IRInterpreter(prog).run() == expected
+
+def test_licm():
+    prog = Parser(Tokenizer(working(complex_stack))).parse_program().to_ir_program()
+    dom = Dominators(prog, "Stackerdo")
+    loops = natural_loops(dom)
+    assert len(loops) == 2 and all(len(loop.latches) == 1 and dom.dominates(loop.header, loop.latches[0])
+                                   for loop in loops)
+
+    counter = """class Counter [
+    fields val, step
+    method sum(n) with locals i, s:
+        i = 0
+        s = 0
+        while (i < n): {
+            s = (s + (&this.step * 4))
+            i = (i + 1)
+        }
+        return s
+]
+
+main with c, x, y:
+    c = @Counter
+    !c.step = 3
+    print(^c.sum(10))
+    while (y > 0): {
+        print(&x.val)
+        print((1 / y))
+    }"""
+    prog = Parser(Tokenizer(counter)).parse_program().to_ir_program()
+    to_ssa(prog)
+    report = licm(prog)
+    # the tag check, field map, offset and field of this and the multiplication, but main's loop never runs and x
+    # isn't an object, so only the loop test and x's tag check can be moved out of it, not the read of x's field or
+    # the division (by 0)
+    assert report["Countersum"] == {"loops": 1, "hoisted": 5} and report["main"] == {"loops": 1, "hoisted": 2}
+    dom = Dominators(prog, "Countersum")
+    assert all("getelt" not in str(s) for b in natural_loops(dom)[0].blocks for s in dom.block(b).statements)
+    assert IRInterpreter(prog).run() == [120]
+
+    for prg in [first_example, working(simple_stack), working(complex_stack), optimal, nothing, constants, counter]:
+        prog = Parser(Tokenizer(prg)).parse_program().to_ir_program()
+        expected = IRInterpreter(prog).run()
+        optimize(prog)
+        assert IRInterpreter(prog).run() == expected
+
+def test_devirtualize_and_inline():
+    prog = Parser(Tokenizer(working(complex_stack))).parse_program().to_ir_program()
+    impls = method_implementations(prog)
+    assert impls[prog.method_slot("getVal")] == {"ListNodegetVal"} and impls[prog.method_slot("do")] == {"Stackerdo"}
+    to_ssa(prog)
+    report = devirtualize(prog)
+    # only Stack has push and pop, and main's Stacker was just allocated, but do can't know its stk has the methods
+    assert report["Stackerdo"]["calls"] == 3 and report["main"]["calls"] == 1
+    text = "\n".join(str(b) for b in prog.function_blocks("Stackerdo"))
+    assert "call(Stackpush, %stk, %x.3)" in text and text.count("else NoSuchMethod") == 3
+    assert IRInterpreter(prog).run() == list(range(1, 21))
+
+    report = inline(prog)
+    # the getters are small enough, push and pop aren't
+    assert report["Stackpop"] == {"calls": 2, "instructions": 18} and report["Stackerdo"]["calls"] == 0
+    assert "call(" not in "\n".join(str(b) for b in prog.function_blocks("Stackpop"))
+    assert IRInterpreter(prog).run() == list(range(1, 21))
+    assert IRInterpreter(PackedProgram.from_ir(prog).to_ir()).run() == list(range(1, 21))
+
+    for prg in [first_example, working(simple_stack), working(complex_stack), optimal, nothing]:
+        prog = Parser(Tokenizer(prg)).parse_program().to_ir_program()
+        expected = IRInterpreter(prog).run()
+        to_ssa(prog)
+        devirtualize(prog)
+        inline(prog, budget=100)
+        assert IRInterpreter(prog).run() == expected
+        optimize(prog)
+        assert IRInterpreter(prog).run() == expected
+
+    # a callee assigning its parameter leaves main in SSA form once inlined
+    prog = Parser(Tokenizer("""class A [
+    fields
+    method m(p) with locals:
+        p = (p + 1)
+        ifonly (p == 2): {
+            print(5)
+        }
+        return 0
+]
+
+main with a:
+    a = @A
+    _ = ^a.m(1)""")).parse_program().to_ir_program()
+    to_ssa(prog)
+    devirtualize(prog)
+    assert inline(prog)["main"]["calls"] == 1
+    assigned = [s.v.reg for b in prog.function_blocks("main") for s in b.statements if type(s) is IRAssign]
+    assert len(assigned) == len(set(assigned)) and IRInterpreter(prog).run() == [5]
+    optimize(prog)
+    assert IRInterpreter(prog).run() == [5]
+
+def test_resolve_fields():
+    prog = Parser(Tokenizer(first_example)).parse_program().to_ir_program()
+    to_ssa(prog)
+    assert receiver_classes(prog, "Am") == {"this": 0} and receiver_classes(prog, "main") == {"tmp4": 0, "x.2": 0}
+    report = resolve_fields(prog)
+    # x's field and its tag checks for that and the call, this's field in A.m
+    assert report["main"] == {"fields": 1, "checks": 2} and report["Am"] == {"fields": 1, "checks": 1}
+    assert [str(s) for s in prog.get_block("Am").statements] == ["%tmp0 = 0"]
+    assert IRInterpreter(prog).run() == [3]
+    optimize(prog)
+    assert str(prog.get_block("Am")) == "Am:\n    %tmp3 = getelt(%this, 2)\n    ret %tmp3"
+
+    # a phi of objects of one class has it, not one with something else
+    prog = Parser(Tokenizer(first_example.split("main with")[0] + """main with x, y, z:
+    x = @A
+    y = @A
+    while (z < 2): {
+        y = x
+        z = (z + 1)
+        x = @A
+    }
+    z = @B
+    ifonly (&y.x == 1): {
+        z = y
+    }
+    print(&y.x)
+    print(&z.y)""")).parse_program().to_ir_program()
+    expected = IRInterpreter(prog).run()
+    to_ssa(prog)
+    classes = receiver_classes(prog, "main")
+    assert classes["y.3"] == classes["x.3"] == 0 and classes["z.4"] == 1 and "z.5" not in classes
+    report = resolve_fields(prog)["main"]
+    assert report == {"fields": 2, "checks": 2} and IRInterpreter(prog).run() == expected == [0, 0]
+
+def test_scalar_replacement():
+    prog = Parser(Tokenizer(first_example)).parse_program().to_ir_program()
+    report = optimize(prog)
+    # x only has its field written and read, and its method inlined, so it goes along with the tag checks
+    assert report["escape"]["main"] == {"allocations": 1, "instructions": 5}
+    assert [str(s) for s in prog.get_block("main").statements] == ["print(3)"]
+
+    prog = Parser(Tokenizer("""class Pt [
+    fields x, y
+    method sum() with locals:
+      return (&this.x + &this.y)
+]
+
+main with p, q, s, i:
+    while (i < 4): {
+        p = @Pt
+        !p.x = i
+        !p.y = (i * 2)
+        s = (s + ^p.sum())
+        i = (i + 1)
+    }
+    q = @Pt
+    !q.x = s
+    p = @Pt
+    !p.x = q
+    q = &p.x
+    print(^q.sum())""")).parse_program().to_ir_program()
+    expected = IRInterpreter(prog).run()
+    to_ssa(prog)
+    devirtualize(prog)
+    inline(prog)
+    resolve_fields(prog)
+    sccp(prog)
+    # the points made in the loop and the last one, but not the one stored in it
+    assert scalar_replace(prog)["main"] == {"allocations": 2, "instructions": 11}
+    allocs = [s for b in prog.function_blocks("main") for s in b.statements if type(s) is IRAssign and type(s.val) is IRAlloc]
+    assert len(allocs) == 1 and IRInterpreter(prog).run() == expected == [18]
+
+    for prg in [working(simple_stack), working(complex_stack), optimal, constants]:
+        prog = Parser(Tokenizer(prg)).parse_program().to_ir_program()
+        expected = IRInterpreter(prog).run()
+        optimize(prog)
+        assert IRInterpreter(prog).run() == expected
+
+def test_compact_tables():
+    assert color_symbols([[3, 1], [1, 2], [4], [2, 0, 4]], 6) == ([2, 1, 0, 0, 1, -1], 3)
+
+    tree = Parser(Tokenizer(first_example)).parse_program()
+    prog = tree.to_ir_tables(compact=True)
+    # A's x and B's y share a slot, which says whose offset it is
+    assert prog.field_name_to_map_index == {"x": 0, "y": 0} and prog.method_name_to_vtbl_index == {"m": 0}
+    x, y = tree.classes[0].fields[0], tree.classes[1].fields[0]
+    assert [c.n for c in prog.field_maps[0].vals] == [x.id + 1, 2] and [c.n for c in prog.field_maps[1].vals] == [y.id + 1, 2]
+    assert prog.object_size(0) == 3 and prog.table_sizes() == {"vtables": (2, 4), "field maps": (4, 4)}
+
+    for prg in [first_example, working(simple_stack), working(complex_stack), nothing]:
+        expected = run(prg)
+        prog = Parser(Tokenizer(prg)).parse_program().to_ir_program(compact=True)
+        assert IRInterpreter(prog).run() == expected
+        optimize(prog)
+        assert IRInterpreter(prog).run() == expected
+    for wrong, message in [("print(&x.y)", "NoSuchField"), ("print(^x.n())", "NoSuchMethod")]:
+        # n is B's and shares a slot with A's m
+        prg = first_example.replace("print(^x.m())", wrong).replace("fields y\n    method m()", "fields y\n    method n()")
+        for prog in [Parser(Tokenizer(prg)).parse_program().to_ir_program(compact=compact) for compact in [False, True]]:
+            with pytest.raises(RuntimeError, match=message):
+                IRInterpreter(prog).run()
+
+    # classes with fields and methods of their own only need as many slots as the biggest of them
+    names = [chr(97 + i // 26) + chr(97 + i % 26) for i in range(50)]  # identifiers can't have digits
+    classes = "".join(f"class C{n} [\n    fields a{n}, b{n}\n    method m{n}() with locals:\n        return 0\n]\n"
+                      for n in names)
+    prog = Parser(Tokenizer(classes + "\nmain with:")).parse_program().to_ir_tables(compact=True)
+    assert prog.table_sizes() == {"vtables": (2500, 100), "field maps": (5000, 200)}